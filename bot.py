@@ -43,7 +43,9 @@ bot.py — Listen/Live Only + Sender with:
 
 import argparse
 import asyncio
+import atexit
 import csv
+import functools
 import logging
 import os
 import random
@@ -51,14 +53,17 @@ import sys
 import sqlite3
 import json
 import hashlib
+import heapq
 import re
+import threading
 import time
 
-from collections import defaultdict
-from contextlib import asynccontextmanager
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
 from dataclasses import dataclass
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 from pathlib import Path
+from types import MappingProxyType
 from typing import Dict, List, Optional, Tuple, Union
 from urllib.parse import urlparse
 
@@ -81,6 +86,23 @@ try:
 except Exception:
     OpenAI = None  # type: ignore
 
+try:
+    import re2  # google-re2 (اختياري): DFA من غير backtracking للـ scans اللي بتتعمل مع كل رسالة
+except Exception:
+    re2 = None  # type: ignore
+
+try:
+    import orjson  # اختياري: encoding أسرع للـ JSON في الـ hot path بتاع الليسنر
+except Exception:
+    orjson = None  # type: ignore
+
+
+def dumps_json(obj) -> str:
+    """Compact UTF-8 JSON (زي ensure_ascii=False) — orjson لو متاح."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
 
 # -----------------------
 # OpenAI client (optional)
@@ -94,7 +116,14 @@ if OpenAI and OPENAI_API_KEY:
         openai_client = None
 
 
+# ✅ regex متجمّعة مرة واحدة (بتتنادى مع كل رسالة وكل سطر في ملفات المستلمين)
+_RE_USERNAME = re.compile(r"[A-Za-z0-9_]{5,}")
+_TG_USERNAME_CHARS = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_"
+_RE_WS = re.compile(r"\s+")
+_RE_NONWORD = re.compile(r"[^0-9a-zA-Z_]+")
+
 
+@functools.lru_cache(maxsize=8192)
 def normalize_recipient(s: str) -> str:
     """
     Normalize telegram recipient to @username if possible.
@@ -116,7 +145,7 @@ def normalize_recipient(s: str) -> str:
         return s
 
     # raw username
-    if re.fullmatch(r"[A-Za-z0-9_]{5,}", s):
+    if _RE_USERNAME.fullmatch(s):
         return "@" + s
 
     return s
@@ -166,74 +195,278 @@ def atomic_write_lines(path: str, lines: List[str]):
             f.write(l.rstrip("\n") + "\n")
     os.replace(tmp, path)
 
-@asynccontextmanager
-async def file_lock(path: str, mode="a+"):
-    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
-    f = open(path, mode, encoding="utf-8")
+# ✅ جوه البروسيس: asyncio.Lock لكل path (من غير syscall).
+# بين البروسيسات: portalocker مع كل عملية دايمًا (السندر بيلمس نفس الملفات).
+# acquire_process_lock بيمنع تشغيل listener تاني بس، مش بديل عن الـ lock بتاع كل كتابة.
+_PATH_LOCKS: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+_PROCESS_LOCK_FILE = None
+
+def acquire_process_lock(lock_path: str, logger: Optional[logging.Logger] = None) -> bool:
+    """Exclusive non-blocking single-instance lock; False if another listener already holds it."""
+    global _PROCESS_LOCK_FILE
+    if _PROCESS_LOCK_FILE is not None:
+        return True
+    os.makedirs(os.path.dirname(lock_path) or ".", exist_ok=True)
+    f = open(lock_path, "a+", encoding="utf-8")
     try:
-        portalocker.lock(f, portalocker.LOCK_EX)
-        yield f
-    finally:
-        try:
-            f.flush()
-            os.fsync(f.fileno())
-        except Exception:
-            pass
-        portalocker.unlock(f)
+        portalocker.lock(f, portalocker.LOCK_EX | portalocker.LOCK_NB)
+    except portalocker.LockException:
         f.close()
+        if logger:
+            logger.error(f"[LOCK] {lock_path} is held by another listener -> refusing to start")
+        return False
+    _PROCESS_LOCK_FILE = f
+    return True
+
+# ✅ كاش للملفات: path -> (stat signature, data)
+# الـ sender بروسيس تانية بتعدّل نفس الملفات، فأي تغيير في (ino, mtime, size)
+# من بره بيخلّي الكاش يتقري من جديد.
+_LINES_CACHE: Dict[str, Tuple[Tuple[int, int, int], List[str]]] = {}
+_UNIQUE_CACHE: Dict[str, Tuple[Tuple[int, int, int], set]] = {}
+
+def _stat_sig(st: os.stat_result) -> Tuple[int, int, int]:
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
 
 def read_lines_unique(path: str) -> List[str]:
-    if not os.path.exists(path):
+    try:
+        sig = _stat_sig(os.stat(path))
+    except FileNotFoundError:
+        _LINES_CACHE.pop(path, None)
         return []
-    with open(path, "r", encoding="utf-8") as f:
-        lines = [ln.strip() for ln in f if ln.strip()]
+    cached = _LINES_CACHE.get(path)
+    if cached is not None and cached[0] == sig:
+        return list(cached[1])
     seen = set()
     out = []
-    for l in lines:
-        if l not in seen:
-            seen.add(l)
-            out.append(l)
-    return out
+    with open(path, "r", encoding="utf-8") as f:
+        for ln in f:
+            l = ln.strip()
+            if l and l not in seen:
+                seen.add(l)
+                out.append(l)
+    _LINES_CACHE[path] = (sig, out)
+    return list(out)
+
+def append_line(path: str, line: str):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line.rstrip("\n") + "\n")
+
+
+# ✅ السندر: الحذف/النقل لآخر الملف بيتسجل في path.journal (سطر واحد لكل عملية)
+# وبيتطبق على الملف مرة واحدة في flush_file_ops بدل rewrite كامل مع كل يوزر.
+# "-x" = احذف x ، ">x" = انقل x لآخر الملف
+_FILE_OPS: Dict[str, List[Tuple[str, str]]] = {}
+_FILE_OPS_SINCE: Dict[str, float] = {}  # أول op لسه ما اتطبقش (monotonic)
+# ✅ الملف بيتعاد كتابته كل FILE_OPS_FLUSH_OPS عملية أو FILE_OPS_FLUSH_SEC (مش مع كل إرسال)
+FILE_OPS_FLUSH_OPS = 100
+FILE_OPS_FLUSH_SEC = 30.0
+
+def _journal_path(path: str) -> str:
+    return path + ".journal"
+
+def _queue_file_op(path: str, op: str, line: str):
+    ops = _FILE_OPS.get(path)
+    if ops is None:
+        ops = _FILE_OPS[path] = []
+        _FILE_OPS_SINCE[path] = time.monotonic()
+    ops.append((op, line))
+    append_line(_journal_path(path), op + line)
+    if len(ops) >= FILE_OPS_FLUSH_OPS:
+        flush_file_ops(path)
+
+def queue_remove_line(path: str, line: str):
+    _queue_file_op(path, "-", line)
+
+def queue_move_line_to_end(path: str, line: str):
+    _queue_file_op(path, ">", line)
+
+def _read_journal(jpath: str) -> List[Tuple[str, str]]:
+    ops: List[Tuple[str, str]] = []
+    with open(jpath, "r", encoding="utf-8") as f:
+        for ln in f:
+            ln = ln.rstrip("\n")
+            if len(ln) > 1 and ln[0] in "->":
+                ops.append((ln[0], ln[1:]))
+    return ops
+
+def flush_file_ops(path: str) -> int:
+    """Apply pending ops (or a leftover journal from a crash) to path. Returns #ops."""
+    jpath = _journal_path(path)
+    ops = _FILE_OPS.pop(path, None)
+    _FILE_OPS_SINCE.pop(path, None)
+    if not ops:
+        if not os.path.exists(jpath):
+            return 0
+        ops = _read_journal(jpath)
+    if ops:
+        # الملف بيتقري من جديد هنا عشان ما نضيعش اللي الـ listener ضافه في النص
+        state = dict.fromkeys(read_lines_unique(path))
+        for op, line in ops:
+            if op == "-":
+                state.pop(line, None)
+            elif line in state:
+                del state[line]
+                state[line] = None
+        atomic_write_lines(path, list(state))
+    try:
+        os.remove(jpath)
+    except FileNotFoundError:
+        pass
+    return len(ops)
+
+# ✅ polling بالـ stat sig: الـ flow بيستنى لحد ما الملف يتغير (الـ listener ضاف يوزرات)
+# بدل ما يعيد قراية الملف كله في loop
+FILE_POLL_SEC = 2.0
+
+def _file_sig(path: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        return _stat_sig(os.stat(path))
+    except FileNotFoundError:
+        return None
+
+async def wait_for_file_change(path: str, timeout: float, poll_sec: float = FILE_POLL_SEC) -> bool:
+    """True لو الملف اتغير قبل الـ timeout."""
+    sig = _file_sig(path)
+    deadline = time.monotonic() + timeout
+    while True:
+        left = deadline - time.monotonic()
+        if left <= 0:
+            return False
+        await asyncio.sleep(min(poll_sec, left))
+        if _file_sig(path) != sig:
+            return True
+
+def flush_all_file_ops(min_age_sec: float = 0.0):
+    now = time.monotonic()
+    for path in list(_FILE_OPS):
+        if now - _FILE_OPS_SINCE.get(path, 0.0) >= min_age_sec:
+            flush_file_ops(path)
 
-def append_unique_line(path: str, line: str) -> bool:
+async def file_ops_flusher(logger: logging.Logger, interval_sec: float = 5.0):
+    while True:
+        await asyncio.sleep(interval_sec)
+        try:
+            flush_all_file_ops(FILE_OPS_FLUSH_SEC)
+        except Exception as e:
+            logger.warning(f"[FILE-OPS] flush failed: {e}")
+        flush_csv_logs()
+
+# ✅ نسخ async للـ listener: الـ dedupe من الـ set اللي في الذاكرة، والسطور الجديدة
+# بتتجمع في _PENDING_LINES وتتكتب batch (كل PENDING_FLUSH_LINES سطر أو كل PENDING_FLUSH_SEC)
+PENDING_FLUSH_LINES = 32
+PENDING_FLUSH_SEC = 2.0
+_PENDING_LINES: Dict[str, List[str]] = defaultdict(list)
+
+def _load_unique_set(path: str) -> Tuple[Tuple[int, int, int], set]:
     os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
     with open(path, "a+", encoding="utf-8") as f:
-        portalocker.lock(f, portalocker.LOCK_EX)
         f.seek(0)
-        lines = [ln.strip() for ln in f if ln.strip()]
-        if line in lines:
-            portalocker.unlock(f)
-            return False
-        f.write(line + "\n")
-        portalocker.unlock(f)
-    return True
+        seen = {ln.strip() for ln in f if ln.strip()}
+        return _stat_sig(os.fstat(f.fileno())), seen
 
-def remove_username_from_file_atomic(path: str, username: str):
-    lines = read_lines_unique(path)
-    new = [l for l in lines if l != username]
-    atomic_write_lines(path, new)
+def _write_pending_lines(path: str, lines: List[str], known_sig) -> Tuple[Tuple[int, int, int], Optional[set]]:
+    """
+    Append lines under the file lock. If the file changed behind us (السندر شال يوزرات
+    مثلًا) we re-read it first, skip lines it already has and return the fresh set.
+    """
+    fresh: Optional[set] = None
+    with open(path, "a+", encoding="utf-8") as f:
+        portalocker.lock(f, portalocker.LOCK_EX)
+        try:
+            if _stat_sig(os.fstat(f.fileno())) != known_sig:
+                f.seek(0)
+                fresh = {ln.strip() for ln in f if ln.strip()}
+                lines = [l for l in lines if l not in fresh]
+            if lines:
+                f.write("".join(l + "\n" for l in lines))
+                f.flush()
+            if fresh is not None:
+                fresh.update(lines)
+            return _stat_sig(os.fstat(f.fileno())), fresh
+        finally:
+            portalocker.unlock(f)
 
-def move_line_to_end_atomic(path: str, line: str) -> bool:
-    lines = read_lines_unique(path)
-    if not lines:
-        return False
-    found = False
-    new = []
-    for l in lines:
-        if (not found) and l == line:
-            found = True
-            continue
-        new.append(l)
-    if not found:
+async def flush_pending_lines(path: str):
+    async with _PATH_LOCKS[path]:
+        lines = _PENDING_LINES.pop(path, None)
+        if not lines:
+            return
+        known_sig = _UNIQUE_CACHE[path][0] if path in _UNIQUE_CACHE else None
+        try:
+            sig, fresh = await asyncio.to_thread(_write_pending_lines, path, lines, known_sig)
+        except BaseException:
+            # الكتابة فشلت -> السطور ترجع أول الطابور (لسه في الـ set) والـ flusher يحاول تاني
+            _PENDING_LINES[path][:0] = lines
+            raise
+        logging.getLogger("tg_live").info(f"[FILES] wrote {len(lines)} line(s) -> {path}")
+        if fresh is None:
+            seen = _UNIQUE_CACHE[path][1] if path in _UNIQUE_CACHE else set(lines)
+        else:
+            # اللي اتضاف في الـ set أثناء الكتابة لسه في _PENDING_LINES
+            seen = fresh
+            seen.update(_PENDING_LINES.get(path, ()))
+        _UNIQUE_CACHE[path] = (sig, seen)
+
+async def flush_all_pending_lines():
+    for path in list(_PENDING_LINES):
+        await flush_pending_lines(path)
+
+def _changed_unique_paths(items: List[Tuple[str, Tuple[int, int, int]]]) -> List[str]:
+    changed = []
+    for path, sig in items:
+        try:
+            if _stat_sig(os.stat(path)) != sig:
+                changed.append(path)
+        except FileNotFoundError:
+            changed.append(path)
+    return changed
+
+async def refresh_unique_sets():
+    """Reload the dedupe set of any file changed behind us (السندر بيشيل اليوزرات اللي اتبعتلهم)."""
+    items = [(p, c[0]) for p, c in _UNIQUE_CACHE.items()]
+    for path in await asyncio.to_thread(_changed_unique_paths, items):
+        async with _PATH_LOCKS[path]:
+            sig, seen = await asyncio.to_thread(_load_unique_set, path)
+            # اللي لسه مستني يتكتب يفضل محسوب
+            seen.update(_PENDING_LINES.get(path, ()))
+            _UNIQUE_CACHE[path] = (sig, seen)
+
+async def pending_lines_flusher(logger: logging.Logger, interval_sec: float = PENDING_FLUSH_SEC):
+    while True:
+        await asyncio.sleep(interval_sec)
+        try:
+            await flush_all_pending_lines()
+        except Exception as e:
+            logger.warning(f"[FILES] pending flush failed (lines re-queued): {e}")
+        try:
+            await refresh_unique_sets()
+        except Exception as e:
+            logger.warning(f"[FILES] dedupe refresh failed: {e}")
+
+async def append_unique_line_async(path: str, line: str) -> bool:
+    """Queue line for path unless already there; True = new line queued (بيتكتب في الـ flush الجاي، مش دلوقتي)."""
+    if path not in _UNIQUE_CACHE:
+        async with _PATH_LOCKS[path]:
+            if path not in _UNIQUE_CACHE:
+                _UNIQUE_CACHE[path] = await asyncio.to_thread(_load_unique_set, path)
+    seen = _UNIQUE_CACHE[path][1]
+    if line in seen:
         return False
-    new.append(line)
-    atomic_write_lines(path, new)
+    seen.add(line)
+    pending = _PENDING_LINES[path]
+    pending.append(line)
+    if len(pending) >= PENDING_FLUSH_LINES:
+        try:
+            await flush_pending_lines(path)
+        except Exception as e:
+            # السطور رجعت الطابور؛ الـ flusher هيحاول تاني
+            logging.getLogger("tg_live").warning(f"[FILES] flush {path} failed (lines re-queued): {e}")
     return True
 
-def append_line(path: str, line: str):
-    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
-    with open(path, "a", encoding="utf-8") as f:
-        f.write(line.rstrip("\n") + "\n")
+async def append_line_async(path: str, line: str):
+    async with _PATH_LOCKS[path]:
+        await asyncio.to_thread(append_line, path, line)
 
 
 # -----------------------
@@ -241,16 +474,42 @@ def append_line(path: str, line: str):
 # -----------------------
 DB_PATH = "data/listen_messages.db"
 
+# ✅ اتصال واحد (WAL) لكل البروسيس بدل open/close مع كل helper
+_CONN: Optional[sqlite3.Connection] = None
+_DB_LOCK = threading.RLock()
+
+def _get_conn() -> sqlite3.Connection:
+    global _CONN
+    if _CONN is None:
+        os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-65536")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA busy_timeout=5000")
+        _CONN = conn
+    return _CONN
+
+@contextmanager
+def _db_cur():
+    """Cursor on the shared connection; commits on success, rolls back on error."""
+    with _DB_LOCK:
+        conn = _get_conn()
+        with conn:
+            cur = conn.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+
 def db_add_column_if_missing(table: str, column: str, col_def: str):
-    os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(f"PRAGMA table_info({table})")
-    cols = [r[1] for r in cur.fetchall()]
-    if column not in cols:
-        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {col_def}")
-        conn.commit()
-    conn.close()
+    with _db_cur() as cur:
+        cur.execute(f"PRAGMA table_info({table})")
+        cols = [r[1] for r in cur.fetchall()]
+        if column not in cols:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {col_def}")
 
 def _db_init_broadcast(cur):
     """
@@ -270,11 +529,7 @@ def _db_init_broadcast(cur):
 
 
 
-def db_init():
-    os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
+def _db_init_schema(cur):
     # messages
     cur.execute("""
     CREATE TABLE IF NOT EXISTS messages(
@@ -290,6 +545,9 @@ def db_init():
     )
     """)
 
+    cur.execute("""CREATE INDEX IF NOT EXISTS idx_messages_date ON messages(date)""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS idx_messages_user ON messages(user_id)""")
+
     cur.execute("""CREATE TABLE IF NOT EXISTS blocked_users(user_id INTEGER PRIMARY KEY)""")
     cur.execute("""CREATE TABLE IF NOT EXISTS approved_viewers(user_id INTEGER PRIMARY KEY)""")
 
@@ -323,27 +581,46 @@ def db_init():
     )
     """)
 
+    # OpenAI subjects cache (text hash -> subjects json)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ai_subjects_cache(
+        text_hash TEXT PRIMARY KEY,
+        subjects_json TEXT NOT NULL,
+        ts TEXT
+    )
+    """)
+
     #_db_init_broadcast(cur)
 
-    conn.commit()
-    conn.close()
+
+def db_init():
+    with _db_cur() as cur:
+        _db_init_schema(cur)
 
     # migrations
     db_add_column_if_missing("messages", "source_tag", "TEXT")
     db_add_column_if_missing("messages", "uni_subjects", "TEXT")
     db_add_column_if_missing("groups", "uni_tag", "TEXT")
+    db_add_column_if_missing("groups", "chat_id", "INTEGER")
+    db_add_column_if_missing("groups", "chat_id_src", "TEXT")
+
+    # source_tag جاي من migration فوق -> الـ index بعده
+    with _db_cur() as cur:
+        cur.execute("""CREATE INDEX IF NOT EXISTS idx_messages_source_tag ON messages(source_tag)""")
+
+    db_load_blocked_cache()
 
 
 def db_load_enabled_sections() -> Dict[str, List[Tuple[str, List[str]]]]:
     """Return: {uni_tag: [(section_name, [kw..]), ...]}"""
     out: Dict[str, List[Tuple[str, List[str]]]] = {}
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("""SELECT uni_tag, section_name, keywords_json
-                       FROM uni_sections
-                       WHERE COALESCE(enabled,1)=1""")
-        for uni_tag, section_name, kws_json in cur.fetchall():
+        with _db_cur() as cur:
+            cur.execute("""SELECT uni_tag, section_name, keywords_json
+                           FROM uni_sections
+                           WHERE COALESCE(enabled,1)=1""")
+            rows = cur.fetchall()
+        for uni_tag, section_name, kws_json in rows:
             try:
                 kws = json.loads(kws_json or "[]")
                 if not isinstance(kws, list):
@@ -352,7 +629,6 @@ def db_load_enabled_sections() -> Dict[str, List[Tuple[str, List[str]]]]:
                 kws = []
             kws = [str(k).strip() for k in kws if str(k).strip()]
             out.setdefault(str(uni_tag).strip(), []).append((str(section_name).strip(), kws))
-        conn.close()
     except Exception:
         return {}
     return out
@@ -365,20 +641,17 @@ def db_seed_groups_from_config(cfg_groups):
     """Seed groups table from config.yaml on first run (only if table empty)."""
     if not cfg_groups:
         return
-    os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
     try:
-        cur.execute("SELECT COUNT(1) FROM groups")
-        n = int(cur.fetchone()[0] or 0)
+        with _db_cur() as cur:
+            cur.execute("SELECT COUNT(1) FROM groups")
+            n = int(cur.fetchone()[0] or 0)
     except Exception:
-        conn.close()
         return
     if n > 0:
-        conn.close()
         return
 
     now = utc_now().isoformat()
+    rows = []
     for g in cfg_groups:
         tpl_text = ""
         try:
@@ -395,67 +668,53 @@ def db_seed_groups_from_config(cfg_groups):
         out_file = str(getattr(g, "out_file", "") or "").strip() or f"outputs/{name}.txt"
         chat_s = str(getattr(g, "chat", ""))
 
-        cur.execute(
+        rows.append((
+            name,
+            chat_s,
+            out_file,
+            tpl_text,
+            1 if bool(getattr(g, "attachments_enabled", False)) else 0,
+            1 if bool(getattr(g, "send_enabled", True)) else 0,
+            1 if bool(getattr(g, "subjects_only", False)) else 0,
+            (getattr(g, "uni_tag", None) or "").strip(),
+            now,
+            now,
+        ))
+
+    # ✅ قراءة القوالب برّه الـ transaction، وبعدين INSERT واحد بـ executemany
+    with _db_cur() as cur:
+        cur.executemany(
             """INSERT OR IGNORE INTO groups
                (name, chat, out_file, template_text, attachments_enabled, send_enabled, subjects_only, uni_tag, created_at, updated_at)
                VALUES(?,?,?,?,?,?,?,?,?,?)""",
-            (
-                name,
-                chat_s,
-                out_file,
-                tpl_text,
-                1 if bool(getattr(g, "attachments_enabled", False)) else 0,
-                1 if bool(getattr(g, "send_enabled", True)) else 0,
-                1 if bool(getattr(g, "subjects_only", False)) else 0,
-                (getattr(g, "uni_tag", None) or "").strip(),
-                now,
-                now,
-            )
+            rows
         )
-    conn.commit()
-    conn.close()
 
 
 def db_load_groups():
     """Load groups from DB as GroupConfig list. Template is stored inline in DB."""
     groups: List[GroupConfig] = []
-    os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    # ✅ uni_tag may be missing in old DBs; we handle both
-    cur.execute("PRAGMA table_info(groups)")
-    cols = {r[1] for r in cur.fetchall()}
-    has_uni_tag = "uni_tag" in cols
-
-    if has_uni_tag:
-        cur.execute("""SELECT name, chat, out_file, template_text,
-                              COALESCE(attachments_enabled,0),
-                              COALESCE(send_enabled,1),
-                              COALESCE(subjects_only,0),
-                              COALESCE(uni_tag,'')
-                       FROM groups
-                       ORDER BY id ASC""")
-    else:
+    # ✅ db_init بيضمن وجود uni_tag (db_add_column_if_missing) -> query واحدة من غير PRAGMA
+    with _db_cur() as cur:
+        cur.row_factory = sqlite3.Row
         cur.execute("""SELECT name, chat, out_file, template_text,
-                              COALESCE(attachments_enabled,0),
-                              COALESCE(send_enabled,1),
-                              COALESCE(subjects_only,0)
+                              COALESCE(attachments_enabled,0) AS attachments_enabled,
+                              COALESCE(send_enabled,1)        AS send_enabled,
+                              COALESCE(subjects_only,0)       AS subjects_only,
+                              COALESCE(uni_tag,'')            AS uni_tag,
+                              chat_id, chat_id_src
                        FROM groups
                        ORDER BY id ASC""")
-    rows = cur.fetchall()
-    conn.close()
+        rows = cur.fetchall()
 
     for row in rows:
-        if has_uni_tag:
-            name, chat, out_file, template_text, att, send_en, subj_only, uni_tag = row
-        else:
-            name, chat, out_file, template_text, att, send_en, subj_only = row
-            uni_tag = ""
-
+        chat = row["chat"]
         chat_val: Union[str, int]
         chat_s = str(chat).strip()
-        if chat_s.lstrip("-").isdigit():
+        # ✅ chat_id محلول مسبقًا (resolve_group_chat_ids) وصالح طالما chat ما اتغيرش من mod_bot
+        if row["chat_id"] is not None and row["chat_id_src"] == chat_s:
+            chat_val = int(row["chat_id"])
+        elif chat_s.lstrip("-").isdigit():
             try:
                 chat_val = int(chat_s)
             except Exception:
@@ -464,22 +723,59 @@ def db_load_groups():
             chat_val = chat_s
 
         g = GroupConfig(
-            name=str(name),
+            name=str(row["name"]),
             chat=chat_val,
-            out_file=str(out_file),
+            out_file=str(row["out_file"]),
             template_path=None,
-            attachments_enabled=bool(att),
-            send_enabled=bool(send_en),
-            subjects_only=bool(subj_only),
-            uni_tag=(str(uni_tag).strip() or None),
+            attachments_enabled=bool(row["attachments_enabled"]),
+            send_enabled=bool(row["send_enabled"]),
+            subjects_only=bool(row["subjects_only"]),
+            uni_tag=(str(row["uni_tag"]).strip() or None),
         )
-        setattr(g, "_template_text", (template_text or "").strip())
+        setattr(g, "_template_text", (row["template_text"] or "").strip())
+        setattr(g, "_chat_src", chat_s)
         groups.append(g)
 
     return groups
 
 
-_GROUPS_CACHE = {"ts": 0.0, "by_user": {}, "by_id": {}, "list": []}
+def db_set_group_chat_id(name: str, chat_src: str, chat_id: int):
+    with _db_cur() as cur:
+        cur.execute(
+            "UPDATE groups SET chat_id=?, chat_id_src=? WHERE name=? AND chat=?",
+            (int(chat_id), chat_src, name, chat_src),
+        )
+
+
+async def resolve_group_chat_ids(client: Client, logger: logging.Logger) -> int:
+    """
+    Resolve @username/link chats to int ids once (get_chat) and persist them
+    in groups.chat_id, so later runs and lookups use the int directly.
+    """
+    n = 0
+    for g in db_load_groups():
+        if isinstance(g.chat, int) or not g.chat:
+            continue
+        try:
+            chat = await client.get_chat(g.chat)
+        except Exception as e:
+            logger.warning(f"[GROUPS] could not resolve chat {g.chat!r} (group={g.name}): {e}")
+            continue
+        db_set_group_chat_id(g.name, getattr(g, "_chat_src", str(g.chat)), chat.id)
+        n += 1
+    if n:
+        _GROUPS_CACHE["ts"] = 0.0
+        logger.info(f"[GROUPS] resolved {n} chat(s) to ids")
+    return n
+
+
+_GROUPS_CACHE = {
+    "ts": 0.0,
+    "list": (),
+    "by_user": MappingProxyType({}),
+    "by_id": MappingProxyType({}),
+    "by_int_id": MappingProxyType({}),
+}
 
 def _build_group_maps(groups):
     def norm_key(chat: Union[str, int]) -> str:
@@ -492,25 +788,107 @@ def _build_group_maps(groups):
 
     by_user: Dict[str, GroupConfig] = {}
     by_id: Dict[str, GroupConfig] = {}
+    by_int_id: Dict[int, GroupConfig] = {}  # ✅ chat.id من Pyrogram int جاهز -> lookup من غير str()
     for g in groups:
         if isinstance(g.chat, int) or str(g.chat).lstrip("-").isdigit():
             by_id[str(g.chat)] = g
+            by_int_id[int(g.chat)] = g
+            src = getattr(g, "_chat_src", "")
+            if src and not src.lstrip("-").isdigit():
+                by_user[norm_key(src)] = g  # محلول من @username -> الاتنين شغالين
         else:
             by_user[norm_key(g.chat)] = g
-    return by_user, by_id
+    return by_user, by_id, by_int_id
 
 
 def get_groups_cached(ttl_sec: float = 30.0):
-    """Return (groups_list, by_username, by_id) with TTL cache."""
+    """
+    Return (groups_tuple, by_username, by_id, by_int_id) with TTL cache.
+    ✅ من غير نسخ: الـ mappings read-only (MappingProxyType) والـ list tuple — ما تعدّلش فيهم.
+    """
     now_ts = utc_now().timestamp()
     if (now_ts - _GROUPS_CACHE["ts"]) > ttl_sec or not _GROUPS_CACHE["list"]:
         glist = db_load_groups()
-        by_user, by_id = _build_group_maps(glist)
-        _GROUPS_CACHE["list"] = glist
-        _GROUPS_CACHE["by_user"] = by_user
-        _GROUPS_CACHE["by_id"] = by_id
+        by_user, by_id, by_int_id = _build_group_maps(glist)
+        _GROUPS_CACHE["list"] = tuple(glist)
+        _GROUPS_CACHE["by_user"] = MappingProxyType(by_user)
+        _GROUPS_CACHE["by_id"] = MappingProxyType(by_id)
+        _GROUPS_CACHE["by_int_id"] = MappingProxyType(by_int_id)
         _GROUPS_CACHE["ts"] = now_ts
-    return list(_GROUPS_CACHE["list"]), dict(_GROUPS_CACHE["by_user"]), dict(_GROUPS_CACHE["by_id"])
+    return _GROUPS_CACHE["list"], _GROUPS_CACHE["by_user"], _GROUPS_CACHE["by_id"], _GROUPS_CACHE["by_int_id"]
+
+
+# -----------------------
+# Background writer for listened messages
+# -----------------------
+# on_message بيحط الصف في queue بس، وكوروتين واحدة بتكتب الصفوف batches
+# (executemany جوه transaction واحدة) بدل INSERT + commit لكل رسالة.
+DB_WRITER_BULK_SIZE = 200
+DB_WRITER_FLUSH_SEC = 0.1
+DB_WRITER_QUEUE_MAX = 10000
+
+_DB_WRITER: Optional[asyncio.Queue] = None
+
+# '' بدل NULL للأعمدة النصية (mod_bot بيقرا من غير COALESCE)
+# source_tag بيتخزن متنضف (TRIM) -> mod_bot بيقارن بـ source_tag = ? على الـ index مباشرة
+_INSERT_MESSAGE_SQL = """
+    INSERT INTO messages(
+        chat_id, chat_username, user_id, username, text, date, source_tag, uni_subjects
+    )
+    VALUES(COALESCE(?,0), COALESCE(?,''), COALESCE(?,0), COALESCE(?,''), COALESCE(?,''), COALESCE(?,''),
+           TRIM(COALESCE(?,'')), COALESCE(?,''))
+"""
+
+def _db_write_messages(rows: List[Tuple]):
+    if not rows:
+        return
+    with _db_cur() as cur:
+        cur.executemany(_INSERT_MESSAGE_SQL, rows)
+
+def _drain_queue(q: asyncio.Queue, rows: List[Tuple], limit: int):
+    while len(rows) < limit:
+        try:
+            rows.append(q.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+
+async def _db_writer_loop(q: asyncio.Queue, logger: logging.Logger):
+    while True:
+        rows = [await q.get()]
+        try:
+            _drain_queue(q, rows, DB_WRITER_BULK_SIZE)
+            if len(rows) < DB_WRITER_BULK_SIZE:
+                await asyncio.sleep(DB_WRITER_FLUSH_SEC)
+                _drain_queue(q, rows, DB_WRITER_BULK_SIZE)
+        finally:
+            try:
+                # ✅ الـ commit في thread عشان on_message ما يستناش الـ fsync
+                await asyncio.shield(asyncio.to_thread(_db_write_messages, rows))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"[DB-WRITER] failed to write {len(rows)} rows: {e}")
+
+def start_db_writer(logger: logging.Logger) -> asyncio.Task:
+    global _DB_WRITER
+    _DB_WRITER = asyncio.Queue(maxsize=DB_WRITER_QUEUE_MAX)
+    return asyncio.create_task(_db_writer_loop(_DB_WRITER, logger))
+
+async def stop_db_writer(task: Optional[asyncio.Task]):
+    """Cancel the writer and flush whatever is still queued."""
+    global _DB_WRITER
+    q = _DB_WRITER
+    _DB_WRITER = None
+    if task:
+        task.cancel()
+        try:
+            await task
+        except (asyncio.CancelledError, Exception):
+            pass
+    if q is not None:
+        rows: List[Tuple] = []
+        _drain_queue(q, rows, q.qsize() + 1)
+        _db_write_messages(rows)
 
 
 def db_insert_message(
@@ -523,31 +901,58 @@ def db_insert_message(
     source_tag: Optional[str],
     uni_subjects_json: Optional[str] = None,
 ):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO messages(
-            chat_id, chat_username, user_id, username, text, date, source_tag, uni_subjects
-        )
-        VALUES(?,?,?,?,?,?,?,?)
-    """, (chat_id, chat_username, user_id, username, text, date_iso, source_tag, uni_subjects_json))
-    conn.commit()
-    conn.close()
+    # source_tag قيم قليلة بتتكرر جدًا (kw / uni_tag) -> intern عشان الصفوف اللي مستنية في الـ queue تشارك نفس الـ string
+    if source_tag:
+        source_tag = sys.intern(source_tag)
+    row = (chat_id, chat_username, user_id, username, text, date_iso, source_tag, uni_subjects_json)
+    if _DB_WRITER is not None:
+        try:
+            _DB_WRITER.put_nowait(row)
+            return
+        except asyncio.QueueFull:
+            pass
+    # no writer running (or queue full) -> write directly
+    _db_write_messages([row])
+
+# ✅ blocked_users في set بالذاكرة؛ mod_bot بيبلوك من بروسيس تانية فبنعمل reload كل TTL
+_BLOCKED_CACHE = {"ts": 0.0, "ids": set()}
+
+def db_load_blocked_cache():
+    with _db_cur() as cur:
+        cur.execute("SELECT user_id FROM blocked_users")
+        ids = {r[0] for r in cur.fetchall()}
+    _BLOCKED_CACHE["ids"] = ids
+    _BLOCKED_CACHE["ts"] = utc_now().timestamp()
 
 def db_block_user(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO blocked_users(user_id) VALUES(?)", (user_id,))
-    conn.commit()
-    conn.close()
+    with _db_cur() as cur:
+        cur.execute("INSERT OR IGNORE INTO blocked_users(user_id) VALUES(?)", (user_id,))
+    _BLOCKED_CACHE["ids"].add(user_id)
+
+def db_is_blocked(user_id: int, ttl_sec: float = 30.0) -> bool:
+    if (utc_now().timestamp() - _BLOCKED_CACHE["ts"]) > ttl_sec:
+        db_load_blocked_cache()
+    return user_id in _BLOCKED_CACHE["ids"]
+
 
-def db_is_blocked(user_id: int) -> bool:
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM blocked_users WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row is not None
+# ✅ الليسنر بيعمل reload للـ caches (blocked / groups / sections) في thread كل فترة،
+# فـ on_message بيلاقيها دايمًا fresh ومايلمسش SQLite (الـ TTL في الـ getters بيفضل fallback بس)
+LISTENER_CACHE_REFRESH_SEC = 20.0
+
+def _reload_listener_caches():
+    db_load_blocked_cache()
+    get_groups_cached(0.0)
+    _refresh_sections_cache(0.0)
+
+async def listener_cache_refresher(logger: logging.Logger, interval: float = LISTENER_CACHE_REFRESH_SEC):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(_reload_listener_caches)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"[CACHE] reload failed: {e}")
 
 
 # -----------------------
@@ -688,8 +1093,38 @@ class SafeDict(dict):
     def __missing__(self, key):
         return "{" + key + "}"
 
+# ✅ القالب بيتعمله format مرة واحدة لكل (template, group, sender) ويتقسم عند {username}
+# وبعد كده كل مستلم = join بسيط بدل format_map كامل.
+_TPL_CACHE: Dict[Tuple[str, str, str], Optional[List[str]]] = {}
+_TPL_CACHE_MAX = 1024
+_TPL_USER_MARK = "\x00USER\x00"
+
+def _template_parts(template_text: str, group_name: str, sender_name: str) -> Optional[List[str]]:
+    key = (template_text, group_name, sender_name)
+    try:
+        return _TPL_CACHE[key]
+    except KeyError:
+        pass
+    parts: Optional[List[str]] = None
+    # {username:..} / {username!r} بيغيّروا شكل القيمة نفسها -> المسار القديم
+    if "{username:" not in template_text and "{username!" not in template_text:
+        rendered = template_text.format_map(
+            SafeDict(username=_TPL_USER_MARK, group_name=group_name, sender_name=sender_name)
+        )
+        parts = rendered.split(_TPL_USER_MARK)
+    if len(_TPL_CACHE) >= _TPL_CACHE_MAX:
+        _TPL_CACHE.clear()
+    _TPL_CACHE[key] = parts
+    return parts
+
 def format_message(template_text: str, username: str, group_name: str, sender_name: str):
-    return template_text.format_map(SafeDict(username=username, group_name=group_name, sender_name=sender_name))
+    try:
+        parts = _template_parts(template_text, group_name, sender_name)
+    except (ValueError, IndexError, AttributeError, KeyError):
+        parts = None
+    if parts is None:
+        return template_text.format_map(SafeDict(username=username, group_name=group_name, sender_name=sender_name))
+    return username.join(parts)
 
 def message_key_for(name: str, template_path: Optional[str]) -> str:
     tpl = Path(template_path).name if template_path else "default"
@@ -705,48 +1140,111 @@ def load_permanent_blocked(path: str = "blocked_senders.txt") -> set:
                     blocked.add(s)
     return blocked
 
-def choose_sender_index(
-    mode: str,
-    sender_sessions: List[str],
-    last_index: int,
-    disabled_until: Dict[str, float],
-    now_ts: float,
-    perma_blocked: set
-) -> Optional[int]:
-    n = len(sender_sessions)
-    if n == 0:
-        return None
-
-    def is_available(sess):
-        if sess in perma_blocked:
-            return False
-        return now_ts >= disabled_until.get(sess, 0.0)
-
-    if mode == "single_account":
-        return 0 if is_available(sender_sessions[0]) else None
-
-    if mode == "random":
-        order = list(range(n))
-        random.shuffle(order)
-        for i in order:
-            if is_available(sender_sessions[i]):
-                return i
+class SenderPicker:
+    """
+    Amortized O(1) sender choice:
+    - ready: deque of indices in rotation order
+    - waiting: min-heap (disabled_until, idx) for temp-disabled senders
+    disabled_until/perma_blocked stay the source of truth (send_one_message
+    بيعدّلهم مباشرة)، والـ picker بيراجعهم lazily وقت الاختيار.
+    """
+    def __init__(self, n: int):
+        self.ready = deque(range(n))
+        self.waiting: List[Tuple[float, int]] = []
+
+    def pick(self, mode: str, sender_sessions: List[str], disabled_until: Dict[str, float],
+             now_ts: float, perma_blocked: set) -> Optional[int]:
+        while self.waiting and self.waiting[0][0] <= now_ts:
+            _, i = heapq.heappop(self.waiting)
+            until = disabled_until.get(sender_sessions[i], 0.0)
+            if until > now_ts:
+                heapq.heappush(self.waiting, (until, i))  # اتمدّ تاني
+            else:
+                self.ready.append(i)
+
+        if mode == "single_account":
+            sess = sender_sessions[0]
+            if sess in perma_blocked or now_ts < disabled_until.get(sess, 0.0):
+                return None
+            return 0
+
+        if mode == "random" and len(self.ready) > 1:
+            self.ready.rotate(-random.randrange(len(self.ready)))
+
+        while self.ready:
+            i = self.ready.popleft()
+            sess = sender_sessions[i]
+            if sess in perma_blocked:
+                continue  # خرج نهائيًا
+            until = disabled_until.get(sess, 0.0)
+            if now_ts < until:
+                heapq.heappush(self.waiting, (until, i))
+                continue
+            self.ready.append(i)
+            return i
         return None
 
-    # round_robin
-    for _ in range(n):
-        last_index = (last_index + 1) % n
-        if is_available(sender_sessions[last_index]):
-            return last_index
 
-    return None
-
-def jitter_sleep_sec(cfg: AppConfig, session_path: str) -> float:
-    if cfg.per_account_rate and session_path in cfg.per_account_rate:
-        r = cfg.per_account_rate[session_path]
-    else:
-        r = cfg.global_rate
-    return random.uniform(r.min_seconds, r.max_seconds)
+class TokenBucket:
+    """
+    rate tokens/sec, up to burst. acquire() waits for a token (FIFO via lock);
+    pause(sec) freezes the bucket (FloodWait / jitter بعد الإرسال)؛ لما الـ pause يخلص
+    فيه token جاهز على طول (الـ pause نفسه هو المسافة).
+    """
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = max(float(rate), 1e-6)
+        self.burst = max(float(burst), 1.0)
+        self.tokens = self.burst
+        self.ts = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+
+    def pause(self, seconds: float):
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens = 0.0
+        self.paused_until = max(self.paused_until, now + float(seconds))
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    self.ts = time.monotonic()
+                    self.tokens = max(self.tokens, 1.0)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self.tokens) / self.rate)
+
+# ✅ bucket عام لكل الحسابات + bucket لكل حساب (معدله من global_rate/per_account_rate)
+GLOBAL_SEND_RATE = 25.0
+GLOBAL_SEND_BURST = 5
+_GLOBAL_BUCKET: Optional[TokenBucket] = None
+_ACCT_BUCKETS: Dict[str, TokenBucket] = {}
+
+def get_global_bucket() -> TokenBucket:
+    global _GLOBAL_BUCKET
+    if _GLOBAL_BUCKET is None:
+        _GLOBAL_BUCKET = TokenBucket(GLOBAL_SEND_RATE, GLOBAL_SEND_BURST)
+    return _GLOBAL_BUCKET
+
+def get_account_bucket(cfg: AppConfig, session_path: str) -> TokenBucket:
+    b = _ACCT_BUCKETS.get(session_path)
+    if b is None:
+        if cfg.per_account_rate and session_path in cfg.per_account_rate:
+            r = cfg.per_account_rate[session_path]
+        else:
+            r = cfg.global_rate
+        b = _ACCT_BUCKETS[session_path] = TokenBucket(1.0 / max(r.min_seconds, 0.1), 1)
+    return b
 
 def load_template_text(path: Optional[str]) -> str:
     if path and os.path.exists(path):
@@ -777,40 +1275,166 @@ def is_valid_tg_username_recipient(s: str) -> bool:
     Valid Telegram username:
     @username (5–32 chars, letters/numbers/_)
     """
-    if not s or not s.startswith("@"):
+    if not s or s[0] != "@" or not (6 <= len(s) <= 33) or not s.isascii():
         return False
-    return bool(re.fullmatch(r"@[A-Za-z0-9_]{5,32}", s))
+    # ✅ delete كل الحروف المسموحة بـ bytes.translate (C) -> لو فضل حاجة يبقى invalid
+    return not s[1:].encode("ascii").translate(None, _TG_USERNAME_CHARS)
+
+
+# ✅ توحيد الحروف العربي (ألف/ياء/تاء مربوطة/همزات + تشكيل + أرقام هندي) في pass واحد بـ str.translate
+_AR_NORMALIZE_TABLE = str.maketrans(
+    {
+        **{chr(c): None for c in range(0x064B, 0x0653)},  # fathatan .. sukun
+        "\u0670": None,  # superscript alef
+        "\u0640": None,  # tatweel
+        "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+        "ى": "ي", "ئ": "ي",
+        "ؤ": "و",
+        "ة": "ه",
+        **{chr(0x0660 + d): str(d) for d in range(10)},  # ٠..٩
+        **{chr(0x06F0 + d): str(d) for d in range(10)},  # ۰..۹
+    }
+)
+
+def ar_normalize(text: str) -> str:
+    return (text or "").translate(_AR_NORMALIZE_TABLE)
 
 
 def slugify_section_name(name: str) -> str:
     s = (name or "").strip().lower()
-    s = re.sub(r"\s+", "_", s)
-    s = re.sub(r"[^0-9a-zA-Z_]+", "", s)
+    s = _RE_WS.sub("_", s)
+    s = _RE_NONWORD.sub("", s)
     if s:
         return s[:60]
     h = hashlib.md5((name or "").encode("utf-8", errors="ignore")).hexdigest()[:10]
     return f"sec_{h}"
 
-def match_manual_sections(text: str, sections: List[Tuple[str, List[str]]], case_insensitive: bool = True) -> List[str]:
-    if not text or not sections:
-        return []
-    t = text.lower() if case_insensitive else text
-    matched: List[str] = []
+def _build_sections_matcher(sections: List[Tuple[str, List[str]]], case_insensitive: bool = True) -> Dict:
+    """
+    Compile sections into one regex scan:
+    - pat: union of all keywords (longest first) inside a lookahead so every
+      start position is tried (زي `kw in text` بالظبط).
+    - kw_sections: keyword -> sections of that keyword + every keyword contained
+      in it, so the longest hit at a position also covers the shorter ones.
+    - order: section -> index (نرجّع النتيجة بنفس ترتيب السكشنات).
+    """
+    order: Dict[str, int] = {}
+    direct: Dict[str, List[str]] = {}
     for sec_name, kws in sections:
+        if sec_name not in order:
+            order[sec_name] = len(order)
         for kw in (kws or []):
-            if not kw:
+            k = ar_normalize(kw.lower() if case_insensitive else kw) if kw else ""
+            if not k:
                 continue
-            k = kw.lower() if case_insensitive else kw
-            if k and k in t:
-                matched.append(sec_name)
-                break
+            lst = direct.setdefault(k, [])
+            if sec_name not in lst:
+                lst.append(sec_name)
+
+    kws_sorted = sorted(direct, key=len, reverse=True)
+    kw_sections: Dict[str, List[str]] = {}
+    for i, k in enumerate(kws_sorted):
+        secs = list(direct[k])
+        for sub in kws_sorted[i + 1:]:
+            if sub in k:
+                secs.extend(x for x in direct[sub] if x not in secs)
+        kw_sections[k] = secs
+
+    pat = None
+    if kws_sorted:
+        pat = re.compile("(?=(" + "|".join(re.escape(k) for k in kws_sorted) + "))")
+    return {"pat": pat, "kw_sections": kw_sections, "order": order, "ci": case_insensitive}
+
+
+def _match_sections(matcher: Dict, text: str, lowered: bool = False) -> List[str]:
+    pat = matcher["pat"]
+    if not text or pat is None:
+        return []
+    # lowered=True: الـ caller عامل ar_normalize + lower() بالفعل
+    t = text if lowered else ar_normalize(text.lower() if matcher["ci"] else text)
+    kw_sections = matcher["kw_sections"]
+    found = set()
+    for hit in set(pat.findall(t)):
+        found.update(kw_sections.get(hit, ()))
+    return sorted(found, key=matcher["order"].__getitem__)
+
+
+# ✅ matcher متجمّع لكل جامعة (global + uni) مع TTL زي _GROUPS_CACHE
+GLOBAL_UNI_TAG = "__ALL__"  # ✅ سكشنات عامة لكل الجامعات
+_SECTIONS_CACHE = {"ts": 0.0, "raw": {}, "by_uni": {}}
+
+def _refresh_sections_cache(ttl_sec: float = 30.0):
+    now_ts = time.monotonic()
+    if not _SECTIONS_CACHE["ts"] or (now_ts - _SECTIONS_CACHE["ts"]) > ttl_sec:
+        raw = db_load_enabled_sections()
+        _SECTIONS_CACHE["ts"] = now_ts
+        if raw != _SECTIONS_CACHE["raw"]:
+            # الـ matchers بتتبني تاني بس لو السكشنات اتغيرت فعلًا
+            # ✅ matcher واحد متجمّع لكل uni_tag من أول reload (مش مع أول رسالة)
+            # بنبني في dict جديد ونبدّل مرة واحدة (ممكن نكون في thread الـ refresher)
+            by_uni = {}
+            for tag in raw:
+                if tag != GLOBAL_UNI_TAG:
+                    by_uni[tag] = _build_sections_matcher(_merge_sections(raw, tag))
+            _SECTIONS_CACHE["by_uni"] = by_uni
+            _SECTIONS_CACHE["raw"] = raw
+
+def _merge_sections(raw: Dict[str, List[Tuple[str, List[str]]]], uni_tag: str) -> List[Tuple[str, List[str]]]:
+    merged: List[Tuple[str, List[str]]] = []
     seen = set()
-    out = []
-    for s in matched:
-        if s not in seen:
-            seen.add(s)
-            out.append(s)
-    return out
+    for sec_name, kws in (raw.get(GLOBAL_UNI_TAG, []) + raw.get(uni_tag, [])):
+        key = (sec_name or "").strip()
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        merged.append((sec_name, kws))
+    return merged
+
+def get_sections_for_uni(uni_tag: str) -> List[Tuple[str, List[str]]]:
+    """global + uni sections (بدون تكرار section_name)."""
+    _refresh_sections_cache()
+    return _merge_sections(_SECTIONS_CACHE["raw"], (uni_tag or "").strip())
+
+
+def match_sections_for_uni(text: str, uni_tag: str, lowered: bool = False) -> List[str]:
+    """lowered=True لو الـ caller عامل ar_normalize(text.lower()) بالفعل (مرة واحدة لكل رسالة)."""
+    if not text:
+        return []
+    _refresh_sections_cache()
+    key = (uni_tag or "").strip()
+    matcher = _SECTIONS_CACHE["by_uni"].get(key)
+    if matcher is None:
+        matcher = _build_sections_matcher(get_sections_for_uni(key))
+        _SECTIONS_CACHE["by_uni"][key] = matcher
+    return _match_sections(matcher, text, lowered)
+
+
+# ---------- Exact keyword matching ----------
+KW_WORD_CLASS = "0-9A-Za-z\u0600-\u06FF"
+KW_REGEX_MAX_KEYWORDS = 150
+_KW_WORD_RE = re.compile(f"[{KW_WORD_CLASS}]+")
+
+def compile_scan_regex(pattern: str):
+    """re2 لو متاح والـ pattern يتفهم فيه (من غير lookarounds/backrefs)، وإلا re العادي."""
+    if re2 is not None:
+        try:
+            return re2.compile(pattern)
+        except Exception:
+            pass
+    return re.compile(pattern)
+
+def build_exact_keyword_regex(keywords) -> Optional["re.Pattern"]:
+    """
+    One compiled scan equivalent to: any(token in keywords for token in WORD_RE.findall(text)).
+    keyword لازم يبقى محاط بـ non-word أو بداية/نهاية النص (خصوصي. ✅ / الخصوصي ❌).
+    keywords فيها حروف برّه الـ class عمرها ما تساوي token فبنشيلها.
+    (من غير lookarounds عشان نفس الـ pattern ينفع مع engines تانية)
+    """
+    kws = sorted({k for k in keywords if k and _KW_WORD_RE.fullmatch(k)}, key=len, reverse=True)
+    if not kws:
+        return None
+    alts = "|".join(re.escape(k) for k in kws)
+    return compile_scan_regex(f"(?:^|[^{KW_WORD_CLASS}])(?:{alts})(?:[^{KW_WORD_CLASS}]|$)")
 
 
 # ---------- KW notifications helpers ----------
@@ -831,6 +1455,17 @@ def _normalize_target(t: Union[int, str]) -> Optional[Union[int, str]]:
             return s
     return s
 
+# ✅ حد Telegram للبوت ~30 رسالة/ثانية -> نسيب هامش
+KW_NOTIFY_CONCURRENCY = 25
+_KW_NOTIFY_SEM: Optional[asyncio.Semaphore] = None
+
+async def _send_kw_one(bot_client: Client, chat_id: Union[int, str], text: str):
+    global _KW_NOTIFY_SEM
+    if _KW_NOTIFY_SEM is None:
+        _KW_NOTIFY_SEM = asyncio.Semaphore(KW_NOTIFY_CONCURRENCY)
+    async with _KW_NOTIFY_SEM:
+        return await bot_client.send_message(chat_id, text, disable_web_page_preview=True)
+
 async def send_kw_notifications(
     bot_client: Optional[Client],
     targets: List[Union[int, str]],
@@ -841,71 +1476,174 @@ async def send_kw_notifications(
         return
 
     bad = set()
+    sends = []
     for raw in list(targets):
         chat_id = _normalize_target(raw)
         if chat_id is None:
             bad.add(raw)
             continue
-        try:
-            await bot_client.send_message(chat_id, text, disable_web_page_preview=True)
-        except PeerIdInvalid as e:
-            logger.warning(f"[KW-NOTIFY] PeerIdInvalid -> drop target for this run: {raw} ({e})")
+        sends.append((raw, chat_id))
+
+    # ✅ كل الـ targets بالتوازي بدل await واحد ورا التاني
+    results = await asyncio.gather(
+        *[_send_kw_one(bot_client, chat_id, text) for _, chat_id in sends],
+        return_exceptions=True,
+    )
+    for (raw, _), res in zip(sends, results):
+        if isinstance(res, PeerIdInvalid):
+            logger.warning(f"[KW-NOTIFY] PeerIdInvalid -> drop target for this run: {raw} ({res})")
             bad.add(raw)
-        except Exception as e:
-            logger.warning(f"[KW-NOTIFY] failed to send to {raw}: {e}")
+        elif isinstance(res, Exception):
+            logger.warning(f"[KW-NOTIFY] failed to send to {raw}: {res}")
 
     if bad:
         targets[:] = [t for t in targets if t not in bad]
         logger.info(f"[KW-NOTIFY] remaining targets after drop: {targets}")
 
 
+# ✅ on_message مابيستناش الإشعارات: كل إشعار task في الخلفية (الـ sem فوق بيحدد التوازي)،
+# ولو اتراكموا أكتر من KW_NOTIFY_MAX_PENDING بنلغي الأقدم
+KW_NOTIFY_MAX_PENDING = 200
+_KW_NOTIFY_TASKS: Dict[asyncio.Task, None] = {}  # insertion order = الأقدم الأول
+
+def notify_kw_in_background(
+    bot_client: Optional[Client],
+    targets: List[Union[int, str]],
+    text: str,
+    logger: logging.Logger
+):
+    if not bot_client or not targets:
+        return
+    while len(_KW_NOTIFY_TASKS) >= KW_NOTIFY_MAX_PENDING:
+        oldest = next(iter(_KW_NOTIFY_TASKS))
+        _KW_NOTIFY_TASKS.pop(oldest, None)
+        oldest.cancel()
+        logger.warning("[KW-NOTIFY] backlog full -> dropped oldest notification")
+    task = asyncio.create_task(send_kw_notifications(bot_client, targets, text, logger))
+    _KW_NOTIFY_TASKS[task] = None
+    task.add_done_callback(lambda t: _KW_NOTIFY_TASKS.pop(t, None))
+
+async def drain_kw_notifications(timeout: float = 10.0):
+    pending = list(_KW_NOTIFY_TASKS)
+    if pending:
+        await asyncio.wait(pending, timeout=timeout)
+
+
+# -----------------------
+# CSV logs: handle مفتوح طول عمر البروسيس + flush كل K صف أو كل كام ثانية
+# -----------------------
+CSV_FLUSH_ROWS = 50
+CSV_FLUSH_SEC = 2.0
+
+class _CsvAppender:
+    def __init__(self, path: str, header: List[str]):
+        self.path = path
+        self.header = header
+        self.fp = None
+        self.writer = None
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # ✅ open("a") بيحط الـ position في آخر الملف -> tell()==0 يعني ملف جديد/فاضي (من غير stat زيادة)
+        self.fp = open(self.path, "a", newline="", encoding="utf-8", buffering=1 << 16)
+        self.writer = csv.writer(self.fp)
+        if self.fp.tell() == 0:
+            self.writer.writerow(self.header)
+
+    def write(self, row):
+        if self.fp is None:
+            self._open()
+        self.writer.writerow(row)
+        self.pending += 1
+        if self.pending >= CSV_FLUSH_ROWS or (time.monotonic() - self.last_flush) >= CSV_FLUSH_SEC:
+            self.flush()
+
+    def flush(self):
+        if self.fp is not None and self.pending:
+            self.fp.flush()
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        if self.fp is not None:
+            self.flush()
+            self.fp.close()
+            self.fp = None
+            self.writer = None
+
+_CSV_APPENDERS: Dict[str, _CsvAppender] = {}
+
+def _csv_appender(path: str, header: List[str]) -> _CsvAppender:
+    a = _CSV_APPENDERS.get(path)
+    if a is None:
+        a = _CSV_APPENDERS[path] = _CsvAppender(path, header)
+    return a
+
+def flush_csv_logs():
+    for a in list(_CSV_APPENDERS.values()):
+        try:
+            a.flush()
+        except Exception:
+            pass
+
+def close_csv_logs():
+    for a in list(_CSV_APPENDERS.values()):
+        try:
+            a.close()
+        except Exception:
+            pass
+
+atexit.register(close_csv_logs)
+
+
 # -----------------------
 # Sent history (no-duplicate within cfg.cooldown_days)
 # -----------------------
 HISTORY_PATH = "logs/sent_history.csv"
 
-def load_sent_history(path: str = HISTORY_PATH) -> Dict[Tuple[str, str], datetime]:
-    hist: Dict[Tuple[str, str], datetime] = {}
+# ✅ المفتاح int (blake2b 64-bit) والقيمة unix ts int بدل (str,str) -> datetime
+def _hist_key(username: str, message_key: str) -> int:
+    h = hashlib.blake2b(f"{username}\x00{message_key}".encode("utf-8"), digest_size=8)
+    return int.from_bytes(h.digest(), "little")
+
+def load_sent_history(path: str = HISTORY_PATH) -> Dict[int, int]:
+    hist: Dict[int, int] = {}
     if not os.path.exists(path):
         return hist
-    with open(path, "r", encoding="utf-8") as f:
+    with open(path, "r", encoding="utf-8", newline="") as f:
         reader = csv.reader(f)
         _ = next(reader, None)
         for row in reader:
             try:
-                ts = datetime.fromisoformat(row[0])
-                uname = row[1]
-                mkey = row[2]
-                hist[(uname, mkey)] = ts
+                ts = int(datetime.fromisoformat(row[0]).timestamp())
+                hist[_hist_key(row[1], row[2])] = ts
             except Exception:
                 continue
     return hist
 
-def append_sent_history(username: str, message_key: str, path: str = HISTORY_PATH):
-    head = not os.path.exists(path)
-    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
-    with open(path, "a", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-        if head:
-            w.writerow(["timestamp", "username", "message_key"])
-        w.writerow([utc_now().isoformat(), username, message_key])
-
-def within_history_window(hist: Dict[Tuple[str, str], datetime], username: str, message_key: str, days: int) -> bool:
-    dt = hist.get((username, message_key))
-    if not dt:
+def append_sent_history(username: str, message_key: str, path: str = HISTORY_PATH,
+                        hist: Optional[Dict[int, int]] = None):
+    now = utc_now()
+    _csv_appender(path, ["timestamp", "username", "message_key"]).write(
+        [now.isoformat(), username, message_key]
+    )
+    if hist is not None:
+        hist[_hist_key(username, message_key)] = int(now.timestamp())
+
+def within_history_window(hist: Dict[int, int], username: str, message_key: str, days: int) -> bool:
+    ts = hist.get(_hist_key(username, message_key))
+    if not ts:
         return False
-    return (utc_now() - dt) < timedelta(days=days)
+    return (time.time() - ts) < days * 86400
 
 
 # -----------------------
 # OpenAI: extract university subjects (optional)
 # -----------------------
-def extract_university_subjects_with_ai(text: str, logger: logging.Logger) -> List[str]:
-    if not text or not text.strip():
-        return []
-    if openai_client is None:
-        return []
-
+def _extract_university_subjects_sync(text: str, logger: logging.Logger) -> Optional[List[str]]:
+    """Blocking OpenAI call. None = failed (ما بنكاشش الفشل)."""
     try:
         user_prompt = (
             "أنت مساعد ذكي في جامعة.\n"
@@ -931,29 +1669,299 @@ def extract_university_subjects_with_ai(text: str, logger: logging.Logger) -> Li
         )
 
         content = (resp.choices[0].message.content or "").strip()
-
-        try:
-            data = json.loads(content)
-        except json.JSONDecodeError:
-            match = re.search(r"\{.*\}", content, re.DOTALL)
-            if not match:
-                logger.warning("AI response is not valid JSON: %s", content[:200])
-                return []
-            data = json.loads(match.group(0))
-
-        subjects = data.get("subjects", [])
-        subjects = [s.strip() for s in subjects if isinstance(s, str) and s.strip()]
-        return subjects
+        data = _parse_ai_json(content, logger)
+        if data is None:
+            return None
+        return _clean_subjects(data.get("subjects", []))
 
     except Exception as e:
         logger.exception("Error while calling OpenAI for university subject extraction: %s", e)
+        return None
+
+
+def _parse_ai_json(content: str, logger: logging.Logger) -> Optional[dict]:
+    try:
+        data = json.loads(content)
+    except json.JSONDecodeError:
+        match = re.search(r"\{.*\}", content, re.DOTALL)
+        if not match:
+            logger.warning("AI response is not valid JSON: %s", content[:200])
+            return None
+        data = json.loads(match.group(0))
+    return data if isinstance(data, dict) else None
+
+def _clean_subjects(subjects) -> List[str]:
+    if not isinstance(subjects, list):
+        return []
+    return [t for s in subjects if isinstance(s, str) and (t := s.strip())]
+
+
+def _extract_university_subjects_batch_sync(texts: List[str], logger: logging.Logger) -> List[Optional[List[str]]]:
+    """
+    One OpenAI request for several messages. Returns one entry per text
+    (None = no valid answer for that text).
+    """
+    if len(texts) == 1:
+        return [_extract_university_subjects_sync(texts[0], logger)]
+    try:
+        numbered = "\n\n".join(f"[{i}]\n\"\"\"\n{t}\n\"\"\"" for i, t in enumerate(texts))
+        user_prompt = (
+            "أنت مساعد ذكي في جامعة.\n"
+            "سأعطيك عدة رسائل دردشة مرقّمة من طلاب. "
+            "كل رسالة قد تحتوي على أسماء مواد دراسية في الجامعة (أي كلية) بالعربي أو بالإنجليزي.\n\n"
+            "المطلوب لكل رسالة لوحدها:\n"
+            "1) استخرج أسماء المواد الجامعية فقط.\n"
+            "2) تجاهل كلمات مثل: امتحان، دكتور، محاضرة، سكشن.\n"
+            "3) ارجع JSON فقط بهذا الشكل (عنصر لكل رسالة بنفس الرقم):\n"
+            '{ "results": [ { "i": 0, "subjects": ["اسم مادة"] }, { "i": 1, "subjects": [] } ] }\n\n'
+            f"الرسائل:\n{numbered}\n"
+        )
+        resp = openai_client.chat.completions.create(
+            model="gpt-4.1-mini",
+            messages=[
+                {"role": "system", "content": "You extract university course names from each numbered text and return ONLY valid JSON."},
+                {"role": "user", "content": user_prompt},
+            ],
+            temperature=0.0,
+        )
+        content = (resp.choices[0].message.content or "").strip()
+        data = _parse_ai_json(content, logger)
+        out: List[Optional[List[str]]] = [None] * len(texts)
+        for item in (data or {}).get("results", []) or []:
+            if not isinstance(item, dict):
+                continue
+            try:
+                i = int(item.get("i"))
+            except (TypeError, ValueError):
+                continue
+            if 0 <= i < len(texts):
+                out[i] = _clean_subjects(item.get("subjects", []))
+        return out
+    except Exception as e:
+        logger.exception("Error while calling OpenAI for batched subject extraction: %s", e)
+        return [None] * len(texts)
+
+
+# ✅ Arabic normalization: تشكيل/تطويل بيتشالوا، أ/إ/آ/ٱ -> ا ، ى -> ي ، ة -> ه
+def _ai_cache_text(text: str) -> str:
+    """Normalized form used for the cache key (forwards/reposts بتختلف في المسافات والتشكيل)."""
+    return " ".join(ar_normalize(text).lower().split())
+
+
+# ✅ كاش للنتايج: LRU+TTL في الذاكرة + جدول ai_subjects_cache (بيعيش بعد الـ restart، بنفس الـ TTL)
+AI_CACHE_MAX = 10_000
+AI_CACHE_TTL_SEC = 6 * 3600
+_AI_CACHE: "OrderedDict[str, Tuple[float, List[str]]]" = OrderedDict()
+
+def _ai_text_hash(text: str) -> str:
+    return hashlib.blake2b(_ai_cache_text(text).encode("utf-8", errors="ignore"), digest_size=16).hexdigest()
+
+def _ai_cache_get(key: str) -> Optional[List[str]]:
+    hit = _AI_CACHE.get(key)
+    if hit is None:
+        return None
+    if (time.time() - hit[0]) > AI_CACHE_TTL_SEC:
+        del _AI_CACHE[key]
+        return None
+    _AI_CACHE.move_to_end(key)
+    return hit[1]
+
+def _ai_cache_put(key: str, subjects: List[str], ts: Optional[float] = None):
+    _AI_CACHE[key] = (time.time() if ts is None else ts, subjects)
+    _AI_CACHE.move_to_end(key)
+    while len(_AI_CACHE) > AI_CACHE_MAX:
+        _AI_CACHE.popitem(last=False)
+
+def db_ai_cache_get(text_hash: str) -> Optional[Tuple[float, List[str]]]:
+    with _db_cur() as cur:
+        cur.execute("SELECT subjects_json, ts FROM ai_subjects_cache WHERE text_hash=?", (text_hash,))
+        row = cur.fetchone()
+    if not row:
+        return None
+    try:
+        ts = datetime.fromisoformat(row[1]).timestamp()
+    except Exception:
+        return None
+    if (time.time() - ts) > AI_CACHE_TTL_SEC:
+        return None
+    try:
+        data = json.loads(row[0] or "[]")
+    except Exception:
+        return None
+    if not isinstance(data, list):
+        return None
+    return ts, [s for s in data if isinstance(s, str)]
+
+def db_ai_cache_put(text_hash: str, subjects: List[str]):
+    with _db_cur() as cur:
+        cur.execute(
+            "INSERT OR REPLACE INTO ai_subjects_cache(text_hash, subjects_json, ts) VALUES(?,?,?)",
+            (text_hash, dumps_json(subjects), utc_now().isoformat()),
+        )
+
+# ✅ pre-filter: رسائل قصيرة جدًا أو من غير أي حروف (emoji/أرقام/روابط بس) ما بتروحش للـ AI
+AI_MIN_TEXT_LEN = 20
+_AI_LETTER_RE = re.compile(r"[A-Za-z\u0600-\u06FF]{2,}")
+
+def ai_prefilter(text: str) -> bool:
+    t = (text or "").strip()
+    return len(t) >= AI_MIN_TEXT_LEN and _AI_LETTER_RE.search(t) is not None
+
+
+# -----------------------
+# AI batcher: الرسائل بتتجمع (لحد AI_BATCH_MAX أو AI_BATCH_WAIT_SEC) في request واحد
+# -----------------------
+AI_BATCH_MAX = 16
+AI_BATCH_WAIT_SEC = 0.2
+AI_BATCH_CONCURRENCY = 4
+AI_QUEUE_MAX = 1000
+
+_AI_QUEUE: Optional[asyncio.Queue] = None
+_AI_INFLIGHT: Dict[str, asyncio.Future] = {}
+_AI_BATCH_TASKS: set = set()  # reference للـ batches اللي شغالة (عشان الـ GC وعشان stop يستناها)
+
+def _resolve_pending(batch: List[Tuple[str, asyncio.Future]]):
+    # أي future لسه مفتوحة -> None (on_message اللي مستنيها يكمل من غير AI بدل ما يعلق)
+    for _, fut in batch:
+        if not fut.done():
+            fut.set_result(None)
+
+async def _run_ai_batch(batch: List[Tuple[str, asyncio.Future]], sem: asyncio.Semaphore, logger: logging.Logger):
+    try:
+        async with sem:
+            try:
+                results = await asyncio.to_thread(
+                    _extract_university_subjects_batch_sync, [t for t, _ in batch], logger
+                )
+            except Exception as e:
+                logger.exception(f"[AI-BATCH] failed: {e}")
+                results = [None] * len(batch)
+        for (_, fut), res in zip(batch, results):
+            if not fut.done():
+                fut.set_result(res)
+    finally:
+        _resolve_pending(batch)
+
+async def _ai_batch_loop(q: asyncio.Queue, logger: logging.Logger):
+    sem = asyncio.Semaphore(AI_BATCH_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+    batch: List[Tuple[str, asyncio.Future]] = []
+    try:
+        while True:
+            batch = [await q.get()]
+            deadline = loop.time() + AI_BATCH_WAIT_SEC
+            while len(batch) < AI_BATCH_MAX:
+                try:
+                    batch.append(q.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                # مش wait_for: لو الـ get خلص مع الـ timeout في نفس اللحظة كان العنصر بيضيع
+                getter = asyncio.ensure_future(q.get())
+                await asyncio.wait({getter}, timeout=remaining)
+                if getter.cancel():
+                    break  # اتلغى قبل ما ياخد حاجة -> العنصر لسه في الطابور
+                batch.append(getter.result())
+            task = asyncio.create_task(_run_ai_batch(batch, sem, logger))
+            batch = []
+            _AI_BATCH_TASKS.add(task)
+            task.add_done_callback(_AI_BATCH_TASKS.discard)
+    finally:
+        _resolve_pending(batch)
+
+def start_ai_batcher(logger: logging.Logger) -> Optional[asyncio.Task]:
+    global _AI_QUEUE
+    if openai_client is None:
+        return None
+    _AI_QUEUE = asyncio.Queue(maxsize=AI_QUEUE_MAX)
+    return asyncio.create_task(_ai_batch_loop(_AI_QUEUE, logger))
+
+async def stop_ai_batcher(task: Optional[asyncio.Task]):
+    global _AI_QUEUE
+    q = _AI_QUEUE
+    _AI_QUEUE = None
+    if task:
+        task.cancel()
+        try:
+            await task
+        except (asyncio.CancelledError, Exception):
+            pass
+    # الـ batches اللي اتبعتت بتكمل (وبتحل الـ futures بتاعتها) قبل ما نقفل
+    if _AI_BATCH_TASKS:
+        await asyncio.gather(*list(_AI_BATCH_TASKS), return_exceptions=True)
+    # أي حد لسه مستني في الطابور -> نتيجة فاضية بدل ما يفضل معلق
+    while q is not None and not q.empty():
+        _, fut = q.get_nowait()
+        if not fut.done():
+            fut.set_result(None)
+
+async def _ai_extract_uncached(text: str, logger: logging.Logger) -> Optional[List[str]]:
+    if _AI_QUEUE is None:
+        return await asyncio.to_thread(_extract_university_subjects_sync, text, logger)
+    fut = asyncio.get_running_loop().create_future()
+    try:
+        _AI_QUEUE.put_nowait((text, fut))
+    except asyncio.QueueFull:
+        return await asyncio.to_thread(_extract_university_subjects_sync, text, logger)
+    return await fut
+
+
+async def extract_university_subjects_with_ai(text: str, logger: logging.Logger) -> List[str]:
+    if not text or not text.strip():
+        return []
+    if openai_client is None:
+        return []
+    if not ai_prefilter(text):
+        return []
+
+    key = _ai_text_hash(text)
+    hit = _ai_cache_get(key)
+    if hit is not None:
+        return list(hit)
+
+    try:
+        row = await asyncio.to_thread(db_ai_cache_get, key)
+    except Exception:
+        row = None
+    if row is not None:
+        _ai_cache_put(key, row[1], ts=row[0])
+        return list(row[1])
+
+    # ✅ نفس النص في الطريق بالفعل (forward/spam) -> نستنى نفس النتيجة
+    pending = _AI_INFLIGHT.get(key)
+    if pending is not None:
+        res = await asyncio.shield(pending)
+        return list(res) if res else []
+
+    pending = asyncio.get_running_loop().create_future()
+    _AI_INFLIGHT[key] = pending
+    subjects: Optional[List[str]] = None
+    try:
+        subjects = await _ai_extract_uncached(text, logger)
+    finally:
+        _AI_INFLIGHT.pop(key, None)
+        if not pending.done():
+            pending.set_result(subjects)
+    if subjects is None:
         return []
+    _ai_cache_put(key, subjects)
+    try:
+        await asyncio.to_thread(db_ai_cache_put, key, subjects)
+    except Exception as e:
+        logger.warning(f"[AI-CACHE] failed to persist: {e}")
+    return list(subjects)
 
 
 # -----------------------
 # LISTEN MODE (NO SENDING TO USERS)
 # -----------------------
 async def run_listener(cfg: AppConfig, logger: logging.Logger):
+    # ✅ listener واحد بس في نفس الوقت (اتنين كانوا هيكرروا نفس الرسايل ويكتبوا على نفس الملفات)
+    if not acquire_process_lock("outputs/.listener.lock", logger):
+        return
     kw_conf = cfg.keyword_filter or {}
     kw_enabled = bool(kw_conf.get("enabled", False))
     kw_ci = bool(kw_conf.get("case_insensitive", True))
@@ -978,33 +1986,6 @@ async def run_listener(cfg: AppConfig, logger: logging.Logger):
     uni_out_file = "outputs/uni_subjects.jsonl"
     os.makedirs(os.path.dirname(uni_out_file) or ".", exist_ok=True)
 
-    sections_cache: Dict[str, List[Tuple[str, List[str]]]] = {}
-    sections_cache_ts: float = 0.0
-    sections_cache_ttl: float = 30.0
-
-    GLOBAL_UNI_TAG = "__ALL__"  # ✅ سكشنات عامة لكل الجامعات
-
-    def get_sections_for_uni(uni_tag: str) -> List[Tuple[str, List[str]]]:
-        nonlocal sections_cache, sections_cache_ts
-        now_ts = utc_now().timestamp()
-        if (now_ts - sections_cache_ts) > sections_cache_ttl or not sections_cache:
-            sections_cache = db_load_enabled_sections()
-            sections_cache_ts = now_ts
-
-        uni_tag = (uni_tag or "").strip()
-        uni_secs = sections_cache.get(uni_tag, [])
-        global_secs = sections_cache.get(GLOBAL_UNI_TAG, [])
-        # global + uni (بدون تكرار section_name)
-        merged: List[Tuple[str, List[str]]] = []
-        seen = set()
-        for sec_name, kws in (global_secs + uni_secs):
-            key = (sec_name or "").strip()
-            if not key or key in seen:
-                continue
-            seen.add(key)
-            merged.append((sec_name, kws))
-        return merged
-
     sections_base_dir = "outputs/sections"
     os.makedirs(sections_base_dir, exist_ok=True)
 
@@ -1028,12 +2009,10 @@ async def run_listener(cfg: AppConfig, logger: logging.Logger):
         for aid in (vb.get("admin_ids") or []):
             notify_targets.append(aid)
 
-    cleaned: List[Union[int, str]] = []
-    for t in notify_targets:
-        nt = _normalize_target(t)
-        if nt is not None and nt not in cleaned:
-            cleaned.append(nt)
-    notify_targets = cleaned
+    # ✅ dedupe مع الحفاظ على الترتيب في O(n)
+    notify_targets = list(dict.fromkeys(
+        nt for t in notify_targets if (nt := _normalize_target(t)) is not None
+    ))
 
     if vb_token and notify_targets:
         try:
@@ -1054,29 +2033,31 @@ async def run_listener(cfg: AppConfig, logger: logging.Logger):
             notify_bot = None
 
     # ✅ Exact word match with punctuation-safe tokenization
-    WORD_RE = re.compile(r"[0-9A-Za-z\u0600-\u06FF]+", re.UNICODE)
-
-    def _tokenize_words(text: str) -> List[str]:
-        if not text:
-            return []
-        t = text.lower() if kw_ci else text
-        return WORD_RE.findall(t)
+    WORD_RE = compile_scan_regex(f"[{KW_WORD_CLASS}]+")
 
-    KW_SET = set([k.lower() if kw_ci else k for k in kw_list])
+    KW_SET = frozenset(ar_normalize(k.lower() if kw_ci else k) for k in kw_list)
+    KW_MIN = min(map(len, KW_SET), default=0)
+    KW_MAX = max(map(len, KW_SET), default=0)
+    # regex union أسرع مع قوايم صغيرة؛ مع قوايم كبيرة الـ token scan (مستقل عن عدد الكلمات) أسرع
+    KW_RE = build_exact_keyword_regex(KW_SET) if len(KW_SET) <= KW_REGEX_MAX_KEYWORDS else None
 
     def contains_keyword(text: str) -> bool:
-        if not text:
+        if not text or not KW_SET:
             return False
-        words = _tokenize_words(text)
-        return any(w in KW_SET for w in words)
+        if KW_RE is not None:
+            return KW_RE.search(text) is not None
+        for m in WORD_RE.finditer(text):
+            w = m.group()
+            if KW_MIN <= len(w) <= KW_MAX and w in KW_SET:
+                return True
+        return False
 
     def get_group_conf_for(chat) -> Optional[GroupConfig]:
-        _, by_user, by_id = get_groups_cached(30.0)
-        if getattr(chat, "username", None):
-            return by_user.get(str(chat.username).strip().lower())
-        if getattr(chat, "id", None):
-            return by_id.get(str(chat.id))
-        return None
+        _, by_user, _, by_int_id = get_groups_cached(30.0)
+        g = by_int_id.get(getattr(chat, "id", None))
+        if g is None and getattr(chat, "username", None):
+            g = by_user.get(chat.username.lower())
+        return g
 
     def uni_tag_for_group(gconf: Optional[GroupConfig]) -> Optional[str]:
         if not gconf:
@@ -1094,7 +2075,7 @@ async def run_listener(cfg: AppConfig, logger: logging.Logger):
             user = msg.from_user
             if not user:
                 return
-            if db_is_blocked(user.id):
+            if db_is_blocked(user.id):  # ✅ الـ set بيتعمله reload من listener_cache_refresher (الـ TTL fallback بس)
                 return
 
             gconf = get_group_conf_for(chat)
@@ -1104,26 +2085,30 @@ async def run_listener(cfg: AppConfig, logger: logging.Logger):
             has_username = bool(raw_username)
 
             mtext = msg.text or msg.caption or ""
+            # ✅ lower() مرة واحدة لكل رسالة، وبس لو فيه matcher محتاجه (sections / kw)
+            mtext_lower = mtext.lower() if (utag or (kw_enabled and kw_ci)) else mtext
+            # ✅ نفس توحيد الحروف اللي اتعمل للـ keywords/السكشنات وقت التحميل
+            mtext_norm = ar_normalize(mtext_lower) if (utag or kw_enabled) else mtext_lower
             chat_username = getattr(chat, "username", None)
 
-            manual_sections: List[str] = []
-            if utag:
-                sec_defs = get_sections_for_uni(utag)
-                manual_sections = match_manual_sections(mtext, sec_defs, case_insensitive=True)
+            hit_kw = kw_enabled and contains_keyword(mtext_norm if kw_ci else ar_normalize(mtext))
 
-            uni_subjects_ai = extract_university_subjects_with_ai(mtext, logger)
+            # listen_scope=configured: اسمع بس للجروبات اللي موجودة في DB/config
+            # ✅ قبل الـ AI call: من غير gconf مفيش سكشنات، فمانصرفش OpenAI على رسالة هنرميها
+            if (not hit_kw) and cfg.listen_scope == "configured" and not gconf:
+                return
 
-            subjects_all: List[str] = []
-            for s in (uni_subjects_ai or []) + (manual_sections or []):
-                if isinstance(s, str) and s.strip() and s.strip() not in subjects_all:
-                    subjects_all.append(s.strip())
-            uni_json = json.dumps(subjects_all, ensure_ascii=False) if subjects_all else None
+            manual_sections: List[str] = []
+            if utag:
+                manual_sections = match_sections_for_uni(mtext_norm, utag, lowered=True)
 
-            hit_kw = kw_enabled and contains_keyword(mtext)
+            uni_subjects_ai = await extract_university_subjects_with_ai(mtext, logger)
 
-            # listen_scope=configured: اسمع بس للجروبات اللي موجودة في DB/config
-            if (not hit_kw) and (not subjects_all) and cfg.listen_scope == "configured" and not gconf:
-                return
+            # ✅ dedupe مرتب في O(n) (strip مرة واحدة لكل عنصر)
+            subjects_all: List[str] = list(dict.fromkeys(
+                _clean_subjects(uni_subjects_ai) + _clean_subjects(manual_sections)
+            ))
+            uni_json = dumps_json(subjects_all) if subjects_all else None
 
             msg_link = None
             if not has_username:
@@ -1160,13 +2145,13 @@ async def run_listener(cfg: AppConfig, logger: logging.Logger):
             if auto_enabled:
                 if has_username:
                     to_write = f"@{raw_username}" if not raw_username.startswith("@") else raw_username
-                    if append_unique_line(auto_out_file, to_write):
-                        logger.info(f"[AUTO] + {to_write} -> {auto_out_file}")
+                    if await append_unique_line_async(auto_out_file, to_write):
+                        logger.info(f"[AUTO] queued {to_write} -> {auto_out_file}")
                 else:
                     if not cfg.exclude_no_username:
                         to_write = msg_link or str(user.id)
-                        if to_write and append_unique_line(auto_out_file, to_write):
-                            logger.info(f"[AUTO] + {to_write} -> {auto_out_file}")
+                        if to_write and await append_unique_line_async(auto_out_file, to_write):
+                            logger.info(f"[AUTO] queued {to_write} -> {auto_out_file}")
 
             if subjects_all:
                 record = {
@@ -1178,7 +2163,7 @@ async def run_listener(cfg: AppConfig, logger: logging.Logger):
                     "text": mtext,
                     "date": utc_now().isoformat()
                 }
-                append_line(uni_out_file, json.dumps(record, ensure_ascii=False))
+                await append_line_async(uni_out_file, dumps_json(record))
                 logger.info(f"[UNI-SUBJECT] {display_id} -> {uni_out_file} | subjects={subjects_all}")
 
             if hit_kw and kw_enabled:
@@ -1187,8 +2172,8 @@ async def run_listener(cfg: AppConfig, logger: logging.Logger):
                         f"@{raw_username}" if has_username and not raw_username.startswith("@")
                         else (raw_username if has_username else (msg_link or str(user.id)))
                     )
-                    if to_write and append_unique_line(kw_out_file, to_write):
-                        logger.info(f"[LISTEN/KEYWORD] + {to_write} -> {kw_out_file}")
+                    if to_write and await append_unique_line_async(kw_out_file, to_write):
+                        logger.info(f"[LISTEN/KEYWORD] queued {to_write} -> {kw_out_file}")
 
             # ملفات القروبات (للسندر): ما زالت per-group out_file
             if gconf and (not gconf.subjects_only or hit_kw or subjects_all):
@@ -1197,19 +2182,18 @@ async def run_listener(cfg: AppConfig, logger: logging.Logger):
                         f"@{raw_username}" if has_username and not raw_username.startswith("@")
                         else (raw_username if has_username else (msg_link or str(user.id)))
                     )
-                    if to_write and append_unique_line(gconf.out_file, to_write):
-                        logger.info(f"[LISTEN] + {to_write} -> {gconf.out_file} (group={gconf.name})")
+                    if to_write and await append_unique_line_async(gconf.out_file, to_write):
+                        logger.info(f"[LISTEN] queued {to_write} -> {gconf.out_file} (group={gconf.name})")
 
             # ملفات السكشنات: نجمعها تحت outputs/sections/<uni_tag>/...
             if utag and manual_sections and has_username:
                 handle = f"@{raw_username}" if not raw_username.startswith("@") else raw_username
                 uni_dir = os.path.join(sections_base_dir, utag)
-                os.makedirs(uni_dir, exist_ok=True)
                 for sec in manual_sections:
                     slug = slugify_section_name(sec)
                     sec_path = os.path.join(uni_dir, f"{slug}.txt")
-                    if append_unique_line(sec_path, handle):
-                        logger.info(f"[SECTION] + {handle} -> {sec_path} ({sec})")
+                    if await append_unique_line_async(sec_path, handle):
+                        logger.info(f"[SECTION] queued {handle} -> {sec_path} ({sec})")
 
             if hit_kw and notify_bot and notify_targets:
                 snippet = (mtext or "")
@@ -1225,17 +2209,35 @@ async def run_listener(cfg: AppConfig, logger: logging.Logger):
                     f"🔗 <b>الرابط:</b> {link_for_display or '—'}\n"
                     f"\n<code>{snippet}</code>"
                 )
-                await send_kw_notifications(notify_bot, notify_targets, text_notify, logger)
+                notify_kw_in_background(notify_bot, notify_targets, text_notify, logger)
 
         except Exception as e:
             logger.exception(f"[LISTEN] error: {e}")
 
+    db_writer_task = start_db_writer(logger)
+    ai_batcher_task = start_ai_batcher(logger)
+    lines_flusher_task = asyncio.create_task(pending_lines_flusher(logger))
+    await asyncio.to_thread(_reload_listener_caches)
+    cache_refresh_task = asyncio.create_task(listener_cache_refresher(logger))
     await app.start()
     try:
+        try:
+            await resolve_group_chat_ids(app, logger)
+        except Exception as e:
+            logger.warning(f"[GROUPS] chat id resolve failed: {e}")
         await asyncio.Future()
     finally:
         await app.stop()
+        cache_refresh_task.cancel()
+        await stop_ai_batcher(ai_batcher_task)
+        await stop_db_writer(db_writer_task)
+        lines_flusher_task.cancel()
+        try:
+            await flush_all_pending_lines()
+        except Exception as e:
+            logger.warning(f"[FILES] final flush failed: {e}")
         if notify_bot:
+            await drain_kw_notifications()
             try:
                 await notify_bot.stop()
             except Exception:
@@ -1246,13 +2248,7 @@ async def run_listener(cfg: AppConfig, logger: logging.Logger):
 # SEND MODE
 # -----------------------
 def append_send_log(path: str, row: Tuple):
-    head = not os.path.exists(path)
-    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
-    with open(path, "a", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-        if head:
-            w.writerow(["timestamp", "username", "group", "sender_session", "result", "error"])
-        w.writerow(row)
+    _csv_appender(path, ["timestamp", "username", "group", "sender_session", "result", "error"]).write(row)
 
 async def send_one_message(
     cfg,
@@ -1281,13 +2277,18 @@ async def send_one_message(
         return False
 
     try:
+        # 🪣 token عام + token للحساب (بدل sleep ثابت بعد كل إرسال)
+        await get_global_bucket().acquire()
+        await get_account_bucket(cfg, session_path).acquire()
+
         # ⏱ Delay عشوائي قبل الإرسال
         await asyncio.sleep(random.uniform(2.5, 6.0))
 
         await client.send_message(username, text)
 
         send_counter[session_path] = count + 1
-        sent_hist[username.lower()] = now_ts
+        # ⏱ نفس الـ jitter القديم (3.5–8.5s) بعد كل إرسال، بس على bucket الحساب ده بس
+        get_account_bucket(cfg, session_path).pause(random.uniform(3.5, 8.5))
         return True
 
     except PeerFlood:
@@ -1304,8 +2305,9 @@ async def send_one_message(
         return False
 
     except FloodWait as e:
-        wait_s = int(getattr(e, "seconds", 60))
+        wait_s = int(getattr(e, "value", None) or getattr(e, "seconds", 60) or 60)
         disabled_until[session_path] = now_ts + wait_s + 2
+        get_account_bucket(cfg, session_path).pause(wait_s + 2)
         logger.warning(f"[SEND] FLOOD_WAIT {wait_s}s -> disable {session_path}")
         return False
 
@@ -1315,6 +2317,69 @@ async def send_one_message(
         return False
 
 
+# ✅ كل session ليها worker وطابور خاص بيها؛ الـ flows بتوزّع الشغل بالـ picker
+# من غير lock مشترك، فالحسابات بتبعت بالتوازي وكل واحد cooldown بتاعه محلي
+SENDER_QUEUE_MAX = 128
+
+async def _sender_worker(
+    *,
+    cfg: AppConfig,
+    logger: logging.Logger,
+    session_path: str,
+    client: Client,
+    queue: asyncio.Queue,
+    perma_blocked: set,
+    disabled_until: Dict[str, float],
+    sent_hist: Dict,
+):
+    send_counter: Dict[str, int] = {}
+    while True:
+        file_path, username, uname, flow_name, message_key, text, fut = await queue.get()
+        try:
+            now_ts = time.time()
+            if session_path in perma_blocked or now_ts < disabled_until.get(session_path, 0.0):
+                # اتقفل وهو مستني في الطابور -> يرجع آخر الملف ويتوزع تاني
+                ok = False
+            else:
+                ok = await send_one_message(
+                    cfg=cfg,
+                    logger=logger,
+                    client=client,
+                    session_path=session_path,
+                    username=uname,
+                    text=text,
+                    perma_blocked=perma_blocked,
+                    disabled_until=disabled_until,
+                    sent_hist=sent_hist,
+                    send_counter=send_counter,
+                    attachments=None,
+                )
+
+            if ok:
+                append_send_log(
+                    "logs/send_log.csv",
+                    (utc_iso(), uname, flow_name, session_path, "OK", ""),
+                )
+                queue_remove_line(file_path, username)
+                append_sent_history(uname, message_key, hist=sent_hist)
+                logger.info(f"[SEND] OK {uname} via {session_path}")
+                # 🔢 خلّص مرتينه -> cooldown ودور جديد هنا، قبل ما send_one_message يرفض الجوب الجاية
+                if send_counter.get(session_path, 0) >= 2:
+                    send_counter[session_path] = 0
+                    disabled_until[session_path] = time.time() + random.uniform(20, 40)
+                    logger.info(f"[SEND] session {session_path} done 2 sends → cooldown")
+            else:
+                queue_move_line_to_end(file_path, username)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"[SEND] worker {session_path} error @{uname}: {e}")
+        finally:
+            if not fut.done():
+                fut.set_result(None)
+            queue.task_done()
+
+
 async def _process_file_sends(
     *,
     cfg: AppConfig,
@@ -1327,8 +2392,8 @@ async def _process_file_sends(
     flow_name: str,
     template_path: Optional[str],
     attachments_enabled: bool,
-    last_idx_ref: Dict[str, int],
-    state_lock: asyncio.Lock,
+    send_queues: Dict[str, asyncio.Queue],
+    picker: SenderPicker,
     template_text_override: Optional[str] = None,
 ):
     logger.info(f"[SEND] processing {file_path} (flow={flow_name})")
@@ -1340,60 +2405,54 @@ async def _process_file_sends(
     )
 
     message_key = message_key_for(flow_name, template_path)
+    loop = asyncio.get_running_loop()
 
-    # ✅ NEW: عداد الإرسال لكل session
-    send_counter: Dict[str, int] = {}   # <——— الحل هنا
+    # 🔁 تغيير النص + random variation — بتتبني مرة واحدة للـ flow مش مع كل username
+    variations = [
+        template_text,
+        template_text.replace("السلام عليكم", "أهلاً"),
+        template_text.replace("لو تحب", "لو حابب"),
+        template_text + " 😊",
+        template_text.replace("شرح", "مساعدة"),
+    ]
 
     while True:
+        flush_file_ops(file_path)
         usernames = read_lines_unique(file_path)
         if not usernames:
-            logger.info(f"[SEND] no usernames in {file_path}. sleeping 300s")
-            await asyncio.sleep(300)
+            logger.info(f"[SEND] no usernames in {file_path}. waiting for changes (max 300s)")
+            await wait_for_file_change(file_path, 300)
             continue
 
+        pending = []  # futures الدور ده؛ مانقراش الملف تاني قبل ما يخلصوا (من غير تكرار)
         for username in list(usernames):
             uname = normalize_recipient(username)
             if not is_valid_tg_username_recipient(uname):
-                remove_username_from_file_atomic(file_path, username)
+                queue_remove_line(file_path, username)
                 continue
 
             if within_history_window(sent_hist, uname, message_key, cfg.cooldown_days):
-                move_line_to_end_atomic(file_path, username)
+                queue_move_line_to_end(file_path, username)
                 continue
 
-            async with state_lock:
-                idx = choose_sender_index(
-                    cfg.send_mode,
-                    cfg.sender_sessions,
-                    last_idx_ref["last"],
-                    disabled_until,
-                    time.time(),
-                    perma_blocked,
-                )
+            idx = picker.pick(
+                cfg.send_mode,
+                cfg.sender_sessions,
+                disabled_until,
+                time.time(),
+                perma_blocked,
+            )
 
-                if idx is None:
-                    logger.warning(f"[SEND] no sender available -> requeue {uname}")
-                    move_line_to_end_atomic(file_path, username)
-                    await asyncio.sleep(5)
-                    continue
+            if idx is None:
+                logger.warning(f"[SEND] no sender available -> requeue {uname}")
+                queue_move_line_to_end(file_path, username)
+                await asyncio.sleep(5)
+                continue
 
-                last_idx_ref["last"] = idx
-                session_path = cfg.sender_sessions[idx]
-                client = clients[session_path]
-                
-            # 🔁 تغيير النص + random variation
-            def mutate_text(tpl: str) -> str:
-                variations = [
-                    tpl,
-                    tpl.replace("السلام عليكم", "أهلاً"),
-                    tpl.replace("لو تحب", "لو حابب"),
-                    tpl + " 😊",
-                    tpl.replace("شرح", "مساعدة"),
-                ]
-                return random.choice(variations)
+            session_path = cfg.sender_sessions[idx]
 
-            # ✅ النص النهائي
-            final_template = mutate_text(template_text)
+            # ✅ النص النهائي (random variation)
+            final_template = random.choice(variations)
 
             text = format_message(
                 template_text=final_template,
@@ -1402,33 +2461,18 @@ async def _process_file_sends(
                 sender_name=session_path,
             )
 
-            ok = await send_one_message(
-                cfg=cfg,
-                logger=logger,
-                client=client,
-                session_path=session_path,
-                username=uname,
-                text=text,   # ✅ بقى متعرّف
-                perma_blocked=perma_blocked,
-                disabled_until=disabled_until,
-                sent_hist=sent_hist,
-                send_counter=send_counter,
-                attachments=None,
+            fut = loop.create_future()
+            await send_queues[session_path].put(
+                (file_path, username, uname, flow_name, message_key, text, fut)
             )
+            pending.append(fut)
 
-            if ok:
-                append_send_log(
-                    "logs/send_log.csv",
-                    (utc_iso(), uname, flow_name, session_path, "OK", ""),
-                )
-                remove_username_from_file_atomic(file_path, username)
-                append_sent_history(uname, message_key)
-                logger.info(f"[SEND] OK {uname} via {session_path}")
-            else:
-                move_line_to_end_atomic(file_path, username)
-
-            # ⏱ Delay عشوائي حقيقي
-            await asyncio.sleep(random.uniform(3.5, 8.5))
+        if pending:
+            await asyncio.gather(*pending)
+        else:
+            # كله في فترة الـ cooldown -> مفيش داعي نلف على الملف تاني قبل ما يتغير
+            flush_file_ops(file_path)
+            await wait_for_file_change(file_path, 60)
 
 
 async def run_sender(cfg: AppConfig, only: Optional[str], logger: logging.Logger):
@@ -1475,9 +2519,25 @@ async def run_sender(cfg: AppConfig, only: Optional[str], logger: logging.Logger
     disabled_until: Dict[str, float] = {}
     sent_hist = load_sent_history()
 
-    state_lock = asyncio.Lock()
-    last_idx_ref = {"last": -1}
-    send_counter = defaultdict(int)
+    picker = SenderPicker(len(cfg.sender_sessions))
+    send_queues: Dict[str, asyncio.Queue] = {
+        sess: asyncio.Queue(SENDER_QUEUE_MAX) for sess in cfg.sender_sessions
+    }
+    workers = [
+        asyncio.create_task(
+            _sender_worker(
+                cfg=cfg,
+                logger=logger,
+                session_path=sess,
+                client=clients[sess],
+                queue=send_queues[sess],
+                perma_blocked=perma_blocked,
+                disabled_until=disabled_until,
+                sent_hist=sent_hist,
+            )
+        )
+        for sess in cfg.sender_sessions
+    ]
 
     try:
         tasks = []
@@ -1516,8 +2576,8 @@ async def run_sender(cfg: AppConfig, only: Optional[str], logger: logging.Logger
                         flow_name="AUTO",
                         template_path=cfg.auto_flow.template_path,
                         attachments_enabled=cfg.auto_flow.attachments_enabled,
-                        last_idx_ref=last_idx_ref,
-                        state_lock=state_lock,
+                        send_queues=send_queues,
+                        picker=picker,
                     )
                 )
             )
@@ -1540,9 +2600,9 @@ async def run_sender(cfg: AppConfig, only: Optional[str], logger: logging.Logger
                         flow_name=g.name,
                         template_path=g.template_path,
                         attachments_enabled=g.attachments_enabled,
-                        last_idx_ref=last_idx_ref,
                         template_text_override=getattr(g, "_template_text", None),
-                        state_lock=state_lock,
+                        send_queues=send_queues,
+                        picker=picker,
                     )
                 )
             )
@@ -1551,9 +2611,20 @@ async def run_sender(cfg: AppConfig, only: Optional[str], logger: logging.Logger
             logger.warning("[SEND] No active flows.")
             return
 
-        await asyncio.gather(*tasks)
+        flusher = asyncio.create_task(file_ops_flusher(logger))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            flusher.cancel()
 
     finally:
+        for w in workers:
+            w.cancel()
+        try:
+            flush_all_file_ops()
+        except Exception as e:
+            logger.warning(f"[FILE-OPS] final flush failed: {e}")
+        close_csv_logs()
         for c in clients.values():
             try:
                 await c.__aexit__(None, None, None)
@@ -1622,24 +2693,29 @@ def _db_init_broadcast(cur):
     )
     """)
 
+# ✅ نفس نص الـ SQL كل مرة -> sqlite3 بيعيد استخدام الـ prepared statement من الكاش بتاع الاتصال المشترك
+_INSERT_BROADCAST_SQL = "INSERT OR IGNORE INTO broadcast_targets(user_id, username, first_seen) VALUES(?,?,?)"
+_SELECT_BROADCAST_SQL = "SELECT user_id FROM broadcast_targets ORDER BY first_seen DESC LIMIT ?"
+_BROADCAST_READY = False
+
+def _broadcast_cur():
+    global _BROADCAST_READY
+    if not _BROADCAST_READY:
+        with _db_cur() as cur:
+            _db_init_broadcast(cur)
+        _BROADCAST_READY = True
+    return _db_cur()
+
 def collect_broadcast_user(user_id, username, enabled=True):
     if not enabled:
         return
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT OR IGNORE INTO broadcast_targets(user_id, username, first_seen) VALUES(?,?,?)",
-        (user_id, username or "", datetime.utcnow().isoformat())
-    )
-    conn.commit()
-    conn.close()
+    with _broadcast_cur() as cur:
+        cur.execute(_INSERT_BROADCAST_SQL, (user_id, username or "", datetime.utcnow().isoformat()))
 
 def send_broadcast_all(send_func, template_text, limit=20):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT user_id FROM broadcast_targets ORDER BY first_seen DESC LIMIT ?", (limit,))
-    rows = cur.fetchall()
-    conn.close()
+    with _broadcast_cur() as cur:
+        cur.execute(_SELECT_BROADCAST_SQL, (limit,))
+        rows = cur.fetchall()
     for (uid,) in rows:
         try:
             send_func(uid, template_text)
@@ -30,30 +30,47 @@ mod_bot.py — Viewer/Moderator bot for listened messages (all-UI buttons + grou
 - TRIM في الاستعلامات عشان لو عندك بيانات قديمة بمسافات.
 """
 
+import asyncio
+import atexit
+import bisect
 import os
 import csv
+import queue
+import functools
 import sqlite3
+import threading
+import time
+import unicodedata
 import yaml
 import json
 import html
+import logging
 import re
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from typing import Optional, List, Tuple, Dict
 
 from pyrogram import Client, filters
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
 from pyrogram.enums import ParseMode
+from pyrogram.errors import FloodWait
+
+try:
+    import orjson  # اختياري: decoding أسرع لأعمدة الـ JSON (زي bot.py)
+except Exception:
+    orjson = None  # type: ignore
+
+logger = logging.getLogger("mod_bot")
 
 
 # -----------------------
 # Normalization helpers (FIX)
 # -----------------------
+@functools.lru_cache(maxsize=8192)
 def norm_key(s: str) -> str:
     """Normalize keys used for DB matching (uni_tag, section_name, keywords)."""
-    s = (s or "").strip()
-    # collapse multiple spaces
-    s = re.sub(r"\s+", " ", s)
-    return s
+    # strip + collapse whitespace runs (split/join in C, no regex)
+    return " ".join((s or "").split())
 
 
 # -----------------------
@@ -86,13 +103,57 @@ if not BOT_TOKEN:
 # -----------------------
 # DB init & migrations
 # -----------------------
+def _configure_conn(conn: sqlite3.Connection) -> sqlite3.Connection:
+    """Per-connection PRAGMAs (journal_mode=WAL is persistent, set once in db_init)."""
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.execute("PRAGMA mmap_size=134217728")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+
+# ✅ connection واحدة لكل thread بدل connect/close مع كل helper (الـ page cache بيفضل سخن)
+_TL = threading.local()
+_ALL_CONNS: List[sqlite3.Connection] = []
+
+
 def db_conn():
-    return sqlite3.connect(DB_PATH)
+    c = getattr(_TL, "c", None)
+    if c is None:
+        c = _configure_conn(sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False, cached_statements=256))
+        _TL.c = c
+        _ALL_CONNS.append(c)
+    elif c.in_transaction:
+        # كل helper بيكتب بيقفل الـ transaction بتاعه بنفسه (with conn)؛ لو فيه واحد نسي -> نسجّل ونكمّل
+        logger.error("DB transaction left open by a previous helper; rolling back")
+        c.rollback()
+    return c
+
+
+def db_close_all():
+    for c in _ALL_CONNS:
+        try:
+            c.execute("PRAGMA optimize")
+            c.close()
+        except Exception:
+            pass
+    _ALL_CONNS.clear()
+
+
+atexit.register(db_close_all)
+
+
+# ✅ الـ migrations اللي بتلف على جدول messages كله بتتعمل مرة واحدة بس (PRAGMA user_version)
+DB_SCHEMA_VERSION = 3
 
 
 def db_init():
     os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_conn()
+    # ✅ WAL: القراية ما بتستناش الكتابة (bot.py بيكتب في نفس الـ DB)
+    conn.execute("PRAGMA journal_mode=WAL")
     cur = conn.cursor()
     # messages
     cur.execute("""
@@ -131,6 +192,31 @@ def db_init():
     if "reply_to_tg_id" not in cols:
         cur.execute("ALTER TABLE messages ADD COLUMN reply_to_tg_id INTEGER")
 
+    cur.execute("PRAGMA user_version")
+    db_ver = cur.fetchone()[0]
+
+    if db_ver < 1:
+        # ✅ defaults بدل NULL (الـ listener بيكتب '' من الأول) -> الـ SELECTs من غير COALESCE لكل عمود
+        # edited_text بيفضل NULL (يعني مش متعدّل)، و note/assigned_to بيفضلوا NULL (الـ SELECTs بتعمل COALESCE)
+        cur.execute("""
+            UPDATE messages
+               SET chat_id=COALESCE(chat_id,0), chat_username=COALESCE(chat_username,''),
+                   user_id=COALESCE(user_id,0), username=COALESCE(username,''),
+                   text=COALESCE(text,''), date=COALESCE(date,''), status=COALESCE(status,'new'),
+                   source_tag=COALESCE(source_tag,''), uni_subjects=COALESCE(uni_subjects,'')
+             WHERE chat_id IS NULL OR chat_username IS NULL OR user_id IS NULL OR username IS NULL
+                OR text IS NULL OR date IS NULL OR status IS NULL
+                OR source_tag IS NULL OR uni_subjects IS NULL
+        """)
+
+    if db_ver < 2:
+        # ✅ source_tag بيتقارن بـ = مباشرة (عشان الـ index) -> نضّف أي مسافات قديمة مرة واحدة
+        cur.execute("UPDATE messages SET source_tag=TRIM(source_tag) WHERE source_tag <> TRIM(source_tag)")
+
+    # indexes for the inbox / replies queries
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_msg_tag_status_id ON messages(source_tag, status, deleted, id DESC)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_msg_chat_reply ON messages(chat_id, reply_to_tg_id) WHERE deleted=0")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_msg_chat_date ON messages(chat_id, date) WHERE deleted=0")
 
     # other tables
     cur.execute("""CREATE TABLE IF NOT EXISTS blocked_users(user_id INTEGER PRIMARY KEY)""")
@@ -160,6 +246,114 @@ def db_init():
     )
     """)
     cur.execute("""CREATE UNIQUE INDEX IF NOT EXISTS idx_uni_sections_unique ON uni_sections(uni_tag, section_name)""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS idx_uni_sections_tag ON uni_sections(uni_tag)""")
+
+    # ✅ keywords_json متفكّكة في جدول (triggers بتحافظ عليه) -> القراية من غير json.loads
+    # keywords_json لسه الـ source of truth (bot.py بيقرا منه)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS section_keywords(
+        section_id INTEGER NOT NULL,
+        pos INTEGER NOT NULL,
+        kw TEXT NOT NULL,
+        PRIMARY KEY(section_id, pos)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("""CREATE INDEX IF NOT EXISTS idx_section_kw ON section_keywords(kw)""")
+    # keywords رقمية (زي 101) بتتخزن كـ text عشان تتقارن بالنص زي باقي الكلمات
+    fill_kws = """INSERT INTO section_keywords(section_id, pos, kw)
+                  SELECT {sid}, j.key, CAST(j.value AS TEXT)
+                    FROM json_each(CASE WHEN json_valid({kj}) AND json_type({kj})='array' THEN {kj} ELSE '[]' END) j
+                   WHERE j.type IN ('text','integer','real')"""
+    if db_ver < 3:
+        # الـ triggers القديمة كانت بتتجاهل الأرقام -> تتعمل من جديد والجدول يتملي تاني
+        cur.execute("DROP TRIGGER IF EXISTS trg_section_kws_ins")
+        cur.execute("DROP TRIGGER IF EXISTS trg_section_kws_upd")
+        cur.execute("DELETE FROM section_keywords")
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_section_kws_ins AFTER INSERT ON uni_sections BEGIN
+        {fill_kws.format(sid="NEW.id", kj="NEW.keywords_json")};
+    END""")
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_section_kws_upd AFTER UPDATE OF keywords_json ON uni_sections BEGIN
+        DELETE FROM section_keywords WHERE section_id=OLD.id;
+        {fill_kws.format(sid="NEW.id", kj="NEW.keywords_json")};
+    END""")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_section_kws_del AFTER DELETE ON uni_sections BEGIN
+        DELETE FROM section_keywords WHERE section_id=OLD.id;
+    END""")
+    # backfill مرة واحدة للسكشنات اللي اتعملت قبل الجدول ده
+    cur.execute(
+        fill_kws.replace("FROM json_each", "FROM uni_sections s, json_each").format(sid="s.id", kj="s.keywords_json")
+        + " AND NOT EXISTS (SELECT 1 FROM section_keywords k WHERE k.section_id=s.id)"
+    )
+
+    # ✅ مواد كل رسالة (uni_subjects JSON) في جدول بـ index -> السكشن بقى range scan بدل LIKE '%"x"%' على كل الجدول
+    # section_name NOCASE زي LIKE القديم؛ الـ triggers بتحافظ عليه مع insert/edit/rename من أي bot
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='message_sections'")
+    ms_is_new = cur.fetchone() is None
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS message_sections(
+        uni_name TEXT NOT NULL,
+        section_name TEXT NOT NULL COLLATE NOCASE,
+        msg_id INTEGER NOT NULL,
+        PRIMARY KEY(uni_name, section_name, msg_id)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("""CREATE INDEX IF NOT EXISTS idx_msg_sections_msg ON message_sections(msg_id)""")
+    fill_ms = """INSERT OR IGNORE INTO message_sections(uni_name, section_name, msg_id)
+                 SELECT {tag}, j.value, {mid}
+                   FROM json_each(CASE WHEN json_valid({sj}) AND json_type({sj})='array' THEN {sj} ELSE '[]' END) j
+                  WHERE j.type='text' AND j.value <> ''"""
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_msg_sections_ins AFTER INSERT ON messages BEGIN
+        {fill_ms.format(tag="NEW.source_tag", mid="NEW.id", sj="NEW.uni_subjects")};
+    END""")
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_msg_sections_upd AFTER UPDATE OF source_tag, uni_subjects ON messages
+    WHEN OLD.source_tag IS NOT NEW.source_tag OR OLD.uni_subjects IS NOT NEW.uni_subjects BEGIN
+        DELETE FROM message_sections WHERE msg_id=OLD.id;
+        {fill_ms.format(tag="NEW.source_tag", mid="NEW.id", sj="NEW.uni_subjects")};
+    END""")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_msg_sections_del AFTER DELETE ON messages BEGIN
+        DELETE FROM message_sections WHERE msg_id=OLD.id;
+    END""")
+    if ms_is_new:
+        cur.execute(
+            fill_ms.replace("FROM json_each", "FROM messages m, json_each").format(tag="m.source_tag", mid="m.id", sj="m.uni_subjects")
+            + " AND m.source_tag IS NOT NULL"
+        )
+
+    # ✅ البحث كان LIKE '%q%' = scan للجدول كله مع كل بحث -> FTS5 index على text/edited_text
+    # trigram (مش unicode61) عشان يفضل substring زي LIKE: "كتاب" تلاقي "بالكتاب" في العربي
+    global _FTS_OK
+    try:
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='messages_fts'")
+        fts_is_new = cur.fetchone() is None
+        cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+        USING fts5(text, edited_text, content=messages, content_rowid=id, tokenize='trigram')
+        """)
+        cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_msg_fts_ins AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts(rowid, text, edited_text) VALUES (NEW.id, NEW.text, NEW.edited_text);
+        END""")
+        cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_msg_fts_upd AFTER UPDATE OF text, edited_text ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, text, edited_text) VALUES ('delete', OLD.id, OLD.text, OLD.edited_text);
+            INSERT INTO messages_fts(rowid, text, edited_text) VALUES (NEW.id, NEW.text, NEW.edited_text);
+        END""")
+        cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_msg_fts_del AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, text, edited_text) VALUES ('delete', OLD.id, OLD.text, OLD.edited_text);
+        END""")
+        if fts_is_new:
+            cur.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+        _FTS_OK = True
+    except sqlite3.OperationalError:
+        # sqlite من غير fts5/trigram -> البحث يرجع لـ LIKE
+        _FTS_OK = False
 
     # Dynamic groups table
     cur.execute("""
@@ -177,6 +371,8 @@ def db_init():
         updated_at TEXT
     )
     """)
+    if db_ver < DB_SCHEMA_VERSION:
+        cur.execute(f"PRAGMA user_version={DB_SCHEMA_VERSION}")
     conn.commit()
 
     # migration: ensure groups.uni_tag exists (university tag)
@@ -185,16 +381,44 @@ def db_init():
         cols = [str(r[1]) for r in cur.fetchall()]
         if "uni_tag" not in cols:
             cur.execute("ALTER TABLE groups ADD COLUMN uni_tag TEXT DEFAULT ''")
-        cur.execute("UPDATE groups SET uni_tag=name WHERE TRIM(COALESCE(uni_tag,''))='' ")
+        # ✅ المفاتيح بتتخزن متنضفة (norm_key) والـ queries بتقارن بـ = مباشرة -> نضّف القديم مرة واحدة
+        cur.execute("UPDATE OR IGNORE groups SET name=TRIM(name) WHERE name <> TRIM(name)")
+        cur.execute("UPDATE groups SET uni_tag=TRIM(uni_tag) WHERE uni_tag <> TRIM(uni_tag)")
+        cur.execute("UPDATE groups SET uni_tag=name WHERE uni_tag IS NULL OR uni_tag=''")
+        cur.execute("UPDATE OR IGNORE uni_sections SET uni_tag=TRIM(uni_tag), section_name=TRIM(section_name) "
+                    "WHERE uni_tag <> TRIM(uni_tag) OR section_name <> TRIM(section_name)")
+        # GROUP BY الجامعات (db_list_universities*) بيمشي على الـ index بالترتيب من غير temp b-tree
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_groups_utag ON groups(COALESCE(NULLIF(uni_tag,''), name))")
         conn.commit()
     except Exception:
-        pass
+        conn.rollback()
 
     # seed roles for admins
-    for aid in ADMIN_IDS:
-        cur.execute("INSERT OR IGNORE INTO roles(user_id, role) VALUES(?, ?)", (aid, "admin"))
+    cur.executemany("INSERT OR IGNORE INTO roles(user_id, role) VALUES(?, 'admin')", [(aid,) for aid in ADMIN_IDS])
     conn.commit()
-    conn.close()
+
+    # ✅ أول مرة: stats للـ planner عشان الـ indexes تتختار من أول query (بعد كده PRAGMA optimize)
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'")
+    if cur.fetchone() is None:
+        conn.execute("PRAGMA analysis_limit=400")
+        conn.execute("ANALYZE")
+        conn.commit()
+
+
+DB_OPTIMIZE_EVERY_SEC = 6 * 3600
+
+
+def _db_optimize_loop():
+    while True:
+        time.sleep(DB_OPTIMIZE_EVERY_SEC)
+        try:
+            db_conn().execute("PRAGMA optimize")
+        except Exception:
+            pass
+
+
+def start_db_optimizer():
+    threading.Thread(target=_db_optimize_loop, name="db-optimize", daemon=True).start()
 
 
 # -----------------------
@@ -205,53 +429,98 @@ def db_list_groups() -> List[Tuple[int, str]]:
     cur = conn.cursor()
     cur.execute("SELECT id, name FROM groups ORDER BY id ASC")
     rows = cur.fetchall()
-    conn.close()
     return [(int(r[0]), str(r[1])) for r in rows]
 
+# ✅ صفحات الجامعات بتتفتح كتير -> cache قصير (وبيتمسح مع أي تعديل في groups)
+UNIS_CACHE_TTL_SEC = 30.0
+_UNIS_CACHE: Dict[Tuple, Tuple[float, object]] = {}
+
+
+def _unis_cached(key: Tuple, build):
+    hit = _UNIS_CACHE.get(key)
+    if hit is not None and time.monotonic() - hit[0] < UNIS_CACHE_TTL_SEC:
+        return hit[1]
+    val = build()
+    _UNIS_CACHE[key] = (time.monotonic(), val)
+    return val
+
+
 def db_list_universities() -> List[Tuple[int, str, int]]:
     """Return list of (rep_gid, uni_tag, sources_count)"""
+    return list(_unis_cached(("all",), _db_list_universities))
+
+
+def _db_list_universities() -> List[Tuple[int, str, int]]:
     conn = db_conn()
     cur = conn.cursor()
     cur.execute("""SELECT MIN(id) as gid,
-                            COALESCE(NULLIF(TRIM(uni_tag),''), name) as utag,
+                            COALESCE(NULLIF(uni_tag,''), name) as utag,
                             COUNT(*) as cnt
                      FROM groups
-                     GROUP BY COALESCE(NULLIF(TRIM(uni_tag),''), name)
+                     GROUP BY COALESCE(NULLIF(uni_tag,''), name)
                      ORDER BY utag ASC""")
     rows = cur.fetchall()
-    conn.close()
     out = []
     for gid, utag, cnt in rows:
         out.append((int(gid), str(utag), int(cnt)))
     return out
 
 
-def db_list_sources_for_uni(uni_tag: str) -> List[Tuple[int, str, str, int, int]]:
-    """Return list of sources (groups rows) for a university tag.
+# ✅ صفحات الـ menus من SQL (LIMIT/OFFSET + COUNT(*) OVER() للإجمالي) بدل ما نجيب الجدول كله ونقطّع في بايثون
+def _fetch_page(sql: str, params: Tuple, limit: int, offset: int) -> Tuple[List[Tuple], int]:
+    """sql must select COUNT(*) OVER() as its last column; returns (rows without it, total)."""
+    conn = db_conn()
+    cur = conn.cursor()
+    cur.execute(f"{sql} LIMIT ? OFFSET ?", (*params, int(limit), int(offset)))
+    rows = cur.fetchall()
+    if rows:
+        return [r[:-1] for r in rows], int(rows[0][-1])
+    if offset <= 0:
+        return [], 0
+    cur.execute(f"SELECT COUNT(*) FROM ({sql})", params)
+    return [], int(cur.fetchone()[0] or 0)
+
+
+def db_list_groups_page(limit: int, offset: int) -> Tuple[List[Tuple[int, str]], int]:
+    rows, total = _fetch_page("SELECT id, name, COUNT(*) OVER() FROM groups ORDER BY id ASC", (), limit, offset)
+    return [(int(gid), str(name)) for gid, name in rows], total
+
+
+def db_list_universities_page(limit: int, offset: int) -> Tuple[List[Tuple[int, str, int]], int]:
+    """Page of db_list_universities() rows + total number of universities."""
+    return _unis_cached(("page", int(limit), int(offset)), lambda: _db_list_universities_page(limit, offset))
+
+
+def _db_list_universities_page(limit: int, offset: int) -> Tuple[List[Tuple[int, str, int]], int]:
+    rows, total = _fetch_page(
+        """SELECT MIN(id), COALESCE(NULLIF(uni_tag,''), name) as utag, COUNT(*), COUNT(*) OVER()
+             FROM groups
+            GROUP BY COALESCE(NULLIF(uni_tag,''), name)
+            ORDER BY utag ASC""",
+        (),
+        limit,
+        offset,
+    )
+    return [(int(gid), str(utag), int(cnt)) for gid, utag, cnt in rows], total
+
 
-    Matches rows where effective university key = COALESCE(NULLIF(TRIM(uni_tag),''), name).
-    Returns: (gid, name, chat, send_enabled, subjects_only)
+def db_list_sources_for_uni_page(uni_tag: str, limit: int, offset: int) -> Tuple[List[Tuple[int, str, str, int, int]], int]:
+    """One page of sources (groups rows) for a university tag.
+
+    Matches rows where effective university key = COALESCE(NULLIF(uni_tag,''), name).
+    Returns: ([(gid, name, chat, send_enabled, subjects_only)], total)
     """
     uni_tag = norm_key(uni_tag)
-    conn = db_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """SELECT id,
-                  name,
-                  chat,
-                  COALESCE(send_enabled,0),
-                  COALESCE(subjects_only,0)
+    rows, total = _fetch_page(
+        """SELECT id, name, chat, COALESCE(send_enabled,0), COALESCE(subjects_only,0), COUNT(*) OVER()
              FROM groups
-            WHERE TRIM(COALESCE(NULLIF(uni_tag,''), name)) = TRIM(?)
+            WHERE uni_tag = ? OR (COALESCE(uni_tag,'') = '' AND name = ?)
             ORDER BY id ASC""",
-        (uni_tag,),
+        (uni_tag, uni_tag),
+        limit,
+        offset,
     )
-    rows = cur.fetchall()
-    conn.close()
-    out: List[Tuple[int, str, str, int, int]] = []
-    for gid, name, chat, send_en, subj_only in rows:
-        out.append((int(gid), str(name), str(chat), int(send_en), int(subj_only)))
-    return out
+    return [(int(g), str(n), str(c), int(se), int(so)) for g, n, c, se, so in rows], total
 
 
 
@@ -259,7 +528,7 @@ def db_get_group(gid: int):
     conn = db_conn()
     cur = conn.cursor()
     cur.execute(
-        """SELECT id,name,COALESCE(NULLIF(TRIM(uni_tag),''), name) as uni_tag,chat,out_file,template_text,
+        """SELECT id,name,COALESCE(NULLIF(uni_tag,''), name) as uni_tag,chat,out_file,template_text,
              COALESCE(attachments_enabled,0),
                   COALESCE(send_enabled,1),
                   COALESCE(subjects_only,0)
@@ -267,27 +536,40 @@ def db_get_group(gid: int):
         (gid,),
     )
     row = cur.fetchone()
-    conn.close()
     return row
 
 
-def db_get_group_by_name(name: str):
-    name = norm_key(name)
+# ✅ نفس القروب بيتقري مع كل ضغطة في إدارة القروبات/المصادر/السكشنات -> cache بالـ id
+# (بيتمسح مع أي تعديل في groups عن طريق _invalidate_tags_cache)
+_GROUP_CACHE: Dict[int, Tuple] = {}
+
+
+def get_group_cached(gid: int):
+    gid = int(gid)
+    row = _GROUP_CACHE.get(gid)
+    if row is None:
+        row = db_get_group(gid)
+        if row is not None:
+            if len(_GROUP_CACHE) >= 512:
+                _GROUP_CACHE.clear()
+            _GROUP_CACHE[gid] = row
+    return row
+
+
+def db_next_source_name(base: str) -> str:
+    """Next free "<base>#<n>" (n = أكبر رقم مستخدم + 1) in one query instead of probing name by name."""
+    base = norm_key(base)
     conn = db_conn()
     cur = conn.cursor()
+    # range على الـ UNIQUE index بتاع name ('$' هو الحرف اللي بعد '#') بدل LIKE (الاسم ممكن يكون فيه % أو _)
     cur.execute(
-        """SELECT id, name, uni_tag, chat, out_file, template_text,
-                  COALESCE(attachments_enabled,0),
-                  COALESCE(send_enabled,0),
-                  COALESCE(subjects_only,0),
-                  created_at, updated_at
+        """SELECT MAX(CAST(substr(name, ?) AS INTEGER))
              FROM groups
-            WHERE TRIM(name)=TRIM(?)""",
-        (name,),
+            WHERE name >= ? AND name < ?""",
+        (len(base) + 2, base + "#", base + "$"),
     )
-    row = cur.fetchone()
-    conn.close()
-    return row
+    n = cur.fetchone()[0]
+    return f"{base}#{int(n or 0) + 1}"
 
 
 def db_create_group(
@@ -301,6 +583,7 @@ def db_create_group(
     subjects_only: int = 0,
 ) -> Tuple[bool, str]:
     name = norm_key(name)
+    uni_tag = norm_key(uni_tag)
     chat = (chat or "").strip()
     if not name:
         return False, "اسم القروب فارغ."
@@ -312,28 +595,27 @@ def db_create_group(
     conn = db_conn()
     cur = conn.cursor()
     try:
-        cur.execute(
-            """INSERT INTO groups(name,uni_tag,chat,out_file,template_text,attachments_enabled,send_enabled,subjects_only,created_at,updated_at)
-               VALUES(?,?,?,?,?,?,?,?,?,?)""",
-            (
-                name,
-                uni_tag,
-                chat,
-                out_file,
-                (template_text or "").strip(),
-                int(attachments_enabled),
-                int(send_enabled),
-                int(subjects_only),
-                now,
-                now,
-            ),
-        )
-        conn.commit()
-        conn.close()
-        return True, "تمت إضافة القروب."
+        with conn:
+            cur.execute(
+                """INSERT INTO groups(name,uni_tag,chat,out_file,template_text,attachments_enabled,send_enabled,subjects_only,created_at,updated_at)
+                   VALUES(?,?,?,?,?,?,?,?,?,?)""",
+                (
+                    name,
+                    uni_tag,
+                    chat,
+                    out_file,
+                    (template_text or "").strip(),
+                    int(attachments_enabled),
+                    int(send_enabled),
+                    int(subjects_only),
+                    now,
+                    now,
+                ),
+            )
     except sqlite3.IntegrityError:
-        conn.close()
         return False, "يوجد قروب بنفس الاسم بالفعل."
+    _invalidate_tags_cache()
+    return True, "تمت إضافة القروب."
 
 
 def db_update_group_field(gid: int, field: str, value) -> Tuple[bool, str]:
@@ -342,43 +624,46 @@ def db_update_group_field(gid: int, field: str, value) -> Tuple[bool, str]:
     conn = db_conn()
     cur = conn.cursor()
     if field == "name":
-        row = db_get_group(gid)
-        if not row:
-            conn.close()
-            return False, "القروب غير موجود."
-        old_name = norm_key(str(row[1]))
         new_name = norm_key(str(value))
         if not new_name:
-            conn.close()
             return False, "الاسم الجديد فارغ."
+        # ✅ transaction واحدة: قراءة الاسم القديم + الـ 3 UPDATEs (rename atomic)
         try:
-            cur.execute("UPDATE groups SET name=?, updated_at=? WHERE id=?", (new_name, datetime.utcnow().isoformat(), gid))
-            # cascade with TRIM to catch old whitespace
-            cur.execute("UPDATE uni_sections SET uni_tag=?, updated_at=? WHERE TRIM(uni_tag)=TRIM(?)", (new_name, datetime.utcnow().isoformat(), old_name))
-            cur.execute("UPDATE messages SET source_tag=? WHERE TRIM(COALESCE(source_tag,''))=TRIM(?)", (new_name, old_name))
-            conn.commit()
-            conn.close()
-            return True, "تم تغيير الاسم (مع تحديث السكشنات والرسائل)."
+            with conn:
+                cur.execute("BEGIN IMMEDIATE")
+                cur.execute("SELECT name FROM groups WHERE id=?", (gid,))
+                row = cur.fetchone()
+                if row:
+                    old_name = norm_key(str(row[0]))
+                    cur.execute("UPDATE groups SET name=?, updated_at=? WHERE id=?", (new_name, datetime.utcnow().isoformat(), gid))
+                    # cascade (keys are stored normalized, see db_init)
+                    cur.execute("UPDATE uni_sections SET uni_tag=?, updated_at=? WHERE uni_tag=?", (new_name, datetime.utcnow().isoformat(), old_name))
+                    cur.execute("UPDATE messages SET source_tag=? WHERE source_tag=?", (new_name, old_name))
         except sqlite3.IntegrityError:
-            conn.close()
             return False, "يوجد قروب آخر بنفس الاسم."
+        if not row:
+            return False, "القروب غير موجود."
+        _invalidate_tags_cache()
+        return True, "تم تغيير الاسم (مع تحديث السكشنات والرسائل)."
     else:
-        cur.execute(f"UPDATE groups SET {field}=?, updated_at=? WHERE id=?", (value, datetime.utcnow().isoformat(), gid))
-        conn.commit()
-        conn.close()
+        with conn:
+            cur.execute(f"UPDATE groups SET {field}=?, updated_at=? WHERE id=?", (value, datetime.utcnow().isoformat(), gid))
+        _invalidate_tags_cache()
         return True, "تم الحفظ."
 
 
 def db_delete_group(gid: int) -> bool:
     conn = db_conn()
     cur = conn.cursor()
-    row = db_get_group(gid)
-    if row:
-        gname = norm_key(str(row[1]))
-        cur.execute("DELETE FROM uni_sections WHERE TRIM(uni_tag)=TRIM(?)", (gname,))
-    cur.execute("DELETE FROM groups WHERE id=?", (gid,))
-    conn.commit()
-    conn.close()
+    with conn:
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("SELECT name FROM groups WHERE id=?", (gid,))
+        row = cur.fetchone()
+        if row:
+            gname = norm_key(str(row[0]))
+            cur.execute("DELETE FROM uni_sections WHERE uni_tag=?", (gname,))
+        cur.execute("DELETE FROM groups WHERE id=?", (gid,))
+    _invalidate_tags_cache()
     return True
 
 
@@ -393,6 +678,41 @@ def supported_tags() -> List[str]:
     return tags
 
 
+# ✅ قائمة التاجات المترتبة للمنيو (بتتبني مرة وتتمسح مع أي تعديل في جدول groups)
+_SORTED_TAGS_CACHE: Optional[Tuple[str, ...]] = None
+
+
+def db_supported_tags_sorted() -> Tuple[str, ...]:
+    """supported_tags() deduped + sorted by SQLite (name is UNIQUE -> its autoindex gives the order)."""
+    conn = db_conn()
+    cur = conn.cursor()
+    cur.execute("SELECT name FROM groups ORDER BY name")
+    tags = [str(r[0]) for r in cur.fetchall()]
+    # BINARY collation = نفس ترتيب str في بايثون -> نحط "kw" في مكانها
+    i = bisect.bisect_left(tags, "kw")
+    if i == len(tags) or tags[i] != "kw":
+        tags.insert(i, "kw")
+    return tuple(tags)
+
+
+def sorted_tags() -> Tuple[str, ...]:
+    global _SORTED_TAGS_CACHE
+    if _SORTED_TAGS_CACHE is None:
+        _SORTED_TAGS_CACHE = db_supported_tags_sorted()
+    return _SORTED_TAGS_CACHE
+
+
+def _invalidate_tags_cache():
+    """Call after any change to the groups table (menus, universities and group-row caches)."""
+    global _SORTED_TAGS_CACHE
+    _SORTED_TAGS_CACHE = None
+    _UNIS_CACHE.clear()
+    _GROUP_CACHE.clear()
+    _SECTION_CACHE.clear()  # rename/delete الجامعة بيغيّر uni_tag بتاع سكشناتها
+    build_groups_manage_kb.cache_clear()
+    build_sections_list_kb.cache_clear()
+
+
 def db_seed_groups_from_config():
     groups_cfg = CFG.get("groups", []) or []
     if not groups_cfg:
@@ -402,9 +722,9 @@ def db_seed_groups_from_config():
     cur.execute("SELECT COUNT(1) FROM groups")
     n = int(cur.fetchone()[0] or 0)
     if n > 0:
-        conn.close()
         return
     now = datetime.utcnow().isoformat()
+    rows = []
     for g in groups_cfg:
         name = norm_key(str(g.get("name") or ""))
         uni_tag = norm_key(str(g.get("uni_tag") or g.get("uni") or name))
@@ -417,9 +737,7 @@ def db_seed_groups_from_config():
                 tpl_text = open(tp, "r", encoding="utf-8").read().strip()
             except Exception:
                 tpl_text = ""
-        cur.execute(
-            """INSERT OR IGNORE INTO groups(name,uni_tag,chat,out_file,template_text,attachments_enabled,send_enabled,subjects_only,created_at,updated_at)
-               VALUES(?,?,?,?,?,?,?,?,?,?)""",
+        rows.append(
             (
                 name,
                 uni_tag,
@@ -431,10 +749,16 @@ def db_seed_groups_from_config():
                 1 if bool(g.get("subjects_only")) else 0,
                 now,
                 now,
-            ),
+            )
         )
-    conn.commit()
-    conn.close()
+    # ✅ executemany في transaction واحدة (commit/fsync واحد لكل القروبات)
+    with conn:
+        cur.executemany(
+            """INSERT OR IGNORE INTO groups(name,uni_tag,chat,out_file,template_text,attachments_enabled,send_enabled,subjects_only,created_at,updated_at)
+               VALUES(?,?,?,?,?,?,?,?,?,?)""",
+            rows,
+        )
+    _invalidate_tags_cache()
 
 
 def resolve_tag(display_name: Optional[str]) -> Optional[str]:
@@ -453,84 +777,272 @@ os.makedirs(EXPORT_DIR, exist_ok=True)
 # -----------------------
 # DB helpers
 # -----------------------
+# ✅ الصلاحيات بتتشيك مع كل ضغطة زرار وبتتغير نادرًا -> cache بـ TTL (db_approve بيمسح الـ entry)
+AUTH_CACHE_TTL_SEC = 60.0
+_ROLE_CACHE: Dict[int, Tuple[float, str]] = {}
+_APPROVED_CACHE: Dict[int, Tuple[float, bool]] = {}
+AUTH_CACHE_MAX = 4096
+
+
+def _auth_cache_put(cache: Dict, user_id: int, value):
+    # حد أقصى للحجم (كل user بيبعت /start بيعمل entry) -> نفضّيه ونبدأ من جديد
+    if len(cache) >= AUTH_CACHE_MAX:
+        cache.clear()
+    cache[user_id] = (time.monotonic(), value)
+
+
 def role_of(user_id: int) -> str:
+    hit = _ROLE_CACHE.get(user_id)
+    if hit is not None and time.monotonic() - hit[0] < AUTH_CACHE_TTL_SEC:
+        return hit[1]
     conn = db_conn()
     cur = conn.cursor()
     cur.execute("SELECT role FROM roles WHERE user_id=?", (user_id,))
     row = cur.fetchone()
-    conn.close()
-    if row and row[0]:
-        return row[0]
-    return "viewer"
+    role = row[0] if row and row[0] else "viewer"
+    _auth_cache_put(_ROLE_CACHE, user_id, role)
+    return role
+
+
+# ✅ actions_log بيتكتب من thread في الخلفية (batch + commit واحد) بدل commit مع كل ضغطة زرار
+LOG_FLUSH_SEC = 0.5
+LOG_FLUSH_ROWS = 100
+LOG_BATCH_MAX = 500
+_INSERT_ACTION_SQL = "INSERT INTO actions_log(ts, actor_id, action, msg_id, extra) VALUES(?,?,?,?,?)"
+_log_q: "queue.Queue[Tuple]" = queue.Queue()
+_log_wake = threading.Event()
+_log_stop = threading.Event()
+_log_thread: Optional[threading.Thread] = None
+_log_thread_lock = threading.Lock()
+
+
+def _flush_action_log():
+    batch: List[Tuple] = []
+    while len(batch) < LOG_BATCH_MAX:
+        try:
+            batch.append(_log_q.get_nowait())
+        except queue.Empty:
+            break
+    if not batch:
+        return 0
+    conn = db_conn()
+    try:
+        with conn:
+            conn.executemany(_INSERT_ACTION_SQL, batch)
+    except sqlite3.Error as e:
+        # الـ DB مقفولة (الـ listener بيكتب) أو أي خطأ sqlite -> الـ batch ترجع الطابور وتتكتب في الـ flush الجاية بدل ما تضيع
+        logger.warning("actions_log flush failed (%d rows re-queued): %s", len(batch), e)
+        if not _log_stop.is_set():
+            for item in batch:
+                _log_q.put(item)
+        return 0
+    return len(batch)
+
+
+def _log_writer_loop():
+    while not _log_stop.is_set():
+        _log_wake.wait(LOG_FLUSH_SEC)
+        _log_wake.clear()
+        while _flush_action_log() >= LOG_BATCH_MAX:
+            pass
+    while _flush_action_log():
+        pass
+
+
+def stop_log_writer():
+    """Flush pending action logs and stop the writer thread."""
+    global _log_thread
+    t = _log_thread
+    if t is None:
+        return
+    _log_stop.set()
+    _log_wake.set()
+    t.join(timeout=5)
+    _log_thread = None
+
+
+atexit.register(stop_log_writer)  # بيتنفذ قبل db_close_all (atexit بالعكس)
 
 
 def log_action(actor_id: int, action: str, msg_id: Optional[int], extra: str = ""):
-    conn = db_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO actions_log(ts, actor_id, action, msg_id, extra) VALUES(?,?,?,?,?)",
-        (datetime.utcnow().isoformat(), actor_id, action, msg_id, extra),
+    global _log_thread
+    if _log_thread is None:
+        with _log_thread_lock:
+            if _log_thread is None:
+                _log_stop.clear()
+                _log_thread = threading.Thread(target=_log_writer_loop, name="action-log", daemon=True)
+                _log_thread.start()
+    _log_q.put((datetime.utcnow().isoformat(), actor_id, action, msg_id, extra))
+    if _log_q.qsize() >= LOG_FLUSH_ROWS:
+        _log_wake.set()
+
+
+@functools.lru_cache(maxsize=1024)
+def _kw_content_filter(kws: Tuple[str, ...], id_col: str, use_fts: bool) -> Tuple[str, Optional[str]]:
+    """(SQL, fts query) for "content has any of kws" (already stripped/lowered).
+
+    Built once per keyword set (the section's keywords بتتكرر مع كل ضغطة).
+    """
+    exact = "(" + " OR ".join(["instr(lower(COALESCE(edited_text, text, '')), ?) > 0"] * len(kws)) + ")"
+    if not (use_fts and all(len(k) >= FTS_MIN_QUERY for k in kws)):
+        return exact, None
+    # ✅ الـ FTS index بيضيّق المرشحين الأول (K phrase في query واحدة بدل K×N instr)
+    # وبعدين الـ instr على المرشحين بس -> نفس النتيجة بالظبط (FTS بيشوف text و edited_text الاتنين)
+    return (
+        f"{id_col} IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?) AND {exact}",
+        " OR ".join(_fts_phrase(k) for k in kws),
     )
-    conn.commit()
-    conn.close()
 
 
-def db_query_list(tag: Optional[str], status: Optional[str], limit: int, offset: int) -> List[Tuple]:
-    conn = db_conn()
-    cur = conn.cursor()
-    base = """SELECT id, chat_username, user_id, username,
-                     COALESCE(edited_text, text) AS content,
-                     date, COALESCE(status,'new'), COALESCE(note,''), COALESCE(assigned_to,''),
-                     COALESCE(uni_subjects,'')
-              FROM messages
-              WHERE deleted=0"""
-    params = []
+def _kw_content_where(keywords: Optional[List[str]], id_col: str) -> Tuple[str, List]:
+    kws = tuple(dict.fromkeys(k.strip().lower() for k in (keywords or []) if isinstance(k, str) and k.strip()))
+    if not kws:
+        return "", []
+    sql, fts_q = _kw_content_filter(kws, id_col, _FTS_OK)
+    return " AND " + sql, ([fts_q] if fts_q else []) + list(kws)
+
+
+def _msg_list_where(tag: Optional[str], status: Optional[str], keywords: Optional[List[str]] = None) -> Tuple[str, List]:
+    """WHERE clause shared by db_query_list/db_count (keywords = any of them in the content)."""
+    where = "deleted=0"
+    params: List = []
     if tag:
-        base += " AND TRIM(COALESCE(source_tag,''))=TRIM(?)"
-        params.append(tag)
+        where += " AND source_tag=?"
+        params.append(norm_key(tag))
     if status:
-        base += " AND COALESCE(status,'new')=?"
+        where += " AND status=?"
         params.append(status)
-    base += " ORDER BY id DESC LIMIT ? OFFSET ?"
-    params.extend([limit, offset])
-    cur.execute(base, tuple(params))
-    rows = cur.fetchall()
-    conn.close()
-    # strict filter: keep only messages that contain one of the section keywords in content
-    if keywords:
-        kws = [k.strip() for k in keywords if isinstance(k, str) and k.strip()]
-    else:
-        kws = []
-    if not kws:
-        return rows
-    out = []
-    for r in rows:
-        _id, uname, content, d, chat_un = r
-        c = (content or "")
-        c_low = c.lower()
-        ok = any(k.lower() in c_low for k in kws)
-        if ok:
-            out.append(r)
-    return out
+    # ✅ الفلترة في SQL (قبل الـ LIMIT) بدل loop في بايثون على كل صف
+    kw_sql, kw_params = _kw_content_where(keywords, "id")
+    return where + kw_sql, params + kw_params
 
 
-def db_count(tag: Optional[str], status: Optional[str]) -> int:
+def db_query_list(tag: Optional[str], status: Optional[str], limit: int, offset: int,
+                  keywords: Optional[List[str]] = None) -> List[Tuple]:
     conn = db_conn()
     cur = conn.cursor()
-    base = "SELECT COUNT(*) FROM messages WHERE deleted=0"
-    params = []
-    if tag:
-        base += " AND TRIM(COALESCE(source_tag,''))=TRIM(?)"
-        params.append(tag)
-    if status:
-        base += " AND COALESCE(status,'new')=?"
-        params.append(status)
-    cur.execute(base, tuple(params))
+    where, params = _msg_list_where(tag, status, keywords)
+    cur.execute(
+        f"""SELECT id, chat_username, user_id, username,
+                   COALESCE(edited_text, text) AS content,
+                   date, status, COALESCE(note,''), COALESCE(assigned_to,''),
+                   uni_subjects
+            FROM messages
+            WHERE {where}
+            ORDER BY id DESC LIMIT ? OFFSET ?""",
+        (*params, limit, offset),
+    )
+    return cur.fetchall()
+
+
+def db_count(tag: Optional[str], status: Optional[str], keywords: Optional[List[str]] = None) -> int:
+    conn = db_conn()
+    cur = conn.cursor()
+    where, params = _msg_list_where(tag, status, keywords)
+    cur.execute(f"SELECT COUNT(*) FROM messages WHERE {where}", tuple(params))
     n = cur.fetchone()[0]
-    conn.close()
     return n
 
 
+def db_count_statuses(tag: Optional[str]) -> Dict[str, int]:
+    """Counts per status for one tag in a single GROUP BY (instead of db_count x4)."""
+    conn = db_conn()
+    cur = conn.cursor()
+    where, params = _msg_list_where(tag, None)
+    cur.execute(f"SELECT status, COUNT(*) FROM messages WHERE {where} GROUP BY status", tuple(params))
+    counts = {"new": 0, "done": 0, "serving": 0, "not_served": 0}
+    for st, n in cur.fetchall():
+        counts[st] = int(n)
+    return counts
+
+
+# ✅ SQL الـ callbacks الأكتر استخدامًا كـ constants -> نفس الـ statement من الـ cache بتاع الـ connection
+_MESSAGE_COLS = """id, chat_id, chat_username, user_id,
+                  username, text, COALESCE(edited_text,''), date,
+                  status, COALESCE(note,''), COALESCE(assigned_to,''),
+                  source_tag, uni_subjects"""
+_GET_MESSAGE_SQL = f"SELECT {_MESSAGE_COLS} FROM messages WHERE id=?"
+# ✅ الـ updates بترجع الصف بعد التعديل (RETURNING) بنفس شكل db_get_message -> من غير SELECT تاني
+_SET_STATUS_SQL = f"UPDATE messages SET status=?, status_updated_at=? WHERE id=? RETURNING {_MESSAGE_COLS}"
+_SET_NOTE_SQL = f"UPDATE messages SET note=? WHERE id=? RETURNING {_MESSAGE_COLS}"
+_ASSIGN_TO_SQL = f"UPDATE messages SET assigned_to=? WHERE id=? RETURNING {_MESSAGE_COLS}"
+_EDIT_TEXT_SQL = f"UPDATE messages SET edited_text=? WHERE id=? RETURNING {_MESSAGE_COLS}"
+_REPLY_PARENT_SQL = "SELECT chat_id, tg_msg_id FROM messages WHERE id=? AND deleted=0"
+_COUNT_REPLIES_SQL = """SELECT COUNT(1)
+               FROM messages
+              WHERE deleted=0
+                AND chat_id=?
+                AND reply_to_tg_id=?"""
+
+
+EXPORT_COLUMNS = ["id", "chat_username", "user_id", "username", "content", "date",
+                  "status", "note", "assigned_to", "uni_subjects", "source_tag"]
+
+
+def iter_messages(tag: Optional[str] = None, status: Optional[str] = None):
+    """Stream rows (same filters as db_query_list) straight from the cursor — no fetchall."""
+    where, params = _msg_list_where(tag, status)
+    cur = db_conn().cursor()
+    cur.execute(
+        f"""SELECT id, chat_username, user_id, username,
+                   COALESCE(edited_text, text) AS content,
+                   date, status, COALESCE(note,''), COALESCE(assigned_to,''),
+                   uni_subjects, source_tag
+            FROM messages
+            WHERE {where}
+            ORDER BY id ASC""",
+        tuple(params),
+    )
+    yield from cur
+
+
+def export_messages_csv(path: str, tag: Optional[str] = None, status: Optional[str] = None) -> str:
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:
+        w = csv.writer(f)
+        w.writerow(EXPORT_COLUMNS)
+        w.writerows(iter_messages(tag, status))
+    return path
+
+
+_FTS_OK = False
+FTS_MIN_QUERY = 3  # trigram مبيطابقش أقل من 3 حروف
+
+
+def _fts_phrase(q: str) -> str:
+    # phrase بين "" (الـ " جوه الكلام بتتضاعف) -> أي رموز/عربي بتتعامل كنص عادي
+    return '"' + q.replace('"', '""') + '"'
+
+
+_SEARCH_COLS = """m.id, m.chat_username, m.user_id, m.username,
+              COALESCE(m.edited_text, m.text), m.date,
+              m.status, m.source_tag,
+              m.uni_subjects"""
+# نص ثابت -> نفس الـ prepared statement من cache الـ connection (cached_statements) مع كل بحث
+_SEARCH_FTS_SQL = f"""SELECT {_SEARCH_COLS}
+                        FROM messages_fts f JOIN messages m ON m.id = f.rowid
+                       WHERE messages_fts MATCH ? AND m.deleted=0
+                       ORDER BY m.id DESC LIMIT ?"""
+_SEARCH_LIKE_SQL = f"""SELECT {_SEARCH_COLS}
+                         FROM messages m
+                        WHERE m.deleted=0 AND (m.text LIKE ?1 ESCAPE '\\' OR m.edited_text LIKE ?1 ESCAPE '\\')
+                        ORDER BY m.id DESC LIMIT ?2"""
+
+
+def db_search_messages(q: str, limit: int = 10) -> List[Tuple]:
+    """Newest messages whose text/edited_text contains q:
+    id, chat_username, user_id, username, text, date, status, source_tag, uni_subjects
+    """
+    conn = db_conn()
+    cur = conn.cursor()
+    if _FTS_OK and len(q) >= FTS_MIN_QUERY:
+        cur.execute(_SEARCH_FTS_SQL, (_fts_phrase(q), int(limit)))
+    else:
+        # الـ pattern بيتبني مرة واحدة، و % / _ اللي في كلام المستخدم حروف عادية مش wildcards
+        pat = "%" + q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        cur.execute(_SEARCH_LIKE_SQL, (pat, int(limit)))
+    return cur.fetchall()
+
+
 def db_get_message(msg_id: int):
     """Return:
     id, chat_id, chat_username, user_id, username, text, edited_text, date,
@@ -538,58 +1050,89 @@ def db_get_message(msg_id: int):
     """
     conn = db_conn()
     cur = conn.cursor()
-    cur.execute(
-        """SELECT id, COALESCE(chat_id,0), COALESCE(chat_username,''), COALESCE(user_id,0),
-                  COALESCE(username,''), COALESCE(text,''), COALESCE(edited_text,''), COALESCE(date,''),
-                  COALESCE(status,'new'), COALESCE(note,''), COALESCE(assigned_to,''),
-                  COALESCE(source_tag,''), COALESCE(uni_subjects,'')
-           FROM messages WHERE id=?""",
-        (msg_id,),
-    )
+    cur.execute(_GET_MESSAGE_SQL, (msg_id,))
     row = cur.fetchone()
-    conn.close()
     return row
 
 
 
+# ✅ COUNTs الكبيرة (سكشنات/ردود) بتتحسب مع كل ضغطة -> cache بـ TTL قصير
+# الـ listener بيضيف رسايل من process تانية -> الـ TTL هو اللي بيحدّث؛ الحذف/التعديل هنا بيمسح الـ cache
+COUNT_CACHE_TTL_SEC = 30.0
+COUNT_CACHE_MIN = 1000  # أقل من كده الـ COUNT رخيص أصلًا ومش بيتخزن
+_COUNT_CACHE: Dict[Tuple, Tuple[float, int]] = {}
+
+
+def _cached_count(key: Tuple, count_fn) -> int:
+    hit = _COUNT_CACHE.get(key)
+    if hit is not None and time.monotonic() - hit[0] < COUNT_CACHE_TTL_SEC:
+        return hit[1]
+    n = count_fn()
+    if n >= COUNT_CACHE_MIN:
+        if len(_COUNT_CACHE) >= 4096:
+            _COUNT_CACHE.clear()
+        _COUNT_CACHE[key] = (time.monotonic(), n)
+    else:
+        _COUNT_CACHE.pop(key, None)
+    return n
+
+
+def invalidate_counts():
+    _COUNT_CACHE.clear()
+
+
 def db_count_direct_replies(parent_id: int) -> int:
     """Count direct replies using reply_to_tg_id linkage (threaded)."""
+    return _cached_count(("replies", int(parent_id)), lambda: _db_count_direct_replies(parent_id))
+
+
+def db_count_direct_replies_bulk(parent_ids: List[int]) -> Dict[int, int]:
+    """{parent msg id: direct replies} for a whole page in one grouped query (instead of N+1)."""
+    ids = list(dict.fromkeys(int(i) for i in parent_ids))
+    if not ids:
+        return {}
+    conn = db_conn()
+    cur = conn.cursor()
+    # tg_msg_id مش unique غير جوه نفس الـ chat -> الربط بـ (chat_id, tg_msg_id) زي db_count_direct_replies
+    cur.execute(
+        f"""SELECT p.id, COUNT(r.id)
+              FROM messages p
+              JOIN messages r
+                ON r.deleted=0 AND r.chat_id=p.chat_id AND r.reply_to_tg_id=p.tg_msg_id
+             WHERE p.id IN ({",".join("?" * len(ids))}) AND p.deleted=0
+             GROUP BY p.id""",
+        ids,
+    )
+    return {int(pid): int(n) for pid, n in cur.fetchall()}
+
+
+def _db_count_direct_replies(parent_id: int) -> int:
     conn = db_conn()
     cur = conn.cursor()
-    cur.execute("SELECT chat_id, tg_msg_id FROM messages WHERE id=? AND deleted=0", (int(parent_id),))
+    cur.execute(_REPLY_PARENT_SQL, (int(parent_id),))
     row = cur.fetchone()
     if not row or row[1] is None:
-        conn.close()
         return 0
     chat_id, parent_tg = row[0], row[1]
-    cur.execute(
-        """SELECT COUNT(1)
-               FROM messages
-              WHERE deleted=0
-                AND chat_id=?
-                AND reply_to_tg_id=?""",
-        (chat_id, int(parent_tg)),
-    )
+    cur.execute(_COUNT_REPLIES_SQL, (chat_id, int(parent_tg)))
     n = cur.fetchone()[0] or 0
-    conn.close()
     return int(n)
 
 def db_list_direct_replies(parent_id: int, limit: int = 10, offset: int = 0):
     """List direct replies for a message, ordered oldest→newest."""
     conn = db_conn()
     cur = conn.cursor()
-    cur.execute("SELECT chat_id, tg_msg_id FROM messages WHERE id=? AND deleted=0", (int(parent_id),))
+    cur.execute(_REPLY_PARENT_SQL, (int(parent_id),))
     row = cur.fetchone()
     if not row or row[1] is None:
-        conn.close()
         return []
     chat_id, parent_tg = row[0], row[1]
     cur.execute(
         """SELECT id,
-                    COALESCE(username,'') AS username,
+                    username,
                     COALESCE(edited_text, text) AS content,
-                    COALESCE(date,'') AS date,
-                    COALESCE(chat_username,'') AS chat_username
+                    date,
+                    chat_username
              FROM messages
              WHERE deleted=0
                AND chat_id=?
@@ -599,53 +1142,115 @@ def db_list_direct_replies(parent_id: int, limit: int = 10, offset: int = 0):
         (chat_id, int(parent_tg), int(limit), int(offset)),
     )
     rows = cur.fetchall()
-    conn.close()
     return rows
 
+
+def db_list_direct_replies_keyset(parent_id: int, limit: int, cursor_id: Optional[int], older: bool = False):
+    """Replies after cursor_id (or before it, for ⬅️); always returned oldest→newest."""
+    conn = db_conn()
+    cur = conn.cursor()
+    cur.execute(_REPLY_PARENT_SQL, (int(parent_id),))
+    row = cur.fetchone()
+    if not row or row[1] is None:
+        return []
+    where = "deleted=0 AND chat_id=? AND reply_to_tg_id=?"
+    params: List = [row[0], int(row[1])]
+    order = "ASC"
+    if cursor_id is not None:
+        # ✅ id > ? بدل OFFSET (idx_msg_chat_reply فيه الـ id ضمنيًا)
+        where += " AND id < ?" if older else " AND id > ?"
+        params.append(int(cursor_id))
+        if older:
+            order = "DESC"
+    cur.execute(
+        f"""SELECT id,
+                    username,
+                    COALESCE(edited_text, text) AS content,
+                    date,
+                    chat_username
+             FROM messages
+             WHERE {where}
+             ORDER BY id {order}
+             LIMIT ?""",
+        (*params, int(limit)),
+    )
+    rows = cur.fetchall()
+    if order == "DESC":
+        rows.reverse()
+    return rows
+
+
+# نفس html.escape(quote=True) بس في pass واحد (str.translate)
+_HTML_ESC = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"})
+
+
+def _esc(s) -> str:
+    """html.escape(str(s)) via the translate table (used in the list/detail renderers)."""
+    return str(s).translate(_HTML_ESC)
+
+
+@functools.lru_cache(maxsize=2048)
+def _snip(content: str, n: int, oneline: bool = True) -> str:
+    """Strip + truncate to n chars (cached by the content itself, so edits get a new key)."""
+    s = content.strip()
+    if oneline:
+        s = s.replace("\n", " ")
+    if len(s) <= n:
+        return s
+    # ما نقطعش بين حرف والتشكيل بتاعه (combining marks) -> نرجع لبداية الحرف
+    i = n - 1
+    while i > 0 and unicodedata.combining(s[i]):
+        i -= 1
+    return s[:i] + "…"
+
+
+_CARD_SEP = "\n\n────────\n\n"  # الفاصل بين الكروت في sec:msgs / thr:
+
+
+# ✅ نفس الكروت بتترسم تاني مع كل رجوع/تقليب صفحات -> cache؛ المحتوى نفسه جزء من الـ key
+# فالتعديل (edited_text) بيدّي كارت جديد لوحده من غير invalidate
+@functools.lru_cache(maxsize=4096)
 def render_message_card(msg_id: int, username: str, date_str: str, content: str, max_chars: int = 420) -> str:
     """Render a compact card for lists (safe for Telegram HTML)."""
     uname = (username or '').strip()
-    user_part = html.escape(uname) if uname else "—"
-    dt_part = html.escape((date_str or '').replace('T', ' ').replace('+00:00', ''))
-    text = (content or '').strip()
-    if len(text) > max_chars:
-        text = text[: max_chars - 1] + "…"
-    text = html.escape(text)
+    user_part = uname.translate(_HTML_ESC) if uname else "—"
+    # date = ISO اللي bot.py بيكتبه (utc_now().isoformat()) -> مفيهوش حروف HTML، مش محتاج escape
+    dt_part = (date_str or '').replace('T', ' ').replace('+00:00', '')
+    text = _snip(content or '', max_chars, False).translate(_HTML_ESC)
     return f"<b>#{msg_id}</b>\n📅 {dt_part} | 👤 {user_part}\n📝 {text}"
 
 def db_get_nearby_replies(msg_id: int, window_minutes: int, limit: int) -> List[Tuple[int, str, str, str]]:
     """Heuristic replies: same chat_id, messages AFTER the question within time window."""
-    row = db_get_message(msg_id)
+    conn = db_conn()
+    cur = conn.cursor()
+    # بس العمودين اللي محتاجينهم (مش الصف كله زي db_get_message)
+    cur.execute("SELECT chat_id, date FROM messages WHERE id=?", (msg_id,))
+    row = cur.fetchone()
     if not row:
         return []
-    _, chat_id, _, _, _, _, _, date_iso, *_ = row
+    chat_id, start_iso = row
+    # الـ ISO المتخزن بيتقارن lexically -> نستخدمه زي ما هو كـ bound، ونحسب النهاية بس
     try:
-        dt0 = datetime.fromisoformat(str(date_iso))
+        end_iso = (datetime.fromisoformat(start_iso) + timedelta(minutes=int(window_minutes))).isoformat()
     except Exception:
         return []
-    dt1 = dt0 + timedelta(minutes=int(window_minutes))
-    start_iso = dt0.isoformat()
-    end_iso = dt1.isoformat()
 
-    conn = db_conn()
-    cur = conn.cursor()
     cur.execute(
         """SELECT id,
-                  COALESCE(username,'') AS username,
+                  username,
                   COALESCE(edited_text, text, '') AS content,
-                  COALESCE(date,'') AS date
+                  date
            FROM messages
            WHERE deleted=0
-             AND COALESCE(chat_id,0)=?
-             AND COALESCE(date,'') > ?
-             AND COALESCE(date,'') <= ?
+             AND chat_id=?
+             AND date > ?
+             AND date <= ?
              AND id != ?
-           ORDER BY COALESCE(date,'') ASC
+           ORDER BY date ASC
            LIMIT ?""",
         (int(chat_id), start_iso, end_iso, int(msg_id), int(limit)),
     )
     rows = cur.fetchall()
-    conn.close()
     out: List[Tuple[int, str, str, str]] = []
     for rid, runame, rtext, rdate in rows:
         out.append((int(rid), str(runame or ""), str(rtext or ""), str(rdate or "")))
@@ -656,135 +1261,189 @@ def db_get_nearby_replies(msg_id: int, window_minutes: int, limit: int) -> List[
 def db_delete_message(msg_id: int):
     conn = db_conn()
     cur = conn.cursor()
-    cur.execute("DELETE FROM messages WHERE id=?", (msg_id,))
-    conn.commit()
-    conn.close()
+    with conn:
+        cur.execute("DELETE FROM messages WHERE id=?", (msg_id,))
+    invalidate_counts()
+    invalidate_section_windows()
 
 
-def db_edit_message(msg_id: int, new_text: str):
+def _update_returning(sql: str, params: Tuple):
+    """Run an UPDATE ... RETURNING and return the updated row (None if the id is gone)."""
     conn = db_conn()
     cur = conn.cursor()
-    cur.execute("UPDATE messages SET edited_text=? WHERE id=?", (new_text, msg_id))
-    conn.commit()
-    conn.close()
+    with conn:
+        cur.execute(sql, params)
+        row = cur.fetchone()
+    return row
+
+
+def db_edit_message(msg_id: int, new_text: str):
+    row = _update_returning(_EDIT_TEXT_SQL, (new_text, msg_id))
+    invalidate_counts()  # الـ keyword filter بتاع السكشنات بيقرا النص المتعدّل
+    invalidate_section_windows()
+    return row
 
 
 def db_block_user(user_id: int):
     conn = db_conn()
     cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO blocked_users(user_id) VALUES(?)", (user_id,))
-    conn.commit()
-    conn.close()
+    with conn:
+        cur.execute("INSERT OR IGNORE INTO blocked_users(user_id) VALUES(?)", (user_id,))
 
 
 def db_is_approved(user_id: int) -> bool:
+    hit = _APPROVED_CACHE.get(user_id)
+    if hit is not None and time.monotonic() - hit[0] < AUTH_CACHE_TTL_SEC:
+        return hit[1]
     conn = db_conn()
     cur = conn.cursor()
     cur.execute("SELECT 1 FROM approved_viewers WHERE user_id=?", (user_id,))
     ok = cur.fetchone() is not None
-    conn.close()
+    _auth_cache_put(_APPROVED_CACHE, user_id, ok)
     return ok
 
 
 def db_approve(user_id: int):
     conn = db_conn()
     cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO approved_viewers(user_id) VALUES(?)", (user_id,))
-    cur.execute("INSERT OR REPLACE INTO roles(user_id, role) VALUES(?, 'admin')", (user_id,))
-    conn.commit()
-    conn.close()
+    with conn:
+        cur.execute("INSERT OR IGNORE INTO approved_viewers(user_id) VALUES(?)", (user_id,))
+        cur.execute("INSERT OR REPLACE INTO roles(user_id, role) VALUES(?, 'admin')", (user_id,))
+    _ROLE_CACHE.pop(user_id, None)
+    _APPROVED_CACHE.pop(user_id, None)
 
 
 def db_set_status(msg_id: int, status: str):
-    conn = db_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE messages SET status=?, status_updated_at=? WHERE id=?", (status, datetime.utcnow().isoformat(), msg_id))
-    conn.commit()
-    conn.close()
+    return _update_returning(_SET_STATUS_SQL, (status, datetime.utcnow().isoformat(), msg_id))
 
 
 def db_set_note(msg_id: int, note: str):
-    conn = db_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE messages SET note=? WHERE id=?", (note, msg_id))
-    conn.commit()
-    conn.close()
+    return _update_returning(_SET_NOTE_SQL, (note, msg_id))
 
 
 def db_assign_to(msg_id: int, uid: int):
-    conn = db_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE messages SET assigned_to=? WHERE id=?", (uid, msg_id))
-    conn.commit()
-    conn.close()
+    return _update_returning(_ASSIGN_TO_SQL, (uid, msg_id))
+
+
+@functools.lru_cache(maxsize=8192)
+def _json_list_cached(raw: str) -> Tuple:
+    try:
+        data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    except Exception:
+        return ()
+    return tuple(data) if isinstance(data, list) else ()
+
+
+def json_list(raw: Optional[str]) -> List:
+    """JSON array column (uni_subjects / keywords_json) -> list; anything invalid -> [].
+
+    ✅ نفس الـ JSON بيتفك مع كل view/بحث/صفحة -> الـ parse متكاش بالنص نفسه (نسخة list جديدة لكل caller)
+    """
+    return list(_json_list_cached(raw)) if raw else []
 
 
 def db_get_subjects(msg_id: int) -> List[str]:
     row = db_get_message(msg_id)
     if not row:
         return []
-    uni_json = row[-1]
-    if not uni_json:
-        return []
-    try:
-        data = json.loads(uni_json)
-        if isinstance(data, list):
-            return [s for s in data if isinstance(s, str) and s.strip()]
-        return []
-    except Exception:
-        return []
+    return [s for s in json_list(row[-1]) if isinstance(s, str) and s.strip()]
 
 
 # -----------------------
 # Manual sections (uni_sections) helpers
 # -----------------------
 def db_list_sections(uni_tag: str) -> List[Tuple[int, str, List[str], int]]:
-    """FIX: TRIM + normalize uni_tag so sections always show even if extra spaces."""
+    """uni_tag is normalized with norm_key (stored keys are trimmed in db_init)."""
     uni_tag = norm_key(uni_tag)
     conn = db_conn()
     cur = conn.cursor()
     cur.execute(
-        """SELECT id, section_name, keywords_json, COALESCE(enabled,1)
-           FROM uni_sections
-           WHERE TRIM(uni_tag)=TRIM(?)
-           ORDER BY id DESC""",
+        """SELECT s.id, s.section_name, COALESCE(s.enabled,1), k.kw
+           FROM uni_sections s
+           LEFT JOIN section_keywords k ON k.section_id=s.id
+           WHERE s.uni_tag=?
+           ORDER BY s.id DESC, k.pos""",
         (uni_tag,),
     )
-    rows = cur.fetchall()
-    conn.close()
     out = []
-    for sid, sname, kws_json, enabled in rows:
-        try:
-            kws = json.loads(kws_json or "[]")
-            if not isinstance(kws, list):
-                kws = []
-        except Exception:
-            kws = []
-        kws = [norm_key(str(k)) for k in kws if norm_key(str(k))]
-        out.append((int(sid), str(sname), kws, int(enabled or 0)))
+    last_sid = None
+    for sid, sname, enabled, kw in cur.fetchall():
+        if sid != last_sid:
+            out.append((int(sid), str(sname), [], int(enabled or 0)))
+            last_sid = sid
+        kw = norm_key(kw) if kw else ""
+        if kw:
+            out[-1][2].append(kw)
     return out
 
 
+def db_list_sections_page(uni_tag: str, limit: int, offset: int) -> Tuple[List[Tuple[int, str, List[str], int]], int]:
+    """Like db_list_sections but only one page of sections (+ total count)."""
+    uni_tag = norm_key(uni_tag)
+    conn = db_conn()
+    cur = conn.cursor()
+    cur.execute(
+        """WITH page AS (
+               SELECT id, section_name, COALESCE(enabled,1) AS enabled, COUNT(*) OVER() AS total
+                 FROM uni_sections
+                WHERE uni_tag=?
+                ORDER BY id DESC
+                LIMIT ? OFFSET ?
+           )
+           SELECT p.id, p.section_name, p.enabled, p.total, k.kw
+             FROM page p
+             LEFT JOIN section_keywords k ON k.section_id=p.id
+            ORDER BY p.id DESC, k.pos""",
+        (uni_tag, int(limit), int(offset)),
+    )
+    out = []
+    total = 0
+    last_sid = None
+    for sid, sname, enabled, total, kw in cur.fetchall():
+        if sid != last_sid:
+            out.append((int(sid), str(sname), [], int(enabled or 0)))
+            last_sid = sid
+        kw = norm_key(kw) if kw else ""
+        if kw:
+            out[-1][2].append(kw)
+    if not out and offset > 0:
+        cur.execute("SELECT COUNT(*) FROM uni_sections WHERE uni_tag=?", (uni_tag,))
+        total = cur.fetchone()[0] or 0
+    return out, int(total)
+
+
+# ✅ السكشن (بكلماته من section_keywords) بيتقري مع كل ضغطة view/msgs/تقليب صفحة -> cache بالـ id
+# بيتمسح مع تعديل/rename/delete السكشن ومع أي تعديل في groups (_invalidate_tags_cache)
+_SECTION_CACHE: Dict[int, Tuple[int, str, str, List[str], int]] = {}
+
+
 def db_get_section(section_id: int) -> Optional[Tuple[int, str, str, List[str], int]]:
+    """(id, uni_tag, section_name, keywords, enabled); keywords already decoded from section_keywords."""
+    sid = int(section_id)
+    row = _SECTION_CACHE.get(sid)
+    if row is None:
+        row = _db_get_section(sid)
+        if row is not None:
+            if len(_SECTION_CACHE) >= 512:
+                _SECTION_CACHE.clear()
+            _SECTION_CACHE[sid] = row
+    return row
+
+
+def _db_get_section(section_id: int) -> Optional[Tuple[int, str, str, List[str], int]]:
     conn = db_conn()
     cur = conn.cursor()
     cur.execute(
-        """SELECT id, uni_tag, section_name, keywords_json, COALESCE(enabled,1)
+        """SELECT id, uni_tag, section_name, COALESCE(enabled,1)
            FROM uni_sections WHERE id=?""",
         (section_id,),
     )
     row = cur.fetchone()
-    conn.close()
     if not row:
         return None
-    sid, uni_tag, sname, kws_json, enabled = row
-    try:
-        kws = json.loads(kws_json or "[]")
-        if not isinstance(kws, list):
-            kws = []
-    except Exception:
-        kws = []
-    kws = [norm_key(str(k)) for k in kws if norm_key(str(k))]
+    sid, uni_tag, sname, enabled = row
+    cur.execute("SELECT kw FROM section_keywords WHERE section_id=? ORDER BY pos", (sid,))
+    kws = [k for (kw,) in cur.fetchall() if (k := norm_key(kw))]
     return (int(sid), str(uni_tag), str(sname), kws, int(enabled or 0))
 
 
@@ -795,38 +1454,68 @@ def db_add_section(uni_tag: str, section_name: str, keywords: List[str]) -> Tupl
 
     if not section_name:
         return False, "اسم السكشن فارغ."
-    keywords = [norm_key(str(k)) for k in (keywords or []) if norm_key(str(k))]
+    keywords = [nk for k in (keywords or []) if (nk := norm_key(str(k)))]
     if not keywords:
         return False, "لازم تضيف كلمات مفتاحية على الأقل."
     now = datetime.utcnow().isoformat()
     conn = db_conn()
     cur = conn.cursor()
     try:
-        cur.execute(
-            """INSERT INTO uni_sections(uni_tag, section_name, keywords_json, enabled, created_at, updated_at)
-               VALUES(?,?,?,?,?,?)""",
-            (uni_tag, section_name, json.dumps(keywords, ensure_ascii=False), 1, now, now),
-        )
-        conn.commit()
-        conn.close()
-        return True, "تمت إضافة السكشن."
+        with conn:
+            cur.execute(
+                """INSERT INTO uni_sections(uni_tag, section_name, keywords_json, enabled, created_at, updated_at)
+                   VALUES(?,?,?,?,?,?)""",
+                (uni_tag, section_name, json.dumps(keywords, ensure_ascii=False), 1, now, now),
+            )
     except sqlite3.IntegrityError:
-        conn.close()
         return False, "السكشن موجود بالفعل بنفس الاسم لهذه الجامعة."
+    invalidate_counts()
+    invalidate_section_windows()
+    build_sections_list_kb.cache_clear()
+    return True, "تمت إضافة السكشن."
+
+
+def db_add_sections_bulk(uni_tags: List[str], section_name: str, keywords: List[str]) -> int:
+    """Same section for many universities in one transaction; returns how many were added.
+
+    اللي موجود بالفعل بنفس الاسم بيتساب زي db_add_section (OR IGNORE مش REPLACE عشان الـ id والكلمات ما يتمسحوش).
+    """
+    section_name = norm_key(section_name)
+    keywords = [nk for k in (keywords or []) if (nk := norm_key(str(k)))]
+    tags = [t for u in uni_tags if (t := norm_key(u))]
+    if not section_name or not keywords or not tags:
+        return 0
+    now = datetime.utcnow().isoformat()
+    kws_json = json.dumps(keywords, ensure_ascii=False)
+    conn = db_conn()
+    cur = conn.cursor()
+    with conn:
+        cur.executemany(
+            """INSERT OR IGNORE INTO uni_sections(uni_tag, section_name, keywords_json, enabled, created_at, updated_at)
+               VALUES(?,?,?,?,?,?)""",
+            [(t, section_name, kws_json, 1, now, now) for t in dict.fromkeys(tags)],
+        )
+        added = cur.rowcount
+    if added:
+        invalidate_counts()
+        invalidate_section_windows()
+        build_sections_list_kb.cache_clear()
+    return max(0, added)
 
 
 def db_update_section_keywords(section_id: int, keywords: List[str]) -> Tuple[bool, str]:
-    keywords = [norm_key(str(k)) for k in (keywords or []) if norm_key(str(k))]
+    keywords = [nk for k in (keywords or []) if (nk := norm_key(str(k)))]
     if not keywords:
         return False, "لازم تضيف كلمات مفتاحية على الأقل."
     conn = db_conn()
     cur = conn.cursor()
-    cur.execute(
-        """UPDATE uni_sections SET keywords_json=?, updated_at=? WHERE id=?""",
-        (json.dumps(keywords, ensure_ascii=False), datetime.utcnow().isoformat(), section_id),
-    )
-    conn.commit()
-    conn.close()
+    with conn:
+        cur.execute(
+            """UPDATE uni_sections SET keywords_json=?, updated_at=? WHERE id=?""",
+            (json.dumps(keywords, ensure_ascii=False), datetime.utcnow().isoformat(), section_id),
+        )
+    _SECTION_CACHE.pop(int(section_id), None)
+    build_sections_list_kb.cache_clear()  # الاسم/عدد الكلمات بيظهروا في القايمة
     return True, "تم تحديث الكلمات."
 
 
@@ -840,21 +1529,22 @@ def db_rename_section(section_id: int, new_name: str) -> Tuple[bool, str]:
     conn = db_conn()
     cur = conn.cursor()
     try:
-        cur.execute("""UPDATE uni_sections SET section_name=?, updated_at=? WHERE id=?""", (new_name, datetime.utcnow().isoformat(), section_id))
-        conn.commit()
-        conn.close()
-        return True, "تم تغيير الاسم."
+        with conn:
+            cur.execute("""UPDATE uni_sections SET section_name=?, updated_at=? WHERE id=?""", (new_name, datetime.utcnow().isoformat(), section_id))
     except sqlite3.IntegrityError:
-        conn.close()
         return False, "يوجد سكشن آخر بنفس الاسم في هذه الجامعة."
+    _SECTION_CACHE.pop(int(section_id), None)
+    build_sections_list_kb.cache_clear()  # الاسم/عدد الكلمات بيظهروا في القايمة
+    return True, "تم تغيير الاسم."
 
 
 def db_delete_section(section_id: int) -> bool:
     conn = db_conn()
     cur = conn.cursor()
-    cur.execute("DELETE FROM uni_sections WHERE id=?", (section_id,))
-    conn.commit()
-    conn.close()
+    with conn:
+        cur.execute("DELETE FROM uni_sections WHERE id=?", (section_id,))
+    _SECTION_CACHE.pop(int(section_id), None)
+    build_sections_list_kb.cache_clear()  # الاسم/عدد الكلمات بيظهروا في القايمة
     return True
 
 
@@ -889,11 +1579,12 @@ def render_user_display(u: str) -> str:
 
 
 def short_snip(s: str, n: int = 220) -> str:
-    s = (s or "").strip()
-    s = s.replace("\n", " ")
-    if len(s) <= n:
-        return s
-    return s[: n - 1] + "…"
+    return _snip(s or "", n)
+
+
+@functools.lru_cache(maxsize=512)
+def _subj_label(subj: str) -> str:
+    return f"📚 {subj if len(subj) <= 20 else subj[:17] + '…'}"
 
 
 def build_item_kb(msg_id: int, user_id: int, uni_subjects: Optional[List[str]] = None):
@@ -915,17 +1606,14 @@ def build_item_kb(msg_id: int, user_id: int, uni_subjects: Optional[List[str]] =
     rows = [row_status, row_view, row_edit_del, row_note_assign]
 
     if uni_subjects:
-        subj_buttons = []
-        for i, subj in enumerate(uni_subjects):
-            label = subj
-            if len(label) > 20:
-                label = label[:17] + "…"
-            subj_buttons.append(InlineKeyboardButton(f"📚 {label}", callback_data=f"subj:{msg_id}:{i}"))
-        if len(subj_buttons) <= 3:
-            rows.append(subj_buttons)
-        else:
-            rows.append(subj_buttons[:3])
-            rows.append(subj_buttons[3:6])
+        # بس أول 6 مواد بيظهروا (صفين × 3) -> مانبنيش buttons للباقي
+        subj_buttons = [
+            InlineKeyboardButton(_subj_label(subj), callback_data=f"subj:{msg_id}:{i}")
+            for i, subj in enumerate(uni_subjects[:6])
+        ]
+        rows.append(subj_buttons[:3])
+        if len(subj_buttons) > 3:
+            rows.append(subj_buttons[3:])
 
     row_block = [InlineKeyboardButton("⛔ حذف+حظر", callback_data=f"block_del:{msg_id}:{user_id}")]
     rows.append(row_block)
@@ -944,12 +1632,20 @@ def build_nav_kb(tag: Optional[str], status: Optional[str], offset: int, total:
     rows = []
     if row:
         rows.append(row)
-    rows.append([InlineKeyboardButton("🏠 القائمة", callback_data="home")])
+    rows.append([_HOME_BTN])
     return InlineKeyboardMarkup(rows)
 
 
-def build_main_menu_kb():
-    rows = [
+# ✅ أزرار ثابتة بتتكرر في كل الـ keyboards -> instance واحدة بدل ما تتبني مع كل render
+_HOME_BTN = InlineKeyboardButton("🏠 القائمة", callback_data="home")
+_BACK_TO_SECTIONS_BTN = InlineKeyboardButton("🔙 رجوع", callback_data="menu:sections:0")
+_BACK_TO_UNISOURCES_BTN = InlineKeyboardButton("🔙 رجوع", callback_data="menu:unisources:0")
+_BACK_TO_GROUPS_MANAGE_BTN = InlineKeyboardButton("🔙 رجوع", callback_data="menu:groups_manage:0")
+_BACK_TO_GROUPS_BTN = InlineKeyboardButton("🔙 رجوع للقروبات", callback_data="menu:groups:0")
+
+# ✅ المنيو الرئيسية ثابتة -> تتبني مرة واحدة وقت الـ import
+_MAIN_MENU_KB = InlineKeyboardMarkup(
+    [
         [InlineKeyboardButton("📥 الوارد", callback_data="menu:inbox"), InlineKeyboardButton("🔎 بحث", callback_data="menu:search")],
         [
             InlineKeyboardButton("🆕 جديد", callback_data="menu:filter:new"),
@@ -962,11 +1658,15 @@ def build_main_menu_kb():
         [InlineKeyboardButton("🧩 إدارة القروبات", callback_data="menu:groups_manage:0")],
         [InlineKeyboardButton("📊 إحصاءات", callback_data="menu:stats"), InlineKeyboardButton("⬇️ تصدير CSV", callback_data="menu:export")],
     ]
-    return InlineKeyboardMarkup(rows)
+)
+
+
+def build_main_menu_kb():
+    return _MAIN_MENU_KB
 
 
 def build_groups_menu_kb(offset: int = 0, page_size: int = 8):
-    tags = sorted(list(dict.fromkeys(supported_tags())))
+    tags = sorted_tags()
     total = len(tags)
     end = min(offset + page_size, total)
     page = tags[offset:end]
@@ -981,17 +1681,17 @@ def build_groups_menu_kb(offset: int = 0, page_size: int = 8):
         nav.append(InlineKeyboardButton("➡️ التالي", callback_data=f"menu:groups:{end}"))
     if nav:
         rows.append(nav)
-    rows.append([InlineKeyboardButton("🏠 القائمة", callback_data="home")])
+    rows.append([_HOME_BTN])
     return InlineKeyboardMarkup(rows)
 
 
 def build_group_status_kb(display_name: str) -> InlineKeyboardMarkup:
     tag = resolve_tag(display_name)
-    counts = {"new": db_count(tag, "new"), "done": db_count(tag, "done"), "serving": db_count(tag, "serving"), "not_served": db_count(tag, "not_served")}
+    counts = db_count_statuses(tag)
     rows = [
         [InlineKeyboardButton(f"🆕 جديد ({counts['new']})", callback_data=f"gfilter:{display_name}:new:0"), InlineKeyboardButton(f"✅ تم ({counts['done']})", callback_data=f"gfilter:{display_name}:done:0")],
         [InlineKeyboardButton(f"⏳ جاري ({counts['serving']})", callback_data=f"gfilter:{display_name}:serving:0"), InlineKeyboardButton(f"❌ لم يتم ({counts['not_served']})", callback_data=f"gfilter:{display_name}:not_served:0")],
-        [InlineKeyboardButton("🔙 رجوع للقروبات", callback_data="menu:groups:0")],
+        [_BACK_TO_GROUPS_BTN],
     ]
     return InlineKeyboardMarkup(rows)
 
@@ -999,11 +1699,12 @@ def build_group_status_kb(display_name: str) -> InlineKeyboardMarkup:
 # -----------------------
 # Groups management UI
 # -----------------------
+# ✅ الكيبوردات دي بتتبني مع كل انتقال بنفس الـ args -> lru_cache (الـ markup مش بيتعدل بعد ما يتبني)
+# اللي بيقروا من الـ DB (قايمة القروبات/السكشنات) بيتمسحوا مع أي تعديل (_invalidate_tags_cache / دوال السكشنات)
+@functools.lru_cache(maxsize=256)
 def build_groups_manage_kb(offset: int = 0, page_size: int = 8) -> InlineKeyboardMarkup:
-    gs = db_list_groups()
-    total = len(gs)
-    end = min(offset + page_size, total)
-    page = gs[offset:end]
+    page, total = db_list_groups_page(page_size, offset)
+    end = offset + len(page)
     rows: List[List[InlineKeyboardButton]] = []
     for gid, name in page:
         rows.append([InlineKeyboardButton(f"🏛️ {name}", callback_data=f"grp:view:{gid}")])
@@ -1015,10 +1716,11 @@ def build_groups_manage_kb(offset: int = 0, page_size: int = 8) -> InlineKeyboar
     if nav:
         rows.append(nav)
     rows.append([InlineKeyboardButton("➕ إضافة قروب", callback_data="grp:add")])
-    rows.append([InlineKeyboardButton("🏠 القائمة", callback_data="home")])
+    rows.append([_HOME_BTN])
     return InlineKeyboardMarkup(rows)
 
 
+@functools.lru_cache(maxsize=256)
 def build_group_detail_kb(gid: int) -> InlineKeyboardMarkup:
     rows = [
         [InlineKeyboardButton("✏️ تغيير الاسم", callback_data=f"grp:edit:name:{gid}"), InlineKeyboardButton("✏️ تغيير chat", callback_data=f"grp:edit:chat:{gid}")],
@@ -1027,11 +1729,12 @@ def build_group_detail_kb(gid: int) -> InlineKeyboardMarkup:
         [InlineKeyboardButton("📎 تبديل المرفقات", callback_data=f"grp:toggle:attachments_enabled:{gid}"), InlineKeyboardButton("🚀 تبديل الإرسال", callback_data=f"grp:toggle:send_enabled:{gid}")],
         [InlineKeyboardButton("🎯 subjects_only", callback_data=f"grp:toggle:subjects_only:{gid}")],
         [InlineKeyboardButton("🗑 حذف القروب", callback_data=f"grp:del:{gid}")],
-        [InlineKeyboardButton("🔙 رجوع", callback_data="menu:groups_manage:0")],
+        [_BACK_TO_GROUPS_MANAGE_BTN],
     ]
     return InlineKeyboardMarkup(rows)
 
 
+@functools.lru_cache(maxsize=256)
 def build_group_delete_confirm_kb(gid: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([[InlineKeyboardButton("✅ تأكيد الحذف", callback_data=f"grp:delc:{gid}"), InlineKeyboardButton("❌ إلغاء", callback_data=f"grp:view:{gid}")]])
 
@@ -1039,26 +1742,20 @@ def build_group_delete_confirm_kb(gid: int) -> InlineKeyboardMarkup:
 # -----------------------
 # Sections UI
 # -----------------------
+_KW_SPLIT_RE = re.compile(r"[,\n،;؛]+")
+
+
 def parse_keywords_input(text: str) -> List[str]:
     """FIX: support Arabic comma (،) + semicolons."""
     if not text:
         return []
-    parts = re.split(r"[,\n،;؛]+", text)
-    kws = [norm_key(p) for p in parts if norm_key(p)]
-    seen = set()
-    out = []
-    for k in kws:
-        if k not in seen:
-            seen.add(k)
-            out.append(k)
-    return out
+    # مرتبة + من غير تكرار، و norm_key مرة واحدة لكل جزء
+    return list(dict.fromkeys(k for p in _KW_SPLIT_RE.split(text) if (k := norm_key(p))))
 
 
 def build_universities_kb(offset: int = 0, page_size: int = 8) -> InlineKeyboardMarkup:
-    unis = db_list_universities()
-    total = len(unis)
-    end = min(offset + page_size, total)
-    page = unis[offset:end]
+    page, total = db_list_universities_page(page_size, offset)
+    end = offset + len(page)
     rows = []
     for gid, uni_tag, cnt in page:
         extra = f" ({cnt})" if cnt > 1 else ""
@@ -1071,7 +1768,7 @@ def build_universities_kb(offset: int = 0, page_size: int = 8) -> InlineKeyboard
     if nav:
         rows.append(nav)
     rows.append([InlineKeyboardButton("➕ إضافة مادة لكل الجامعات", callback_data="sec:add_all")])
-    rows.append([InlineKeyboardButton("🏠 القائمة", callback_data="home")])
+    rows.append([_HOME_BTN])
     return InlineKeyboardMarkup(rows)
 
 
@@ -1080,10 +1777,8 @@ def build_universities_kb(offset: int = 0, page_size: int = 8) -> InlineKeyboard
 # -----------------------
 def build_unisources_kb(offset: int = 0, page_size: int = 8) -> InlineKeyboardMarkup:
     """List universities (grouped by uni_tag) to manage their sources."""
-    unis = db_list_universities()
-    total = len(unis)
-    end = min(offset + page_size, total)
-    page = unis[offset:end]
+    page, total = db_list_universities_page(page_size, offset)
+    end = offset + len(page)
     rows: List[List[InlineKeyboardButton]] = []
     for gid, uni_tag, cnt in page:
         extra = f" ({cnt})" if cnt > 1 else ""
@@ -1096,17 +1791,15 @@ def build_unisources_kb(offset: int = 0, page_size: int = 8) -> InlineKeyboardMa
         nav.append(InlineKeyboardButton("➡️ التالي", callback_data=f"menu:unisources:{end}"))
     if nav:
         rows.append(nav)
-    rows.append([InlineKeyboardButton("🏠 القائمة", callback_data="home")])
+    rows.append([_HOME_BTN])
     return InlineKeyboardMarkup(rows)
 
 
 def build_uni_sources_kb(uni_gid: int, offset: int = 0, page_size: int = 8) -> InlineKeyboardMarkup:
-    rowg = db_get_group(uni_gid)
+    rowg = get_group_cached(uni_gid)
     uni_name = norm_key(str(rowg[2] if (rowg and len(rowg) > 2) else rowg[1])) if rowg else ""
-    sources = db_list_sources_for_uni(uni_name) if uni_name else []
-    total = len(sources)
-    end = min(offset + page_size, total)
-    page = sources[offset:end]
+    page, total = db_list_sources_for_uni_page(uni_name, page_size, offset) if uni_name else ([], 0)
+    end = offset + len(page)
 
     rows: List[List[InlineKeyboardButton]] = []
     for gid, name, chat, send_en, subj_only in page:
@@ -1127,19 +1820,18 @@ def build_uni_sources_kb(uni_gid: int, offset: int = 0, page_size: int = 8) -> I
         rows.append(nav)
 
     rows.append([InlineKeyboardButton("➕ إضافة مصدر (قروب/قناة)", callback_data=f"us:add:{uni_gid}")])
-    rows.append([InlineKeyboardButton("🔙 رجوع", callback_data="menu:unisources:0")])
-    rows.append([InlineKeyboardButton("🏠 القائمة", callback_data="home")])
+    rows.append([_BACK_TO_UNISOURCES_BTN])
+    rows.append([_HOME_BTN])
     return InlineKeyboardMarkup(rows)
 
 
 
+@functools.lru_cache(maxsize=256)
 def build_sections_list_kb(uni_gid: int, offset: int = 0, page_size: int = 8) -> InlineKeyboardMarkup:
-    row = db_get_group(int(uni_gid))
+    row = get_group_cached(int(uni_gid))
     uni_name = norm_key(str(row[2] if row and len(row) > 2 else (row[1] if row else '')))
-    secs = db_list_sections(uni_name)
-    total = len(secs)
-    end = min(offset + page_size, total)
-    page = secs[offset:end]
+    page, total = db_list_sections_page(uni_name, page_size, offset)
+    end = offset + len(page)
     rows = []
     for sid, sname, kws, enabled in page:
         flag = "✅" if enabled else "⛔"
@@ -1152,10 +1844,11 @@ def build_sections_list_kb(uni_gid: int, offset: int = 0, page_size: int = 8) ->
     if nav:
         rows.append(nav)
     rows.append([InlineKeyboardButton("➕ إضافة سكشن", callback_data=f"sec:add:{uni_gid}")])
-    rows.append([InlineKeyboardButton("🔙 رجوع", callback_data=f"menu:sections:0")])
+    rows.append([_BACK_TO_SECTIONS_BTN])
     return InlineKeyboardMarkup(rows)
 
 
+@functools.lru_cache(maxsize=256)
 def build_section_detail_kb(section_id: int, uni_gid: int) -> InlineKeyboardMarkup:
     rows = [
         [InlineKeyboardButton("👁 عرض مسجات السكشن", callback_data=f"sec:msgs:{section_id}:{uni_gid}:0")],
@@ -1165,87 +1858,135 @@ def build_section_detail_kb(section_id: int, uni_gid: int) -> InlineKeyboardMark
     return InlineKeyboardMarkup(rows)
 
 
+@functools.lru_cache(maxsize=256)
 def build_section_delete_confirm_kb(section_id: int, uni_gid: int) -> InlineKeyboardMarkup:
     rows = [[InlineKeyboardButton("✅ تأكيد الحذف", callback_data=f"sec:delc:{section_id}:{uni_gid}"), InlineKeyboardButton("❌ إلغاء", callback_data=f"sec:view:{section_id}:{uni_gid}")]]
     return InlineKeyboardMarkup(rows)
 
 
-def db_count_section_messages(uni_name: str, section_name: str) -> int:
+_SECTION_MSGS_FROM = "message_sections s JOIN messages ON messages.id = s.msg_id"
+# نص SQL ثابت لكل شكل WHERE (عدد الكلمات) -> نفس الـ statement من cache الـ connection (cached_statements)
+_SQL_SECTION_COUNT = "SELECT COUNT(1) FROM " + _SECTION_MSGS_FROM + " WHERE {where}"
+_SQL_SECTION_LIST = """SELECT id,
+                    username,
+                    COALESCE(edited_text, text) AS content,
+                    date,
+                    chat_username
+             FROM """ + _SECTION_MSGS_FROM + """
+             WHERE {where}
+             ORDER BY s.msg_id {order}
+             LIMIT ?"""
+
+
+def _section_msgs_where(uni_name: str, section_name: str, keywords: Optional[List[str]] = None) -> Tuple[str, List]:
+    """WHERE shared by db_count/db_list_section_messages (strict: content has one of the keywords).
+
+    Goes with _SECTION_MSGS_FROM (messages joined to message_sections as s).
+    """
+    where = "s.uni_name = ? AND s.section_name = ?"
+    params: List = [norm_key(uni_name), norm_key(section_name)]
+    # ✅ الفلترة في SQL قبل الـ LIMIT (الصفحات بتطلع كاملة والعدد مظبوط)
+    kw_sql, kw_params = _kw_content_where(keywords, "s.msg_id")
+    return where + kw_sql, params + kw_params
+
+
+def db_count_section_messages(uni_name: str, section_name: str, keywords: Optional[List[str]] = None) -> int:
+    key = ("section", norm_key(uni_name), norm_key(section_name), tuple(keywords or ()))
+    return _cached_count(key, lambda: _db_count_section_messages(uni_name, section_name, keywords))
+
+
+def _db_count_section_messages(uni_name: str, section_name: str, keywords: Optional[List[str]] = None) -> int:
     conn = db_conn()
     cur = conn.cursor()
-    # normalize for LIKE
-    uni_name = norm_key(uni_name)
-    section_name = norm_key(section_name)
-    pattern = f'%"{section_name}"%'
-    cur.execute(
-        """SELECT COUNT(1)
-             FROM messages
-             WHERE TRIM(COALESCE(source_tag,'')) = TRIM(?)
-               AND COALESCE(uni_subjects,'') LIKE ?""",
-        (uni_name, pattern),
-    )
+    where, params = _section_msgs_where(uni_name, section_name, keywords)
+    cur.execute(_SQL_SECTION_COUNT.format(where=where), tuple(params))
     n = cur.fetchone()[0] or 0
-    conn.close()
     return int(n)
 
 
 def db_list_section_messages(uni_name: str, section_name: str, keywords: Optional[List[str]], limit: int, offset: int) -> List[Tuple]:
     conn = db_conn()
     cur = conn.cursor()
-    uni_name = norm_key(uni_name)
-    section_name = norm_key(section_name)
-    pattern = f'%"{section_name}"%'
-    cur.execute(
-        """SELECT id,
-                    COALESCE(username,'') AS username,
-                    COALESCE(edited_text, text) AS content,
-                    COALESCE(date,'') AS date,
-                    COALESCE(chat_username,'') AS chat_username
-             FROM messages
-             WHERE TRIM(COALESCE(source_tag,'')) = TRIM(?)
-               AND COALESCE(uni_subjects,'') LIKE ?
-             ORDER BY id DESC
-             LIMIT ? OFFSET ?""",
-        (uni_name, pattern, int(limit), int(offset)),
-    )
+    where, params = _section_msgs_where(uni_name, section_name, keywords)
+    cur.execute(_SQL_SECTION_LIST.format(where=where, order="DESC") + " OFFSET ?", (*params, int(limit), int(offset)))
+    return cur.fetchall()
+
+
+def db_list_section_messages_keyset(
+    uni_name: str,
+    section_name: str,
+    keywords: Optional[List[str]],
+    limit: int,
+    last_id: Optional[int],
+    newer: bool = False,
+) -> List[Tuple]:
+    """Keyset page: older than last_id (or newer than it, for ⬅️). Always returned id DESC."""
+    conn = db_conn()
+    cur = conn.cursor()
+    where, params = _section_msgs_where(uni_name, section_name, keywords)
+    order = "DESC"
+    if last_id is not None:
+        # ✅ id < ? بدل OFFSET -> التكلفة ثابتة مهما كانت الصفحة بعيدة
+        where += " AND s.msg_id > ?" if newer else " AND s.msg_id < ?"
+        params.append(int(last_id))
+        if newer:
+            order = "ASC"
+    cur.execute(_SQL_SECTION_LIST.format(where=where, order=order), (*params, int(limit)))
     rows = cur.fetchall()
-    conn.close()
-    # strict filter: keep only messages that contain one of the section keywords in content
-    if keywords:
-        kws = [k.strip() for k in keywords if isinstance(k, str) and k.strip()]
-    else:
-        kws = []
-    if not kws:
-        return rows
-    out = []
-    for r in rows:
-        _id, uname, content, d, chat_un = r
-        c = (content or "")
-        c_low = c.lower()
-        ok = any(k.lower() in c_low for k in kws)
-        if ok:
-            out.append(r)
-    return out
-
-
-def build_section_messages_kb(section_id: int, uni_gid: int, offset: int, total: int, page_size: int, msg_items: List[Tuple[int, str]]) -> InlineKeyboardMarkup:
-    rows: List[List[InlineKeyboardButton]] = []
-    for mid, label in msg_items:
-        btn_txt = label.strip() if label else f"#{mid}"
-        if len(btn_txt) > 58:
-            btn_txt = btn_txt[:58] + "…"
-        rows.append([InlineKeyboardButton(f"👁 {btn_txt}", callback_data=f"view:{mid}")])
+    if order == "ASC":
+        rows.reverse()
+    return rows
 
-    nav: List[InlineKeyboardButton] = []
-    if offset > 0:
-        nav.append(InlineKeyboardButton("⬅️ السابق", callback_data=f"sec:msgs:{section_id}:{uni_gid}:{max(0, offset - page_size)}"))
-    if offset + page_size < total:
-        nav.append(InlineKeyboardButton("➡️ التالي", callback_data=f"sec:msgs:{section_id}:{uni_gid}:{offset + page_size}"))
-    if nav:
-        rows.append(nav)
 
-    rows.append([InlineKeyboardButton("🔙 رجوع", callback_data=f"sec:view:{section_id}:{uni_gid}")])
-    return InlineKeyboardMarkup(rows)
+# ✅ الصفحة 5 رسايل بس وكل ضغطة ⬅️/➡️ كانت query كاملة -> بنجيب window كبيرة (200) مرة واحدة
+# ونقطّع منها الصفحات من الـ RAM. الـ listener في process تانية -> الـ TTL هو اللي بيجيب الجديد
+SECTION_WINDOW_ROWS = 200
+SECTION_WINDOW_TTL_SEC = 60.0
+# key -> (ts, rows id DESC, starts_at_newest, has_more)
+_SECTION_WINDOW_CACHE: Dict[Tuple, Tuple[float, List[Tuple], bool, bool]] = {}
+
+
+def invalidate_section_windows():
+    _SECTION_WINDOW_CACHE.clear()
+
+
+def db_list_section_messages_page(
+    uni_name: str,
+    section_name: str,
+    keywords: Optional[List[str]],
+    limit: int,
+    last_id: Optional[int],
+    newer: bool = False,
+) -> List[Tuple]:
+    """Same result as db_list_section_messages_keyset, served from a cached window when possible."""
+    key = (norm_key(uni_name), norm_key(section_name), tuple(sorted(k.strip().lower() for k in (keywords or []) if isinstance(k, str) and k.strip())))
+    hit = _SECTION_WINDOW_CACHE.get(key)
+    if hit is not None and time.monotonic() - hit[0] < SECTION_WINDOW_TTL_SEC:
+        _, rows, top, more = hit
+        if last_id is None:
+            if top:
+                return rows[:limit]
+        else:
+            idx = next((i for i, r in enumerate(rows) if r[0] == last_id), -1)
+            if idx >= 0:
+                if newer:
+                    if idx >= limit or top:
+                        return rows[max(0, idx - limit):idx]
+                else:
+                    page = rows[idx + 1:idx + 1 + limit]
+                    if len(page) == limit or not more:
+                        return page
+
+    if newer and last_id is not None:
+        # الرجوع لورا برّه الـ window نادر -> query مباشرة من غير ما نكاش
+        return db_list_section_messages_keyset(uni_name, section_name, keywords, limit, last_id, newer=True)
+
+    rows = db_list_section_messages_keyset(uni_name, section_name, keywords, SECTION_WINDOW_ROWS, last_id)
+    if len(_SECTION_WINDOW_CACHE) >= 512:
+        _SECTION_WINDOW_CACHE.clear()
+    # الـ window بتبدأ بعد last_id -> عشان ⬅️ يلاقي الصفحة اللي قبلها فيها من غير query
+    _SECTION_WINDOW_CACHE[key] = (time.monotonic(), rows, last_id is None, len(rows) == SECTION_WINDOW_ROWS)
+    return rows[:limit]
 
 
 async def notify_monitor(app: Client, text: str):
@@ -1256,6 +1997,30 @@ async def notify_monitor(app: Client, text: str):
             pass
 
 
+# ✅ الحاجات اللي المستخدم مش مستنيها (إشعار المونيتور/مسح الكارت) بتشتغل في الخلفية بعد cq.answer
+_BG_TASKS: set = set()  # reference لحد ما الـ task تخلص (asyncio بيمسك weak refs بس)
+
+
+def spawn_bg(coro):
+    task = asyncio.create_task(coro)
+    _BG_TASKS.add(task)
+    task.add_done_callback(_BG_TASKS.discard)
+    return task
+
+
+async def _delete_quietly(msg):
+    try:
+        await msg.delete()
+    except Exception:
+        pass
+
+
+async def _post_status(app: Client, msg, st: str, mid: int, uid: int):
+    if st == "done":
+        await notify_monitor(app, f"✅ تمت خدمة الرسالة #{mid} بواسطة {uid}")
+    await _delete_quietly(msg)
+
+
 # -----------------------
 # Bot client
 # -----------------------
@@ -1270,21 +2035,15 @@ app = Client(
 )
 
 # حالات انتظار إدخال نص/معرّف
-editing_state = {}
-search_state = set()
-note_state = {}
-assign_state = {}
+# ✅ map واحدة (uid -> UserState) بدل 11 dict: lookup واحد لكل رسالة، وآخر flow اتفتح هو اللي شغال
+# kind: edit | note | assign | search | sec_add | sec_add_all | sec_editkw | sec_rename | grp_add | grp_edit | us_add_source
+@dataclass(slots=True)
+class UserState:
+    kind: str
+    data: Dict[str, object]
 
-sec_add_state: Dict[int, Dict[str, object]] = {}
-sec_add_all_state: Dict[int, Dict[str, object]] = {}
-sec_editkw_state: Dict[int, Dict[str, int]] = {}
-sec_rename_state: Dict[int, Dict[str, int]] = {}
 
-grp_add_state: Dict[int, Dict[str, object]] = {}
-
-us_add_source_state: Dict[int, Dict[str, object]] = {}  # add new source under a university
-
-grp_edit_state: Dict[int, Dict[str, object]] = {}
+user_states: Dict[int, UserState] = {}
 
 
 # -----------------------
@@ -1306,6 +2065,38 @@ def guard(func):
 # -----------------------
 # List sender
 # -----------------------
+SEND_LIST_CONCURRENCY = 5
+SEND_LIST_FLOOD_RETRIES = 2
+
+
+async def _reply_card(ctx_msg: Message, sem: asyncio.Semaphore, text: str, kb):
+    for attempt in range(SEND_LIST_FLOOD_RETRIES + 1):
+        try:
+            async with sem:
+                return await ctx_msg.reply_text(text, reply_markup=kb)
+        except FloodWait as e:
+            if attempt >= SEND_LIST_FLOOD_RETRIES:
+                raise
+            wait_s = int(getattr(e, "value", None) or 5)
+            logger.warning("FloodWait %ss while sending card, retrying", wait_s)
+            await asyncio.sleep(wait_s + 1)  # برا الـ semaphore عشان مانحجزش مكان
+
+
+async def send_cards(ctx_msg: Message, cards: List[Tuple[str, Optional[InlineKeyboardMarkup]]]) -> int:
+    """
+    يبعت الكروت بالتوازي (بحد أقصى SEND_LIST_CONCURRENCY) مع retry على FloodWait.
+    بيرجّع عدد الكروت اللي فشلت (بتتسجل في اللوج).
+    """
+    sem = asyncio.Semaphore(SEND_LIST_CONCURRENCY)
+    results = await asyncio.gather(*(_reply_card(ctx_msg, sem, t, kb) for t, kb in cards), return_exceptions=True)
+    failed = 0
+    for (text, _), res in zip(cards, results):
+        if isinstance(res, BaseException):
+            failed += 1
+            logger.warning("card send failed (%s): %r", text.split(" | ", 1)[0], res)
+    return failed
+
+
 async def send_list(ctx_msg: Message, viewer_uid: int, tag: Optional[str], status: Optional[str], offset: int, page_size: int = 10):
     total = db_count(tag, status)
     rows = db_query_list(tag, status, page_size, offset)
@@ -1313,41 +2104,40 @@ async def send_list(ctx_msg: Message, viewer_uid: int, tag: Optional[str], statu
         await ctx_msg.reply_text("لا توجد رسائل مطابقة حاليًا.", reply_markup=build_main_menu_kb())
         return
     header = (
-        f"📂 الفئة: <b>{html.escape(tag or 'الكل')}</b> | "
-        f"الحالة: <b>{html.escape(status_label(status or 'الكل'))}</b>\n"
+        f"📂 الفئة: <b>{_esc(tag or 'الكل')}</b> | "
+        f"الحالة: <b>{_esc(status_label(status or 'الكل'))}</b>\n"
         f"النتائج: {offset+1}-{min(offset+page_size, total)} / {total}"
     )
     nav = build_nav_kb(tag, status, offset, total, page_size)
     await ctx_msg.reply_text(header, reply_markup=nav)
 
-    for _id, chat_un, user_id, username, text, date, st, note, assigned, uni_json in rows:
+    editor = can_edit(viewer_uid)
+    # ✅ الكروت بتتبعت بالتوازي (send_cards) بعد الهيدر؛ كل كارت عليه #id
+
+    def _card(row):
+        _id, chat_un, user_id, username, text, date, st, note, assigned, uni_json = row
         short = (text or "")[:300]
         extra = ""
         if note:
-            extra += f"\n📝 ملاحظة: {html.escape(str(note))}"
+            extra += f"\n📝 ملاحظة: {_esc(note)}"
         if assigned:
-            extra += f"\n👤 مكلَّف: {html.escape(str(assigned))}"
+            extra += f"\n👤 مكلَّف: {_esc(assigned)}"
 
-        uni_subjects = []
-        if uni_json:
-            try:
-                uni_subjects = json.loads(uni_json)
-                if not isinstance(uni_subjects, list):
-                    uni_subjects = []
-            except Exception:
-                uni_subjects = []
+        uni_subjects = json_list(uni_json)
 
         if uni_subjects:
-            extra += "\n📚 المواد:\n" + "\n".join(f"• {html.escape(str(s))}" for s in uni_subjects)
-
-        kb = build_item_kb(_id, user_id, uni_subjects) if can_edit(viewer_uid) else None
-        await ctx_msg.reply_text(
-            f"#{_id} | {render_user_display(username)} | {html.escape(str(chat_un))}\n"
-            f"الحالة: {html.escape(status_label(st))}\n"
-            f"{html.escape(str(date))}\n\n{html.escape(short)}{extra}",
-            reply_markup=kb,
+            extra += "\n📚 المواد:\n" + "\n".join(f"• {_esc(s)}" for s in uni_subjects)
+
+        kb = build_item_kb(_id, user_id, uni_subjects) if editor else None
+        return (
+            f"#{_id} | {render_user_display(username)} | {_esc(chat_un)}\n"
+            f"الحالة: {_esc(status_label(st))}\n"
+            f"{date}\n\n{_esc(short)}{extra}",
+            kb,
         )
 
+    await send_cards(ctx_msg, [_card(r) for r in rows])
+
 
 # -----------------------
 # Handlers (commands)
@@ -1361,18 +2151,18 @@ async def start_cmd(client, message: Message):
         await message.reply_text("اختر من القائمة:", reply_markup=build_main_menu_kb())
         return
     await message.reply_text("تم استلام طلبك. بانتظار موافقة الأدمن.")
-    for aid in ADMIN_IDS:
-        try:
-            kb = InlineKeyboardMarkup([[InlineKeyboardButton("✅ موافقة", callback_data=f"approve:{uid}"), InlineKeyboardButton("❌ رفض", callback_data=f"deny:{uid}")]])
-            await client.send_message(aid, f"طلب دخول من المستخدم: {uid}", reply_markup=kb)
-        except Exception:
-            pass
+    # ✅ كل الأدمنز في نفس الوقت (gather) بدل واحد ورا التاني
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("✅ موافقة", callback_data=f"approve:{uid}"), InlineKeyboardButton("❌ رفض", callback_data=f"deny:{uid}")]])
+    await asyncio.gather(
+        *(client.send_message(aid, f"طلب دخول من المستخدم: {uid}", reply_markup=kb) for aid in ADMIN_IDS),
+        return_exceptions=True,
+    )
 
 @app.on_callback_query(filters.regex("^student:my_requests$"))
 async def student_my_requests(client, callback_query):
     user_id = callback_query.from_user.id
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_conn()
     cur = conn.cursor()
 
     cur.execute("""
@@ -1384,7 +2174,6 @@ async def student_my_requests(client, callback_query):
     """, (user_id,))
 
     rows = cur.fetchall()
-    conn.close()
 
     if not rows:
         await callback_query.answer("ما عندك طلبات لحد دلوقتي", show_alert=True)
@@ -1457,20 +2246,17 @@ async def by_group_cmd(client, message: Message):
 @app.on_message(filters.command("search"))
 @guard
 async def search_cmd(client, message: Message):
-    search_state.add(message.from_user.id)
+    user_states[message.from_user.id] = UserState("search", {})
     await message.reply_text("🔎 أرسل كلمة/عبارة للبحث…")
 
 
 # -----------------------
 # Callback query
 # -----------------------
-@app.on_callback_query()
-async def on_cbq_all(client, cq):
-    data = cq.data or ""
-    uid = cq.from_user.id
-
+# handler لكل prefix في الـ callback_data؛ بيرجع True لو اتعامل معاه (ورد على الـ cq)
+async def _cbq_approve(client, cq, data: str, parts: List[str], uid: int) -> bool:
     if data.startswith("approve:") and uid in ADMIN_IDS:
-        target = int(data.split(":")[1])
+        target = int(parts[1])
         db_approve(target)
         log_action(uid, "approve_user", None, str(target))
         await cq.message.reply_text(f"تمت موافقة المستخدم {target}")
@@ -1479,10 +2265,14 @@ async def on_cbq_all(client, cq):
         except Exception:
             pass
         await cq.answer("Approved", show_alert=False)
-        return
+        return True
 
+    return False
+
+
+async def _cbq_deny(client, cq, data: str, parts: List[str], uid: int) -> bool:
     if data.startswith("deny:") and uid in ADMIN_IDS:
-        target = int(data.split(":")[1])
+        target = int(parts[1])
         log_action(uid, "deny_user", None, str(target))
         await cq.message.reply_text(f"تم رفض طلب المستخدم {target}")
         try:
@@ -1490,55 +2280,103 @@ async def on_cbq_all(client, cq):
         except Exception:
             pass
         await cq.answer("Denied", show_alert=False)
-        return
+        return True
 
+    return False
+
+
+async def _cbq_home(client, cq, data: str, parts: List[str], uid: int) -> bool:
     if data == "home":
         await cq.message.reply_text("القائمة الرئيسية:", reply_markup=build_main_menu_kb())
         await cq.answer()
-        return
+        return True
+
+    return False
 
+
+async def _cbq_menu(client, cq, data: str, parts: List[str], uid: int) -> bool:
     if data == "menu:inbox":
         await send_list(cq.message, uid, tag=None, status=None, offset=0)
         await cq.answer()
-        return
+        return True
 
     if data.startswith("menu:filter:"):
-        st = data.split(":")[2]
+        st = parts[2]
         await send_list(cq.message, uid, tag=None, status=st, offset=0)
         await cq.answer()
-        return
+        return True
 
     if data.startswith("menu:groups:"):
-        off = int(data.split(":")[2])
+        off = int(parts[2])
         await cq.message.reply_text("اختر القروب:", reply_markup=build_groups_menu_kb(off))
         await cq.answer()
-        return
+        return True
 
     # ---- Groups management ----
     if data.startswith("menu:groups_manage:"):
-        off = int(data.split(":")[2])
+        off = int(parts[2])
         await cq.message.reply_text("🧩 إدارة القروبات:", reply_markup=build_groups_manage_kb(off))
         await cq.answer()
-        return
+        return True
 
     if data.startswith("menu:unisources:"):
-        off = int(data.split(":")[2])
+        off = int(parts[2])
         try:
             await cq.message.edit_text("📡 اختر الجامعة لإدارة المصادر (قروبات/قنوات):", reply_markup=build_unisources_kb(off))
         except Exception:
             await cq.message.reply_text("📡 اختر الجامعة لإدارة المصادر (قروبات/قنوات):", reply_markup=build_unisources_kb(off))
         await cq.answer()
-        return
+        return True
+
+    # ---- Sections ----
+    if data.startswith("menu:sections:"):
+        off = int(parts[2])
+        # Better UX: edit the same message so the click always feels responsive.
+        try:
+            await cq.message.edit_text("اختر الجامعة:", reply_markup=build_universities_kb(off))
+        except Exception:
+            await cq.message.reply_text("اختر الجامعة:", reply_markup=build_universities_kb(off))
+        await cq.answer()
+        return True
+
+    if data == "menu:export":
+        if not can_edit(uid):
+            await cq.answer("ليست لديك صلاحية التصدير.", show_alert=True)
+            return True
+        await cq.answer("جاري التصدير…")
+        path = os.path.join(EXPORT_DIR, f"messages_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.csv")
+        try:
+            await asyncio.to_thread(export_messages_csv, path)
+            await cq.message.reply_document(path, caption="⬇️ تصدير الرسائل")
+        except Exception as e:
+            logger.error("menu:export failed: %s", e)
+            await cq.message.reply_text("⚠️ تعذّر التصدير، حاول مرة أخرى لاحقًا.", reply_markup=build_main_menu_kb())
+        finally:
+            # الملف فيه كل الرسائل -> مايفضلش على الديسك بعد الإرسال
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return True
+
+    if data == "menu:search":
+        user_states[uid] = UserState("search", {})
+        await cq.message.reply_text("🔎 أرسل كلمة/عبارة للبحث…")
+        await cq.answer()
+        return True
+
+    return False
+
 
+async def _cbq_us(client, cq, data: str, parts: List[str], uid: int) -> bool:
     if data.startswith("us:uni:"):
         try:
-            parts = data.split(":")
             uni_gid = int(parts[2])
             off = int(parts[3] or 0)
-            rowg = db_get_group(uni_gid)
+            rowg = get_group_cached(uni_gid)
             if not rowg:
                 await cq.answer("جامعة غير معروفة", show_alert=True)
-                return
+                return True
             uni_name = norm_key(str(rowg[2] if (rowg and len(rowg) > 2) else rowg[1]))
             kb = build_uni_sources_kb(uni_gid, off)
             try:
@@ -1546,23 +2384,23 @@ async def on_cbq_all(client, cq):
             except Exception:
                 await cq.message.reply_text(f"🏛️ <b>{html.escape(uni_name)}</b>\nاختر مصدرًا لإدارته أو أضف مصدر جديد:", reply_markup=kb)
             await cq.answer()
-            return
+            return True
         except Exception:
             await cq.answer("تعذر فتح مصادر الجامعة", show_alert=True)
-            return
+            return True
 
     if data.startswith("us:add:"):
         if not can_edit(uid):
             await cq.answer("ليست لديك صلاحية إدارة القروبات.", show_alert=True)
-            return
+            return True
         try:
-            uni_gid = int(data.split(":")[2])
-            rowg = db_get_group(uni_gid)
+            uni_gid = int(parts[2])
+            rowg = get_group_cached(uni_gid)
             if not rowg:
                 await cq.answer("جامعة غير معروفة", show_alert=True)
-                return
+                return True
             uni_name = norm_key(str(rowg[2] if (rowg and len(rowg) > 2) else rowg[1]))
-            us_add_source_state[uid] = {"step": 1, "uni_gid": uni_gid, "uni_name": uni_name}
+            user_states[uid] = UserState("us_add_source", {"step": 1, "uni_gid": uni_gid, "uni_name": uni_name})
             await cq.message.reply_text(
                 "➕ إضافة مصدر (قروب/قناة)\n\n"
                 f"🏛️ الجامعة: <b>{html.escape(uni_name)}</b>\n\n"
@@ -1573,26 +2411,30 @@ async def on_cbq_all(client, cq):
                 "ملاحظة: لازم تضيف البوت للمصدر وتديه صلاحيات مناسبة."
             )
             await cq.answer()
-            return
+            return True
         except Exception:
             await cq.answer("تعذر بدء إضافة المصدر", show_alert=True)
-            return
+            return True
 
+    return False
+
+
+async def _cbq_grp(client, cq, data: str, parts: List[str], uid: int) -> bool:
     if data == "grp:add":
         if not can_edit(uid):
             await cq.answer("ليست لديك صلاحية إدارة القروبات.", show_alert=True)
-            return
-        grp_add_state[uid] = {"step": 1, "name": "", "chat": ""}
+            return True
+        user_states[uid] = UserState("grp_add", {"step": 1, "name": "", "chat": ""})
         await cq.message.reply_text("➕ إضافة قروب\n\nأرسل <b>اسم القروب</b> الآن…")
         await cq.answer()
-        return
+        return True
 
     if data.startswith("grp:view:"):
-        gid = int(data.split(":")[2])
-        row = db_get_group(gid)
+        gid = int(parts[2])
+        row = get_group_cached(gid)
         if not row:
             await cq.answer("القروب غير موجود", show_alert=True)
-            return
+            return True
         # db_get_group returns: (id, name, uni_tag, chat, out_file, template_text,
         # attachments_enabled, send_enabled, subjects_only)
         _id, name, uni_tag, chat, out_file, tpl, att, send_en, subj_only = row
@@ -1603,27 +2445,27 @@ async def on_cbq_all(client, cq):
             "📄 out_file: <code>{}</code>\n"
             "📎 attachments: <b>{}</b> | 🚀 send: <b>{}</b> | 🎯 subjects_only: <b>{}</b>\n"
             "\n📝 template (مختصر):\n<code>{}</code>".format(
-                html.escape(str(name)),
-                html.escape(str(uni_tag)),
-                html.escape(str(chat)),
-                html.escape(str(out_file)),
+                _esc(name),
+                _esc(uni_tag),
+                _esc(chat),
+                _esc(out_file),
                 "ON" if int(att) else "OFF",
                 "ON" if int(send_en) else "OFF",
                 "ON" if int(subj_only) else "OFF",
-                html.escape((str(tpl)[:500] + ("…" if len(str(tpl)) > 500 else ""))),
+                _esc((str(tpl)[:500] + ("…" if len(str(tpl)) > 500 else ""))),
             ),
             reply_markup=build_group_detail_kb(gid),
         )
         await cq.answer()
-        return
+        return True
 
     if data.startswith("grp:edit:"):
         if not can_edit(uid):
             await cq.answer("ليست لديك صلاحية التعديل.", show_alert=True)
-            return
-        _, _, field, gid = data.split(":")
+            return True
+        _, _, field, gid = parts
         gid = int(gid)
-        grp_edit_state[uid] = {"gid": gid, "field": field}
+        user_states[uid] = UserState("grp_edit", {"gid": gid, "field": field})
         prompt = {
             "name": "أرسل الاسم الجديد للقروب…",
             "chat": "أرسل chat الجديد (@username أو -100...)…",
@@ -1633,83 +2475,75 @@ async def on_cbq_all(client, cq):
         }.get(field, "أرسل القيمة الجديدة…")
         await cq.message.reply_text(prompt)
         await cq.answer()
-        return
+        return True
 
     if data.startswith("grp:toggle:"):
         if not can_edit(uid):
             await cq.answer("ليست لديك صلاحية التعديل.", show_alert=True)
-            return
-        _, _, field, gid = data.split(":")
+            return True
+        _, _, field, gid = parts
         gid = int(gid)
-        row = db_get_group(gid)
+        row = get_group_cached(gid)
         if not row:
             await cq.answer("القروب غير موجود", show_alert=True)
-            return
+            return True
         # indices per db_get_group: 6=attachments, 7=send_enabled, 8=subjects_only
         current = int(row[6] if field == "attachments_enabled" else row[7] if field == "send_enabled" else row[8])
         newv = 0 if current else 1
         ok, msg_txt = db_update_group_field(gid, field, newv)
         await cq.answer(msg_txt, show_alert=False)
         await cq.message.reply_text("تم التحديث ✅", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع للتفاصيل", callback_data=f"grp:view:{gid}")]]))
-        return
+        return True
 
     if data.startswith("grp:del:"):
         if not can_edit(uid):
             await cq.answer("ليست لديك صلاحية الحذف.", show_alert=True)
-            return
-        gid = int(data.split(":")[2])
-        row = db_get_group(gid)
+            return True
+        gid = int(parts[2])
+        row = get_group_cached(gid)
         if not row:
             await cq.answer("القروب غير موجود", show_alert=True)
-            return
+            return True
         await cq.message.reply_text(f"🗑️ تأكيد حذف القروب: <b>{html.escape(str(row[1]))}</b>", reply_markup=build_group_delete_confirm_kb(gid))
         await cq.answer()
-        return
+        return True
 
     if data.startswith("grp:delc:"):
         if not can_edit(uid):
             await cq.answer("ليست لديك صلاحية الحذف.", show_alert=True)
-            return
-        gid = int(data.split(":")[2])
+            return True
+        gid = int(parts[2])
         db_delete_group(gid)
         log_action(uid, "delete_group", None, str(gid))
         await cq.answer("تم الحذف", show_alert=False)
         await cq.message.reply_text("تم حذف القروب ✅", reply_markup=build_groups_manage_kb(0))
-        return
+        return True
+
+    return False
 
-    # ---- Sections ----
-    if data.startswith("menu:sections:"):
-        off = int(data.split(":")[2])
-        # Better UX: edit the same message so the click always feels responsive.
-        try:
-            await cq.message.edit_text("اختر الجامعة:", reply_markup=build_universities_kb(off))
-        except Exception:
-            await cq.message.reply_text("اختر الجامعة:", reply_markup=build_universities_kb(off))
-        await cq.answer()
-        return
 
+async def _cbq_sec(client, cq, data: str, parts: List[str], uid: int) -> bool:
     if data == "sec:add_all":
         if not can_edit(uid):
             await cq.answer("ليست لديك صلاحية التعديل.", show_alert=True)
-            return
-        sec_add_all_state[uid] = {"step": 1}
+            return True
+        user_states[uid] = UserState("sec_add_all", {"step": 1})
         await cq.message.reply_text("📚 إضافة مادة لكل الجامعات\n\nأرسل اسم المادة/السكشن…")
         await cq.answer()
-        return
+        return True
 
     if data.startswith("sec:uni:"):
         try:
-            parts = data.split(":")
             if len(parts) < 4:
                 await cq.answer("بيانات الزر غير صحيحة", show_alert=True)
-                return
+                return True
             uni_gid = int(parts[2])
             off = int(parts[3] or 0)
 
-            rowg = db_get_group(uni_gid)
+            rowg = get_group_cached(uni_gid)
             if not rowg:
                 await cq.answer("جامعة غير معروفة", show_alert=True)
-                return
+                return True
 
             uni_name = norm_key(str(rowg[2] if (rowg and len(rowg) > 2) else rowg[1]))
             kb = build_sections_list_kb(uni_gid, off)
@@ -1721,20 +2555,20 @@ async def on_cbq_all(client, cq):
                 await cq.message.reply_text(f"🏛️ <b>{html.escape(uni_name)}</b>\nاختر سكشن:", reply_markup=kb)
 
             await cq.answer()
-            return
+            return True
         except Exception as e:
             logging.exception("sec:uni handler failed")
             await cq.answer("حصل خطأ أثناء فتح السكشنات", show_alert=True)
-            return
+            return True
 
     if data.startswith("sec:view:"):
-        _, _, sid, uni_gid = data.split(":")
+        _, _, sid, uni_gid = parts
         sid = int(sid)
         uni_gid = int(uni_gid)
         row = db_get_section(sid)
         if not row:
             await cq.answer("السكشن غير موجود", show_alert=True)
-            return
+            return True
         _, uni_tag, sname, kws, enabled = row
         flag = "✅" if enabled else "⛔"
         kw_text = "\n".join(f"• {html.escape(str(k))}" for k in kws) if kws else "—"
@@ -1745,30 +2579,31 @@ async def on_cbq_all(client, cq):
             reply_markup=build_section_detail_kb(sid, uni_gid),
         )
         await cq.answer()
-        return
+        return True
 
     if data.startswith("sec:msgs:"):
-        _, _, sid, uni_gid, off = data.split(":")
-        sid = int(sid)
-        uni_gid = int(uni_gid)
-        off = int(off or 0)
+        sid = int(parts[2])
+        uni_gid = int(parts[3])
+        off = int(parts[4] or 0)
+        # cursor = "<id" (التالي) أو ">id" (السابق)؛ من غيره = أول صفحة / offset قديم
+        cursor = parts[5] if len(parts) > 5 else ""
 
         row = db_get_section(sid)
         if not row:
             await cq.answer("السكشن غير موجود", show_alert=True)
-            return
+            return True
         _, uni_tag, sname, kws, enabled = row
 
         page_size = 5
-        # Parse keywords for strict matching in message content
-        try:
-            keywords = json.loads(kws) if kws else []
-            if not isinstance(keywords, list):
-                keywords = []
-        except Exception:
-            keywords = []
-        total = db_count_section_messages(uni_tag, sname)
-        items = db_list_section_messages(uni_tag, sname, keywords=keywords, limit=page_size, offset=off)
+        # keywords (db_get_section بيرجعها list متفكّة جاهزة) for strict matching in message content
+        keywords = kws
+        total = db_count_section_messages(uni_tag, sname, keywords)
+        if cursor[:1] in ("<", ">") and cursor[1:].isdigit():
+            items = db_list_section_messages_page(uni_tag, sname, keywords, page_size, int(cursor[1:]), newer=cursor[0] == ">")
+        elif off > 0:
+            items = db_list_section_messages(uni_tag, sname, keywords=keywords, limit=page_size, offset=off)
+        else:
+            items = db_list_section_messages_page(uni_tag, sname, keywords, page_size, None)
         total_show = len(items)
 
         if total == 0:
@@ -1779,7 +2614,7 @@ async def on_cbq_all(client, cq):
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 رجوع", callback_data=f"sec:view:{sid}:{uni_gid}")]]),
             )
             await cq.answer()
-            return
+            return True
 
         text_out = (
             f"🏛️ الجامعة: <b>{html.escape(str(uni_tag))}</b>\n"
@@ -1790,182 +2625,187 @@ async def on_cbq_all(client, cq):
 
         cards = []
         kb_rows: List[List[InlineKeyboardButton]] = []
+        reply_counts = db_count_direct_replies_bulk([r[0] for r in items])
         for mid, uname, content, dt, chat_un in items:
             cards.append(render_message_card(int(mid), str(uname), str(dt), str(content)))
-            rc = db_count_direct_replies(int(mid))
+            rc = reply_counts.get(int(mid), 0)
             kb_rows.append([
                 InlineKeyboardButton(f"👁 #{mid}", callback_data=f"view:{mid}"),
                 InlineKeyboardButton(f"💬 الردود ({rc})", callback_data=f"thr:{mid}:0"),
             ])
 
         if cards:
-            text_out += "\n\n" + "\n\n────────\n\n".join(cards)
+            text_out = "\n\n".join((text_out, _CARD_SEP.join(cards)))
 
         nav: List[InlineKeyboardButton] = []
-        if off > 0:
-            nav.append(InlineKeyboardButton("⬅️ السابق", callback_data=f"sec:msgs:{sid}:{uni_gid}:{max(0, off-page_size)}"))
-        if off + page_size < total:
-            nav.append(InlineKeyboardButton("التالي ➡️", callback_data=f"sec:msgs:{sid}:{uni_gid}:{off+page_size}"))
+        if off > 0 and items:
+            nav.append(InlineKeyboardButton("⬅️ السابق", callback_data=f"sec:msgs:{sid}:{uni_gid}:{max(0, off-page_size)}:>{items[0][0]}"))
+        if off + page_size < total and items:
+            nav.append(InlineKeyboardButton("التالي ➡️", callback_data=f"sec:msgs:{sid}:{uni_gid}:{off+page_size}:<{items[-1][0]}"))
         if nav:
             kb_rows.append(nav)
         kb_rows.append([InlineKeyboardButton("🔙 رجوع", callback_data=f"sec:view:{sid}:{uni_gid}")])
 
         await cq.message.edit_text(text_out, reply_markup=InlineKeyboardMarkup(kb_rows))
         await cq.answer()
-        return
+        return True
         await cq.answer()
-        return
+        return True
 
     if data.startswith("sec:add:"):
         if not can_edit(uid):
             await cq.answer("ليست لديك صلاحية إدارة السكشنات.", show_alert=True)
-            return
-        uni_gid = int(data.split(":")[2])
-        rowg = db_get_group(uni_gid)
+            return True
+        uni_gid = int(parts[2])
+        rowg = get_group_cached(uni_gid)
         if not rowg:
             await cq.answer("جامعة غير معروفة", show_alert=True)
-            return
+            return True
         uni_name = norm_key(str(rowg[2] if (rowg and len(rowg)>2) else rowg[1]))
-        sec_add_state[uid] = {"uni_gid": uni_gid, "step": 1, "name": ""}
+        user_states[uid] = UserState("sec_add", {"uni_gid": uni_gid, "step": 1, "name": ""})
         await cq.message.reply_text(f"➕ إضافة سكشن لجامعة <b>{html.escape(uni_name)}</b>\n\nأرسل <b>اسم السكشن</b> الآن…")
         await cq.answer()
-        return
+        return True
 
     if data.startswith("sec:editkw:"):
         if not can_edit(uid):
             await cq.answer("ليست لديك صلاحية التعديل.", show_alert=True)
-            return
-        _, _, sid, uni_gid = data.split(":")
+            return True
+        _, _, sid, uni_gid = parts
         sid = int(sid)
         uni_gid = int(uni_gid)
-        sec_editkw_state[uid] = {"section_id": sid, "uni_gid": uni_gid}
+        user_states[uid] = UserState("sec_editkw", {"section_id": sid, "uni_gid": uni_gid})
         await cq.message.reply_text("✏️ أرسل الكلمات الجديدة (افصل بينهم بفاصلة أو سطر جديد)…")
         await cq.answer()
-        return
+        return True
 
     if data.startswith("sec:rename:"):
         if not can_edit(uid):
             await cq.answer("ليست لديك صلاحية التعديل.", show_alert=True)
-            return
-        _, _, sid, uni_gid = data.split(":")
+            return True
+        _, _, sid, uni_gid = parts
         sid = int(sid)
         uni_gid = int(uni_gid)
-        sec_rename_state[uid] = {"section_id": sid, "uni_gid": uni_gid}
+        user_states[uid] = UserState("sec_rename", {"section_id": sid, "uni_gid": uni_gid})
         await cq.message.reply_text("🏷️ أرسل الاسم الجديد للسكشن…")
         await cq.answer()
-        return
+        return True
 
     if data.startswith("sec:del:"):
         if not can_edit(uid):
             await cq.answer("ليست لديك صلاحية الحذف.", show_alert=True)
-            return
-        _, _, sid, uni_gid = data.split(":")
+            return True
+        _, _, sid, uni_gid = parts
         sid = int(sid)
         uni_gid = int(uni_gid)
         row = db_get_section(sid)
         if not row:
             await cq.answer("السكشن غير موجود", show_alert=True)
-            return
+            return True
         _, uni_tag, sname, _, _ = row
         await cq.message.reply_text(
             f"🗑️ تأكيد حذف السكشن: <b>{html.escape(str(sname))}</b>\n🏛️ {html.escape(str(uni_tag))}",
             reply_markup=build_section_delete_confirm_kb(sid, uni_gid),
         )
         await cq.answer()
-        return
+        return True
 
     if data.startswith("sec:delc:"):
         if not can_edit(uid):
             await cq.answer("ليست لديك صلاحية الحذف.", show_alert=True)
-            return
-        _, _, sid, uni_gid = data.split(":")
+            return True
+        _, _, sid, uni_gid = parts
         sid = int(sid)
         uni_gid = int(uni_gid)
         db_delete_section(sid)
         log_action(uid, "delete_section", None, str(sid))
 
-        rowg = db_get_group(uni_gid)
+        rowg = get_group_cached(uni_gid)
         uni_name = norm_key(str(rowg[2] if (rowg and len(rowg)>2) else rowg[1])) if rowg else "—"
         await cq.answer("تم الحذف", show_alert=False)
         await cq.message.reply_text(f"تم حذف السكشن ✅\n🏛️ <b>{html.escape(uni_name)}</b>", reply_markup=build_sections_list_kb(uni_gid, 0))
-        return
+        return True
+
+    return False
 
-    if data == "menu:search":
-        search_state.add(uid)
-        await cq.message.reply_text("🔎 أرسل كلمة/عبارة للبحث…")
-        await cq.answer()
-        return
 
+async def _cbq_nav(client, cq, data: str, parts: List[str], uid: int) -> bool:
     # --- تنقّل الصفحات ---
     if data.startswith("nav:"):
-        _, tag, st, off = data.split(":")
+        _, tag, st, off = parts
         tag = tag or None
         st = st or None
         off = int(off or 0)
         await send_list(cq.message, uid, tag, st, off)
         await cq.answer()
-        return
+        return True
 
+    return False
+
+
+async def _cbq_cmd(client, cq, data: str, parts: List[str], uid: int) -> bool:
     # --- اختيار قروب وحالته ---
     if data.startswith("cmd:tag:"):
-        disp = data.split(":")[2]
+        disp = parts[2]
         await cq.message.reply_text(f"القروب: {html.escape(disp)}\nاختر حالة:", reply_markup=build_group_status_kb(disp))
         await cq.answer()
-        return
+        return True
 
+    return False
+
+
+async def _cbq_gfilter(client, cq, data: str, parts: List[str], uid: int) -> bool:
     if data.startswith("gfilter:"):
-        _, disp, st, off = data.split(":")
+        _, disp, st, off = parts
         tag = resolve_tag(disp)
         off = int(off or 0)
         await send_list(cq.message, uid, tag=tag, status=st, offset=off)
         await cq.answer()
-        return
+        return True
 
+    return False
+
+
+async def _cbq_status(client, cq, data: str, parts: List[str], uid: int) -> bool:
     # --- تغيير الحالة ---
     if data.startswith("status:"):
-        _, st, mid = data.split(":")
+        _, st, mid = parts
         mid = int(mid)
         if not can_edit(uid):
             await cq.answer("ليست لديك صلاحية تعديل الحالة.", show_alert=True)
-            return
+            return True
         if st not in ("serving", "done", "not_served"):
             await cq.answer("حالة غير معروفة", show_alert=True)
-            return
-        db_set_status(mid, st)
+            return True
+        if db_set_status(mid, st) is None:
+            await cq.answer("غير موجود/محذوف", show_alert=True)
+            return True
         log_action(uid, f"status_{st}", mid)
         await cq.answer("تم تحديث الحالة", show_alert=False)
-        if st == "done":
-            await notify_monitor(client, f"✅ تمت خدمة الرسالة #{mid} بواسطة {uid}")
-        try:
-            await cq.message.delete()
-        except Exception:
-            pass
-        return
+        spawn_bg(_post_status(client, cq.message, st, mid, uid))
+        return True
+
+    return False
 
+
+async def _cbq_view(client, cq, data: str, parts: List[str], uid: int) -> bool:
     # --- عرض/تعديل/ملاحظة/تعيين/مواد/حذف/حظر ---
     if data.startswith("view:"):
-        msg_id = int(data.split(":")[1])
+        msg_id = int(parts[1])
         row = db_get_message(msg_id)
         if not row:
             await cq.answer("غير موجود/محذوف", show_alert=True)
-            return
+            return True
 
         (_id, chat_id, chat_un, user_id2, username, text, edited_text, date, st, note, assigned, tag, uni_json) = row
 
         show_text = (edited_text or text or "")
-        uni_subjects = []
-        if uni_json:
-            try:
-                uni_subjects = json.loads(uni_json)
-                if not isinstance(uni_subjects, list):
-                    uni_subjects = []
-            except Exception:
-                uni_subjects = []
+        uni_subjects = json_list(uni_json)
 
         header_lines = [
             f"[{html.escape(str(tag))}] #{_id}",
             f"👤 {render_user_display(username)} | 💬 {html.escape(str(chat_un))}",
-            f"🕒 {html.escape(str(date))}",
+            f"🕒 {date}",
             f"الحالة: {html.escape(status_label(st))}",
         ]
         if note:
@@ -1984,423 +2824,490 @@ async def on_cbq_all(client, cq):
         rcount = db_count_direct_replies(msg_id)
         kb = InlineKeyboardMarkup([
             [InlineKeyboardButton(f"💬 الردود ({rcount})", callback_data=f"thr:{msg_id}:0")],
-            [InlineKeyboardButton("🏠 القائمة", callback_data="home")],
+            [_HOME_BTN],
         ])
         await cq.message.reply_text(body, reply_markup=kb)
         await cq.answer()
-        return
+        return True
+
+    return False
 
-    
+
+async def _cbq_thr(client, cq, data: str, parts: List[str], uid: int) -> bool:
     if data.startswith("thr:"):
         try:
-            _, mid_s, off_s = data.split(":")
-            mid = int(mid_s)
-            off = int(off_s or 0)
+            mid = int(parts[1])
+            off = int(parts[2] or 0)
+            # cursor = ">id" (التالي) أو "<id" (السابق) زي sec:msgs
+            cursor = parts[3] if len(parts) > 3 else ""
             page_size = 5
             total = db_count_direct_replies(mid)
-            items = db_list_direct_replies(mid, limit=page_size, offset=off)
+            if cursor[:1] in ("<", ">") and cursor[1:].isdigit():
+                items = db_list_direct_replies_keyset(mid, page_size, int(cursor[1:]), older=cursor[0] == "<")
+            elif off > 0:
+                items = db_list_direct_replies(mid, limit=page_size, offset=off)
+            else:
+                items = db_list_direct_replies_keyset(mid, page_size, None)
 
             header = f"💬 <b>الردود على #{mid}</b>\n📦 العدد: <b>{total}</b>"
             cards = []
             kb_rows: List[List[InlineKeyboardButton]] = []
+            # nested replies count (query واحدة للصفحة كلها)
+            reply_counts = db_count_direct_replies_bulk([r[0] for r in items])
             for rid, runame, rcontent, rdate, _chat_un in items:
                 cards.append(render_message_card(int(rid), str(runame), str(rdate), str(rcontent)))
-                # nested replies count
-                n2 = db_count_direct_replies(int(rid))
+                n2 = reply_counts.get(int(rid), 0)
                 kb_rows.append([
                     InlineKeyboardButton(f"👁 #{rid}", callback_data=f"view:{rid}"),
                     InlineKeyboardButton(f"💬 الردود ({n2})", callback_data=f"thr:{rid}:0"),
                 ])
 
-            text_body = header
-            if cards:
-                text_body += "\n\n" + "\n\n────────\n\n".join(cards)
-            else:
-                text_body += "\n\nلا توجد ردود مسجلة."
+            # الكروت بتتلزق في join واحدة (من غير نسخ وسيطة للنص)
+            text_body = "\n\n".join((header, _CARD_SEP.join(cards) if cards else "لا توجد ردود مسجلة."))
 
             nav: List[InlineKeyboardButton] = []
-            if off > 0:
-                nav.append(InlineKeyboardButton("⬅️ السابق", callback_data=f"thr:{mid}:{max(0, off-page_size)}"))
-            if off + page_size < total:
-                nav.append(InlineKeyboardButton("التالي ➡️", callback_data=f"thr:{mid}:{off+page_size}"))
+            if off > 0 and items:
+                nav.append(InlineKeyboardButton("⬅️ السابق", callback_data=f"thr:{mid}:{max(0, off-page_size)}:<{items[0][0]}"))
+            if off + page_size < total and items:
+                nav.append(InlineKeyboardButton("التالي ➡️", callback_data=f"thr:{mid}:{off+page_size}:>{items[-1][0]}"))
             if nav:
                 kb_rows.append(nav)
             kb_rows.append([InlineKeyboardButton("🔙 رجوع للرسالة", callback_data=f"view:{mid}")])
 
             await cq.message.reply_text(text_body, reply_markup=InlineKeyboardMarkup(kb_rows))
             await cq.answer()
-            return
+            return True
         except Exception:
             logging.exception("thr handler failed")
             await cq.answer("حصل خطأ أثناء عرض الردود", show_alert=True)
-            return
+            return True
+
+    return False
+
+
+async def _cbq_edit(client, cq, data: str, parts: List[str], uid: int) -> bool:
     if data.startswith("edit:"):
         if not can_edit(uid):
             await cq.answer("ليست لديك صلاحية التعديل.", show_alert=True)
-            return
-        msg_id = int(data.split(":")[1])
-        editing_state[uid] = msg_id
+            return True
+        msg_id = int(parts[1])
+        user_states[uid] = UserState("edit", {"msg_id": msg_id})
         await cq.message.reply_text(f"أرسل النص الجديد ليتم حفظه للرسالة #{msg_id}")
         await cq.answer()
-        return
+        return True
+
+    return False
+
 
+async def _cbq_note(client, cq, data: str, parts: List[str], uid: int) -> bool:
     if data.startswith("note:start:"):
         if not can_edit(uid):
             await cq.answer("ليست لديك صلاحية إضافة ملاحظات.", show_alert=True)
-            return
-        msg_id = int(data.split(":")[2])
-        note_state[uid] = msg_id
+            return True
+        msg_id = int(parts[2])
+        user_states[uid] = UserState("note", {"msg_id": msg_id})
         await cq.message.reply_text(f"📝 أرسل نص الملاحظة للرسالة #{msg_id}")
         await cq.answer()
-        return
+        return True
+
+    return False
 
+
+async def _cbq_assign(client, cq, data: str, parts: List[str], uid: int) -> bool:
     if data.startswith("assign:start:"):
         if not can_edit(uid):
             await cq.answer("ليست لديك صلاحية التعيين.", show_alert=True)
-            return
-        msg_id = int(data.split(":")[2])
-        assign_state[uid] = msg_id
+            return True
+        msg_id = int(parts[2])
+        user_states[uid] = UserState("assign", {"msg_id": msg_id})
         await cq.message.reply_text(f"👤 أرسل user_id للشخص المكلَّف بالرسالة #{msg_id}")
         await cq.answer()
-        return
+        return True
 
+    return False
+
+
+async def _cbq_subj(client, cq, data: str, parts: List[str], uid: int) -> bool:
     if data.startswith("subj:"):
-        _, mid, idx = data.split(":")
+        _, mid, idx = parts
         mid = int(mid)
         idx = int(idx)
         subjects = db_get_subjects(mid)
         if not subjects or idx < 0 or idx >= len(subjects):
             await cq.answer("المادة غير متاحة.", show_alert=True)
-            return
+            return True
         subj = subjects[idx]
         await cq.answer(f"📚 المادة: {subj}", show_alert=True)
-        return
+        return True
+
+    return False
 
+
+async def _cbq_delete(client, cq, data: str, parts: List[str], uid: int) -> bool:
     if data.startswith("delete:"):
         if not can_edit(uid):
             await cq.answer("ليست لديك صلاحية الحذف.", show_alert=True)
-            return
-        msg_id = int(data.split(":")[1])
+            return True
+        msg_id = int(parts[1])
         db_delete_message(msg_id)
         log_action(uid, "delete_hard", msg_id)
         await cq.answer("تم الحذف نهائيًا", show_alert=False)
-        try:
-            await cq.message.delete()
-        except Exception:
-            pass
-        return
+        spawn_bg(_delete_quietly(cq.message))
+        return True
+
+    return False
 
+
+async def _cbq_block_del(client, cq, data: str, parts: List[str], uid: int) -> bool:
     if data.startswith("block_del:"):
         if not can_edit(uid):
             await cq.answer("ليست لديك صلاحية الحظر.", show_alert=True)
-            return
-        parts = data.split(":")
+            return True
         msg_id = int(parts[1])
         user_id = int(parts[2])
         db_delete_message(msg_id)
         db_block_user(user_id)
         log_action(uid, "block_and_delete_hard", msg_id, str(user_id))
         await cq.answer("تم الحذف والحظر", show_alert=False)
-        try:
-            await cq.message.delete()
-        except Exception:
-            pass
-        return
+        spawn_bg(_delete_quietly(cq.message))
+        return True
+
+    return False
+
+
+_CBQ_HANDLERS = {
+    "approve": _cbq_approve,
+    "deny": _cbq_deny,
+    "home": _cbq_home,
+    "menu": _cbq_menu,
+    "us": _cbq_us,
+    "grp": _cbq_grp,
+    "sec": _cbq_sec,
+    "nav": _cbq_nav,
+    "cmd": _cbq_cmd,
+    "gfilter": _cbq_gfilter,
+    "status": _cbq_status,
+    "view": _cbq_view,
+    "thr": _cbq_thr,
+    "edit": _cbq_edit,
+    "note": _cbq_note,
+    "assign": _cbq_assign,
+    "subj": _cbq_subj,
+    "delete": _cbq_delete,
+    "block_del": _cbq_block_del,
+}
+
+
+
+@app.on_callback_query()
+async def on_cbq_all(client, cq):
+    data = cq.data or ""
+    uid = cq.from_user.id
 
+    # ✅ dispatch على أول جزء من الـ callback_data (dict lookup واحد بدل سلسلة startswith)
+    # والـ split بيتعمل مرة واحدة هنا والـ handlers بتاخد parts جاهزة بدل ما كل فرع يعمل split تاني
+    parts = data.split(":")
+    handler = _CBQ_HANDLERS.get(parts[0])
+    if handler is not None and await handler(client, cq, data, parts, uid):
+        return
     await cq.answer()
 
 
 # -----------------------
 # Free-text handler
 # -----------------------
-@app.on_message(filters.text & ~filters.command(["start", "inbox", "new", "serving", "done", "notserved", "search", "stats", "exportcsv", "kw", "g"]))
-@guard
-async def on_free_text(client, message: Message):
-    uid = message.from_user.id
+# ---- Add new source under a university ----
+async def _ft_us_add_source(client, message: Message, uid: int, st: Dict) -> bool:
+    if not can_edit(uid):
+        user_states.pop(uid, None)
+        await message.reply_text("ليست لديك صلاحية إدارة القروبات.", reply_markup=build_main_menu_kb())
+        return True
+
+    step = int(st.get("step", 1))
+    if step == 1:
+        chat = (message.text or "").strip()
+        if not chat:
+            await message.reply_text("ابعت @username أو chat_id صحيح.")
+            return True
+
+        uni_gid = int(st.get("uni_gid", 0) or 0)
+        uni_name = norm_key(str(st.get("uni_name") or ""))
+
+        # generate unique source name under this university
+        name = db_next_source_name(uni_name or "UNI")
 
-    
-    # ---- Add new source under a university ----
-    if uid in us_add_source_state:
-        st = us_add_source_state.get(uid) or {}
-        if not can_edit(uid):
-            us_add_source_state.pop(uid, None)
-            await message.reply_text("ليست لديك صلاحية إدارة القروبات.", reply_markup=build_main_menu_kb())
-            return
+        out_file = f"outputs/{name}.txt"
+        ok, msg_err = db_create_group(
+            name=name,
+            chat=chat,
+            out_file=out_file,
+            template_text=" ",
+            uni_tag=uni_name,
+            attachments_enabled=0,
+            send_enabled=0,
+            subjects_only=1,
+        )
+        user_states.pop(uid, None)
 
-        step = int(st.get("step", 1))
-        if step == 1:
-            chat = (message.text or "").strip()
-            if not chat:
-                await message.reply_text("ابعت @username أو chat_id صحيح.")
-                return
-
-            uni_gid = int(st.get("uni_gid", 0) or 0)
-            uni_name = norm_key(str(st.get("uni_name") or ""))
-
-            # generate unique source name under this university
-            existing = db_list_sources_for_uni(uni_name) if uni_name else []
-            seq = len(existing) + 1
-            base = uni_name or "UNI"
-            name = f"{base}#{seq}"
-            # ensure unique if already used
-            tries = 0
-            while tries < 50 and db_get_group_by_name(name):
-                seq += 1
-                name = f"{base}#{seq}"
-                tries += 1
-
-            out_file = f"outputs/{name}.txt"
-            ok, msg_err = db_create_group(
-                name=name,
-                chat=chat,
-                out_file=out_file,
-                template_text=" ",
-                uni_tag=uni_name,
-                attachments_enabled=0,
-                send_enabled=0,
-                subjects_only=1,
-            )
-            us_add_source_state.pop(uid, None)
-
-            if not ok:
-                await message.reply_text(f"تعذر إضافة المصدر: {msg_err}")
-                return
-
-            await message.reply_text(
-                f"✅ تم إضافة المصدر بنجاح\n\n"
-                f"🏛️ الجامعة: <b>{html.escape(uni_name)}</b>\n"
-                f"🔌 المصدر: <b>{html.escape(name)}</b>\n"
-                f"📌 chat: <code>{html.escape(chat)}</code>\n\n"
-                "تم تفعيل وضع (مواد فقط) للمصدر تلقائيًا."
-            )
+        if not ok:
+            await message.reply_text(f"تعذر إضافة المصدر: {msg_err}")
+            return True
+
+        await message.reply_text(
+            f"✅ تم إضافة المصدر بنجاح\n\n"
+            f"🏛️ الجامعة: <b>{html.escape(uni_name)}</b>\n"
+            f"🔌 المصدر: <b>{html.escape(name)}</b>\n"
+            f"📌 chat: <code>{html.escape(chat)}</code>\n\n"
+            "تم تفعيل وضع (مواد فقط) للمصدر تلقائيًا."
+        )
+
+        # show updated sources list
+        kb = build_uni_sources_kb(uni_gid, 0) if uni_gid else build_main_menu_kb()
+        await message.reply_text("📡 مصادر الجامعة:", reply_markup=kb)
+        return True
+    return False
 
-            # show updated sources list
-            kb = build_uni_sources_kb(uni_gid, 0) if uni_gid else build_main_menu_kb()
-            await message.reply_text("📡 مصادر الجامعة:", reply_markup=kb)
-            return
 
 # ---- Groups add/edit flows ----
-    if uid in grp_add_state:
-        st = grp_add_state.get(uid) or {}
-        step = int(st.get("step", 1))
-        if not can_edit(uid):
-            grp_add_state.pop(uid, None)
-            await message.reply_text("ليست لديك صلاحية إدارة القروبات.", reply_markup=build_main_menu_kb())
-            return
-        if step == 1:
-            name = norm_key(message.text or "")
-            if not name:
-                await message.reply_text("اكتب اسم القروب (غير فارغ)…")
-                return
-            grp_add_state[uid] = {"step": 2, "name": name, "uni_tag": ""}
-            await message.reply_text(f"✅ اسم المصدر: <b>{html.escape(name)}</b>\n\nأرسل اسم/وسم الجامعة (uni_tag) اللي المصدر تابع لها…\nمثال: Tabuk أو NBU\n\nلو عايزها نفس اسم المصدر ابعت نفس الاسم")
-            return
-        if step == 2:
-            uni_tag = norm_key(message.text or "")
-            if not uni_tag:
-                uni_tag = norm_key(str(st.get("name", "")))
-            grp_add_state[uid] = {"step": 3, "name": st.get("name", ""), "uni_tag": uni_tag}
-            await message.reply_text(f"✅ الجامعة: <b>{html.escape(uni_tag)}</b>\n\nأرسل chat (@username أو -100...)…")
-            return
-        if step == 3:
-            chat = (message.text or "").strip()
-            if not chat:
-                await message.reply_text("اكتب chat (@username أو -100...)…")
-                return
-            grp_add_state[uid] = {"step": 4, "name": st.get("name", ""), "uni_tag": st.get("uni_tag",""), "chat": chat}
-            await message.reply_text("📝 أرسل نص التمبلت الآن (هيتخزن في DB)…")
-            return
-        name = norm_key(str(st.get("name", "")))
-        uni_tag = norm_key(str(st.get("uni_tag", "")))
-        chat = str(st.get("chat", "")).strip()
-        tpl = message.text or ""
-        out_file = f"outputs/{name}.txt"
-        ok, msg_txt = db_create_group(name=name, chat=chat, uni_tag=uni_tag, out_file=out_file, template_text=tpl, attachments_enabled=0, send_enabled=0, subjects_only=0)
-        grp_add_state.pop(uid, None)
-        await message.reply_text(msg_txt, reply_markup=build_groups_manage_kb(0))
-        return
+async def _ft_grp_add(client, message: Message, uid: int, st: Dict) -> bool:
+    step = int(st.get("step", 1))
+    if not can_edit(uid):
+        user_states.pop(uid, None)
+        await message.reply_text("ليست لديك صلاحية إدارة القروبات.", reply_markup=build_main_menu_kb())
+        return True
+    if step == 1:
+        name = norm_key(message.text or "")
+        if not name:
+            await message.reply_text("اكتب اسم القروب (غير فارغ)…")
+            return True
+        user_states[uid] = UserState("grp_add", {"step": 2, "name": name, "uni_tag": ""})
+        await message.reply_text(f"✅ اسم المصدر: <b>{html.escape(name)}</b>\n\nأرسل اسم/وسم الجامعة (uni_tag) اللي المصدر تابع لها…\nمثال: Tabuk أو NBU\n\nلو عايزها نفس اسم المصدر ابعت نفس الاسم")
+        return True
+    if step == 2:
+        uni_tag = norm_key(message.text or "")
+        if not uni_tag:
+            uni_tag = norm_key(str(st.get("name", "")))
+        user_states[uid] = UserState("grp_add", {"step": 3, "name": st.get("name", ""), "uni_tag": uni_tag})
+        await message.reply_text(f"✅ الجامعة: <b>{html.escape(uni_tag)}</b>\n\nأرسل chat (@username أو -100...)…")
+        return True
+    if step == 3:
+        chat = (message.text or "").strip()
+        if not chat:
+            await message.reply_text("اكتب chat (@username أو -100...)…")
+            return True
+        user_states[uid] = UserState("grp_add", {"step": 4, "name": st.get("name", ""), "uni_tag": st.get("uni_tag",""), "chat": chat})
+        await message.reply_text("📝 أرسل نص التمبلت الآن (هيتخزن في DB)…")
+        return True
+    name = norm_key(str(st.get("name", "")))
+    uni_tag = norm_key(str(st.get("uni_tag", "")))
+    chat = str(st.get("chat", "")).strip()
+    tpl = message.text or ""
+    out_file = f"outputs/{name}.txt"
+    ok, msg_txt = db_create_group(name=name, chat=chat, uni_tag=uni_tag, out_file=out_file, template_text=tpl, attachments_enabled=0, send_enabled=0, subjects_only=0)
+    user_states.pop(uid, None)
+    await message.reply_text(msg_txt, reply_markup=build_groups_manage_kb(0))
+    return True
 
-    if uid in grp_edit_state:
-        st = grp_edit_state.pop(uid, None) or {}
-        if not can_edit(uid):
-            await message.reply_text("ليست لديك صلاحية التعديل.", reply_markup=build_main_menu_kb())
-            return
-        gid = int(st.get("gid", 0))
-        field = str(st.get("field", "")).strip()
-        val = message.text or ""
-        if field in ("attachments_enabled", "send_enabled", "subjects_only"):
-            try:
-                val = int(str(val).strip())
-            except Exception:
-                val = 0
-        if field in ("name","uni_tag"):
-            val = norm_key(val)
-        ok, msg_txt = db_update_group_field(gid, field, val.strip() if isinstance(val, str) else val)
-        await message.reply_text(msg_txt, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع للتفاصيل", callback_data=f"grp:view:{gid}")]]))
-        return
 
-    # ---- Sections flows ----
-    if uid in sec_add_all_state:
-        st = sec_add_all_state.get(uid) or {}
-        step = int(st.get("step", 1))
-        if not can_edit(uid):
-            sec_add_all_state.pop(uid, None)
-            await message.reply_text("ليست لديك صلاحية التعديل.", reply_markup=build_main_menu_kb())
-            return
-        if step == 1:
-            name = norm_key(message.text or "")
-            if not name:
-                await message.reply_text("اكتب اسم المادة/السكشن (لازم يكون غير فارغ)…")
-                return
-            sec_add_all_state[uid] = {"step": 2, "name": name}
-            await message.reply_text(f"✅ الاسم: <b>{html.escape(name)}</b>\n\nأرسل الكلمات المفتاحية الآن (افصل بينهم بفاصلة أو سطر جديد)…")
-            return
-        name = norm_key(str(st.get("name", "")))
-        kws = parse_keywords_input(message.text or "")
-        # add to all universities (distinct uni_tag)
-        unis = db_list_universities()
-        ok_count = 0
-        for _gid, uni_tag, _cnt in unis:
-            ok, _ = db_add_section(norm_key(uni_tag), name, kws)
-            if ok:
-                ok_count += 1
-        log_action(uid, "add_section_all", None, f"name={name} unis={len(unis)}")
-        sec_add_all_state.pop(uid, None)
-        await message.reply_text(f"تمت إضافة السكشن لكل الجامعات. (تم/تحديث: {ok_count} جامعة)", reply_markup=build_main_menu_kb())
-        return
+async def _ft_grp_edit(client, message: Message, uid: int, st: Dict) -> bool:
+    user_states.pop(uid, None)
+    if not can_edit(uid):
+        await message.reply_text("ليست لديك صلاحية التعديل.", reply_markup=build_main_menu_kb())
+        return True
+    gid = int(st.get("gid", 0))
+    field = str(st.get("field", "")).strip()
+    val = message.text or ""
+    if field in ("attachments_enabled", "send_enabled", "subjects_only"):
+        try:
+            val = int(str(val).strip())
+        except Exception:
+            val = 0
+    if field in ("name","uni_tag"):
+        val = norm_key(val)
+    ok, msg_txt = db_update_group_field(gid, field, val.strip() if isinstance(val, str) else val)
+    await message.reply_text(msg_txt, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع للتفاصيل", callback_data=f"grp:view:{gid}")]]))
+    return True
 
-    if uid in sec_add_state:
-        st = sec_add_state.get(uid) or {}
-        uni_gid = int(st.get("uni_gid", 0))
-        step = int(st.get("step", 1))
-        rowg = db_get_group(uni_gid)
-        uni_name = norm_key(str(rowg[2] if (rowg and len(rowg)>2) else (rowg[1] if rowg else ''))) if rowg else None
-        if not uni_name or not can_edit(uid):
-            sec_add_state.pop(uid, None)
-            await message.reply_text("لا يمكن إكمال العملية.", reply_markup=build_main_menu_kb())
-            return
-        if step == 1:
-            name = norm_key(message.text or "")
-            if not name:
-                await message.reply_text("اكتب اسم السكشن (لازم يكون غير فارغ)…")
-                return
-            sec_add_state[uid] = {"uni_gid": uni_gid, "step": 2, "name": name}
-            await message.reply_text(f"✅ الاسم: <b>{html.escape(name)}</b>\n\nأرسل الكلمات المفتاحية الآن (افصل بينهم بفاصلة أو سطر جديد)…")
-            return
-        name = norm_key(str(st.get("name", "")))
-        kws = parse_keywords_input(message.text or "")
-        ok, msg_txt = db_add_section(uni_name, name, kws)
-        log_action(uid, "add_section", None, f"uni={uni_name} name={name}")
-        sec_add_state.pop(uid, None)
-        await message.reply_text(msg_txt, reply_markup=build_sections_list_kb(uni_gid, 0))
-        return
 
-    if uid in sec_editkw_state:
-        st = sec_editkw_state.pop(uid, None) or {}
-        if not can_edit(uid):
-            await message.reply_text("ليست لديك صلاحية التعديل.", reply_markup=build_main_menu_kb())
-            return
-        sid = int(st.get("section_id", 0))
-        uni_gid = int(st.get("uni_gid", 0))
-        kws = parse_keywords_input(message.text or "")
-        ok, msg_txt = db_update_section_keywords(sid, kws)
-        log_action(uid, "update_section_keywords", None, str(sid))
-        await message.reply_text(msg_txt, reply_markup=build_section_detail_kb(sid, uni_gid))
-        return
+# ---- Sections flows ----
+async def _ft_sec_add_all(client, message: Message, uid: int, st: Dict) -> bool:
+    step = int(st.get("step", 1))
+    if not can_edit(uid):
+        user_states.pop(uid, None)
+        await message.reply_text("ليست لديك صلاحية التعديل.", reply_markup=build_main_menu_kb())
+        return True
+    if step == 1:
+        name = norm_key(message.text or "")
+        if not name:
+            await message.reply_text("اكتب اسم المادة/السكشن (لازم يكون غير فارغ)…")
+            return True
+        user_states[uid] = UserState("sec_add_all", {"step": 2, "name": name})
+        await message.reply_text(f"✅ الاسم: <b>{html.escape(name)}</b>\n\nأرسل الكلمات المفتاحية الآن (افصل بينهم بفاصلة أو سطر جديد)…")
+        return True
+    name = norm_key(str(st.get("name", "")))
+    kws = parse_keywords_input(message.text or "")
+    # add to all universities (distinct uni_tag)
+    unis = db_list_universities()
+    # ✅ transaction واحدة لكل الجامعات بدل commit لكل جامعة
+    ok_count = db_add_sections_bulk([uni_tag for _gid, uni_tag, _cnt in unis], name, kws)
+    log_action(uid, "add_section_all", None, f"name={name} unis={len(unis)}")
+    user_states.pop(uid, None)
+    await message.reply_text(f"تمت إضافة السكشن لكل الجامعات. (تم/تحديث: {ok_count} جامعة)", reply_markup=build_main_menu_kb())
+    return True
 
-    if uid in sec_rename_state:
-        st = sec_rename_state.pop(uid, None) or {}
-        if not can_edit(uid):
-            await message.reply_text("ليست لديك صلاحية التعديل.", reply_markup=build_main_menu_kb())
-            return
-        sid = int(st.get("section_id", 0))
-        uni_gid = int(st.get("uni_gid", 0))
-        new_name = norm_key(message.text or "")
-        ok, msg_txt = db_rename_section(sid, new_name)
-        log_action(uid, "rename_section", None, str(sid))
-        await message.reply_text(msg_txt, reply_markup=build_section_detail_kb(sid, uni_gid))
-        return
 
-    # تعديل نص الرسالة
-    if uid in editing_state:
-        msg_id = editing_state.pop(uid)
-        new_text = message.text or ""
-        db_edit_message(msg_id, new_text)
-        log_action(uid, "edit_text", msg_id)
-        await message.reply_text(f"تم تعديل الرسالة #{msg_id}", reply_markup=build_main_menu_kb())
-        return
+async def _ft_sec_add(client, message: Message, uid: int, st: Dict) -> bool:
+    uni_gid = int(st.get("uni_gid", 0))
+    step = int(st.get("step", 1))
+    rowg = get_group_cached(uni_gid)
+    uni_name = norm_key(str(rowg[2] if (rowg and len(rowg)>2) else (rowg[1] if rowg else ''))) if rowg else None
+    if not uni_name or not can_edit(uid):
+        user_states.pop(uid, None)
+        await message.reply_text("لا يمكن إكمال العملية.", reply_markup=build_main_menu_kb())
+        return True
+    if step == 1:
+        name = norm_key(message.text or "")
+        if not name:
+            await message.reply_text("اكتب اسم السكشن (لازم يكون غير فارغ)…")
+            return True
+        user_states[uid] = UserState("sec_add", {"uni_gid": uni_gid, "step": 2, "name": name})
+        await message.reply_text(f"✅ الاسم: <b>{html.escape(name)}</b>\n\nأرسل الكلمات المفتاحية الآن (افصل بينهم بفاصلة أو سطر جديد)…")
+        return True
+    name = norm_key(str(st.get("name", "")))
+    kws = parse_keywords_input(message.text or "")
+    ok, msg_txt = db_add_section(uni_name, name, kws)
+    log_action(uid, "add_section", None, f"uni={uni_name} name={name}")
+    user_states.pop(uid, None)
+    await message.reply_text(msg_txt, reply_markup=build_sections_list_kb(uni_gid, 0))
+    return True
 
-    # ملاحظة
-    if uid in note_state:
-        mid = note_state.pop(uid)
-        db_set_note(mid, message.text or "")
-        log_action(uid, "set_note", mid)
-        await message.reply_text(f"تم حفظ الملاحظة للرسالة #{mid}", reply_markup=build_main_menu_kb())
-        return
 
-    # تعيين
-    if uid in assign_state:
-        mid = assign_state.pop(uid)
-        try:
-            assigned_uid = int((message.text or "").strip())
-        except Exception:
-            await message.reply_text("صيغة user_id غير صحيحة.", reply_markup=build_main_menu_kb())
-            return
-        db_assign_to(mid, assigned_uid)
-        log_action(uid, "assign_to", mid, str(assigned_uid))
-        await message.reply_text(f"تم تعيين {assigned_uid} للرسالة #{mid}", reply_markup=build_main_menu_kb())
-        return
+async def _ft_sec_editkw(client, message: Message, uid: int, st: Dict) -> bool:
+    user_states.pop(uid, None)
+    if not can_edit(uid):
+        await message.reply_text("ليست لديك صلاحية التعديل.", reply_markup=build_main_menu_kb())
+        return True
+    sid = int(st.get("section_id", 0))
+    uni_gid = int(st.get("uni_gid", 0))
+    kws = parse_keywords_input(message.text or "")
+    ok, msg_txt = db_update_section_keywords(sid, kws)
+    log_action(uid, "update_section_keywords", None, str(sid))
+    await message.reply_text(msg_txt, reply_markup=build_section_detail_kb(sid, uni_gid))
+    return True
 
-    # بحث
-    if uid in search_state:
-        search_state.discard(uid)
-        q = (message.text or "").strip()
-        if not q:
-            await message.reply_text("أرسل كلمة/عبارة للبحث.", reply_markup=build_main_menu_kb())
-            return
-        conn = db_conn()
-        cur = conn.cursor()
-        cur.execute(
-            """SELECT id, chat_username, user_id, username,
-                      COALESCE(edited_text, text), date,
-                      COALESCE(status,'new'), COALESCE(source_tag,''),
-                      COALESCE(uni_subjects,'')
-               FROM messages
-               WHERE deleted=0 AND (text LIKE ? OR edited_text LIKE ?)
-               ORDER BY id DESC LIMIT 10""",
-            (f"%{q}%", f"%{q}%"),
-        )
-        rows = cur.fetchall()
-        conn.close()
-        if not rows:
-            await message.reply_text("لا نتائج.", reply_markup=build_main_menu_kb())
-            return
-        await message.reply_text(
-            f"نتائج البحث لـ: <b>{html.escape(q)}</b>",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 القائمة", callback_data="home")]]),
+
+async def _ft_sec_rename(client, message: Message, uid: int, st: Dict) -> bool:
+    user_states.pop(uid, None)
+    if not can_edit(uid):
+        await message.reply_text("ليست لديك صلاحية التعديل.", reply_markup=build_main_menu_kb())
+        return True
+    sid = int(st.get("section_id", 0))
+    uni_gid = int(st.get("uni_gid", 0))
+    new_name = norm_key(message.text or "")
+    ok, msg_txt = db_rename_section(sid, new_name)
+    log_action(uid, "rename_section", None, str(sid))
+    await message.reply_text(msg_txt, reply_markup=build_section_detail_kb(sid, uni_gid))
+    return True
+
+
+# تعديل نص الرسالة
+async def _ft_edit(client, message: Message, uid: int, st: Dict) -> bool:
+    user_states.pop(uid, None)
+    msg_id = int(st["msg_id"])
+    new_text = message.text or ""
+    db_edit_message(msg_id, new_text)
+    log_action(uid, "edit_text", msg_id)
+    await message.reply_text(f"تم تعديل الرسالة #{msg_id}", reply_markup=build_main_menu_kb())
+    return True
+
+
+# ملاحظة
+async def _ft_note(client, message: Message, uid: int, st: Dict) -> bool:
+    user_states.pop(uid, None)
+    mid = int(st["msg_id"])
+    db_set_note(mid, message.text or "")
+    log_action(uid, "set_note", mid)
+    await message.reply_text(f"تم حفظ الملاحظة للرسالة #{mid}", reply_markup=build_main_menu_kb())
+    return True
+
+
+# تعيين
+async def _ft_assign(client, message: Message, uid: int, st: Dict) -> bool:
+    user_states.pop(uid, None)
+    mid = int(st["msg_id"])
+    try:
+        assigned_uid = int((message.text or "").strip())
+    except Exception:
+        await message.reply_text("صيغة user_id غير صحيحة.", reply_markup=build_main_menu_kb())
+        return True
+    db_assign_to(mid, assigned_uid)
+    log_action(uid, "assign_to", mid, str(assigned_uid))
+    await message.reply_text(f"تم تعيين {assigned_uid} للرسالة #{mid}", reply_markup=build_main_menu_kb())
+    return True
+
+
+# بحث
+async def _ft_search(client, message: Message, uid: int, st: Dict) -> bool:
+    user_states.pop(uid, None)
+    q = (message.text or "").strip()
+    if not q:
+        await message.reply_text("أرسل كلمة/عبارة للبحث.", reply_markup=build_main_menu_kb())
+        return True
+    rows = db_search_messages(q, 10)
+    if not rows:
+        await message.reply_text("لا نتائج.", reply_markup=build_main_menu_kb())
+        return True
+    await message.reply_text(
+        f"نتائج البحث لـ: <b>{html.escape(q)}</b>",
+        reply_markup=InlineKeyboardMarkup([[_HOME_BTN]]),
+    )
+    editor = can_edit(uid)
+    # ✅ النتايج بتتبعت بنفس send_cards بتاع send_list (حد التوازي + FloodWait + لوج)؛ كل نتيجة عليها #id
+
+    def _card(row):
+        _id, chat_un, user_id2, username, text, date, st, tag, uni_json = row
+        short = (text or "")[:300]
+        uni_subjects = json_list(uni_json)
+        extra = ""
+        if uni_subjects:
+            extra += "\n📚 المواد:\n" + "\n".join(f"• {_esc(s)}" for s in uni_subjects)
+        kb = build_item_kb(_id, user_id2, uni_subjects) if editor else None
+        return (
+            f"[{_esc(tag)}] #{_id} | {render_user_display(username)} | {_esc(chat_un)}\n"
+            f"الحالة: {_esc(status_label(st))}\n"
+            f"{date}\n\n{_esc(short)}{extra}",
+            kb,
         )
-        for _id, chat_un, user_id2, username, text, date, st, tag, uni_json in rows:
-            short = (text or "")[:300]
-            uni_subjects = []
-            if uni_json:
-                try:
-                    uni_subjects = json.loads(uni_json)
-                    if not isinstance(uni_subjects, list):
-                        uni_subjects = []
-                except Exception:
-                    uni_subjects = []
-            extra = ""
-            if uni_subjects:
-                extra += "\n📚 المواد:\n" + "\n".join(f"• {html.escape(str(s))}" for s in uni_subjects)
-            kb = build_item_kb(_id, user_id2, uni_subjects) if can_edit(uid) else None
-            await message.reply_text(
-                f"[{html.escape(str(tag))}] #{_id} | {render_user_display(username)} | {html.escape(str(chat_un))}\n"
-                f"الحالة: {html.escape(status_label(st))}\n"
-                f"{html.escape(str(date))}\n\n{html.escape(short)}{extra}",
-                reply_markup=kb,
-            )
-        return
 
+    await send_cards(message, [_card(r) for r in rows])
+    return True
+
+
+_FREE_TEXT_HANDLERS = {
+    "us_add_source": _ft_us_add_source,
+    "grp_add": _ft_grp_add,
+    "grp_edit": _ft_grp_edit,
+    "sec_add_all": _ft_sec_add_all,
+    "sec_add": _ft_sec_add,
+    "sec_editkw": _ft_sec_editkw,
+    "sec_rename": _ft_sec_rename,
+    "edit": _ft_edit,
+    "note": _ft_note,
+    "assign": _ft_assign,
+    "search": _ft_search,
+}
+
+
+@app.on_message(filters.text & ~filters.command(["start", "inbox", "new", "serving", "done", "notserved", "search", "stats", "exportcsv", "kw", "g"]))
+@guard
+async def on_free_text(client, message: Message):
+    uid = message.from_user.id
+    ust = user_states.get(uid)
+
+    # ✅ dispatch على نوع الـ state (dict lookup واحد بدل سلسلة if kind == ...)
+    handler = _FREE_TEXT_HANDLERS.get(ust.kind) if ust else None
+    if handler is not None and await handler(client, message, uid, ust.data):
+        return
     await message.reply_text("اختر من القائمة:", reply_markup=build_main_menu_kb())
 
 
@@ -2409,6 +3316,7 @@ async def on_free_text(client, message: Message):
 # -----------------------
 if __name__ == "__main__":
     db_init()
+    start_db_optimizer()
     try:
         db_seed_groups_from_config()
     except Exception: